@@ -7,7 +7,6 @@ import os
 import os.path
 import datetime
 import urllib.parse
-import bs4
 
 import runStatus
 runStatus.preloadDicts = False
@@ -177,17 +176,6 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 		ret["spage"] = spage
 		return ret
 
-	def getImage(self, imageUrl, referrer):
-
-		content, handle = self.wg.getpage(imageUrl, returnMultiple=True, addlHeaders={'Referer': referrer})
-		if not content or not handle:
-			raise ValueError("Failed to retreive image from page '%s'!" % referrer)
-
-		fileN = urllib.parse.unquote(urllib.parse.urlparse(handle.geturl())[2].split("/")[-1])
-		fileN = bs4.UnicodeDammit(fileN).unicode_markup
-		self.log.info("retreived image '%s' with a size of %0.3f K", fileN, len(content)/1000.0)
-		return fileN, content
-
 	def extract_cdn_subdomain(self, url):
 		# var number_of_frontends = 2;
 		number_of_frontends = 2
@@ -233,7 +221,7 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 		return subid
 
 
-	def getImages(self, fetch_params):
+	def getImageUrls(self, fetch_params):
 
 		# print("getImage", fetch_params)
 
@@ -250,22 +238,19 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 			imgurl = re.sub(r"\/\/..?\.hitomi\.la\/", 'https://{}.hitomi.la/'.format(self.extract_cdn_subdomain(imgurl)), imgurl, flags=re.IGNORECASE)
 			# print("ImageURL:", imgurl)
 			imageurls.append((imgurl, fetch_params['spage']))
-		if not imageurls:
-			return []
-
-		images = []
-
 
-		for imageurl, referrer in imageurls:
-			images.append(self.getImage(imageurl, referrer))
+		return imageurls
 
-		return images
+	def getImages(self, imageurls):
+		# Fetched concurrently, and yielded in page order, so save_image_set()
+		# can write each image as it arrives, rather then holding the whole gallery.
+		return self.iter_image_set(imageurls)
 
 
 	def get_link(self, link_row_id):
 		try:
 			link_info = self.getDownloadInfo(link_row_id)
-			images = self.getImages(link_info)
+			imageurls = self.getImageUrls(link_info)
 			title  = link_info['title']
 			artist = link_info['artist']
 
@@ -274,22 +259,36 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 				row.state = 'error'
 			return False
 
-		if not (images and title):
+		if not (imageurls and title):
 			return False
 
+		images = self.getImages(imageurls)
 
-		with self.row_sess_context(dbid=link_row_id) as row_tup:
-			row, sess = row_tup
+		with self.row_context(dbid=link_row_id) as row:
+			series_name = row.series_name
 
-			fileN = title+" - "+artist+".zip"
-			fileN = nt.makeFilenameSafe(fileN)
+		fileN = title+" - "+artist+".zip"
+		fileN = nt.makeFilenameSafe(fileN)
 
-			container_dir = os.path.join(settings.hitSettings["dlDir"],
-				nt.makeFilenameSafe(row.series_name))
+		container_dir = os.path.join(settings.hitSettings["dlDir"],
+			nt.makeFilenameSafe(series_name))
 
-			wholePath = os.path.join(container_dir, fileN)
+		wholePath = os.path.join(container_dir, fileN)
 
-			fqFName = self.save_image_set(row, sess, wholePath, images)
+		# The images are downloaded as they're written into the archive, so this is
+		# done without the row session open, and with the same error handling as
+		# the gallery page fetches.
+		try:
+			fqFName, fhash = self.write_image_set(wholePath, images)
+
+		except WebRequest.WebGetException:
+			with self.row_context(dbid=link_row_id) as row:
+				row.state = 'error'
+			return False
+
+		with self.row_sess_context(dbid=link_row_id) as row_tup:
+			row, sess = row_tup
+			fqFName = self.attach_file_row(row, sess, fqFName, fhash)
 
 		with self.row_context(dbid=link_row_id) as row:
 			row.state = 'processing'
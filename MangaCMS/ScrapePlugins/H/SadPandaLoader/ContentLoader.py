@@ -3,19 +3,15 @@
 
 import os
 import os.path
-import time
 import datetime
 import re
 import nameTools as nt
-import runStatus
 import urllib.request, urllib.parse, urllib.error
 import traceback
 
 import WebRequest
 
 import settings
-import random
-random.seed()
 
 from . import LoginMixin
 import MangaCMS.cleaner.processDownload
@@ -214,7 +210,9 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase, LoginMix
 
 
 
-		fCont, fName = self.wg.getFileAndName(downloadUrl)
+		# Archives can run to several hundred MB, so stream them to disk rather then buffering them.
+		staged = self.download_to_staging(downloadUrl)
+		fName = staged.name
 
 
 		# self.log.info(len(content))
@@ -232,7 +230,7 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase, LoginMix
 		# This call also inserts the file parameters into the row
 		with self.row_sess_context(dbid=link_row_id) as row_tup:
 			row, sess = row_tup
-			fqFName = self.save_archive(row, sess, fqFName, fCont)
+			fqFName = self.save_archive(row, sess, fqFName, staged)
 
 		#self.log.info( filePath)
 
@@ -261,21 +259,12 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase, LoginMix
 			return False
 		try:
 
+			# Pacing is handled by the shared host rate limiter (settings.hostRateLimits),
+			# which _fetch_link() consults before each item.
 			link_info = self.getDownloadInfo(link_row_id)
 			if link_info:
 				self.doDownload(link_info=link_info, link_row_id=link_row_id)
 
-				sleeptime = random.randint(10,60*5)
-			else:
-				sleeptime = 5
-
-			self.log.info("Sleeping %s seconds.", sleeptime)
-			for dummy_x in range(sleeptime):
-				time.sleep(1)
-				if not runStatus.run:
-					self.log.info( "Breaking due to exit flag being set")
-					break
-
 			return True
 
 
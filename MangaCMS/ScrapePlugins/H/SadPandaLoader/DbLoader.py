@@ -2,13 +2,10 @@
 
 import traceback
 
-import re
 import copy
 import urllib.parse
 import time
 import calendar
-import random
-import runStatus
 
 import dateutil.parser
 
@@ -55,17 +52,17 @@ class DbLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase, LoginMixin.ExLoginM
 				pageUrl = pageUrl + '&f_sdt1=on'
 			if includeDownvoted:
 				pageUrl = pageUrl + '&f_sdt2=on'
-			soup = self.wg.getSoup(pageUrl)
+			page = self.wg.getpage(pageUrl)
 		except urllib.error.URLError:
 			self.log.critical("Could not get page from SadPanda!")
 			self.log.critical(traceback.format_exc())
 			return None
 
 		# with open("sp_search_{}_{}.html".format(nt.makeFilenameSafe(tag), time.time()), "w") as fp:
-		# 	fp.write(soup.prettify())
+		# 	fp.write(page)
 
 
-		return soup
+		return page
 
 
 	def getUploadTime(self, dateStr):
@@ -85,13 +82,13 @@ class DbLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase, LoginMixin.ExLoginM
 
 	def parseItem(self, inRow):
 		ret = {}
-		itemType, pubDate, name, uploader = inRow.find_all("td")
+		itemType, pubDate, name, uploader = inRow.xpath("./td")
 
 		# Do not download any galleries we uploaded.
-		if uploader.get_text().lower().strip() == settings.sadPanda['login'].lower():
+		if self.get_text(uploader).lower().strip() == settings.sadPanda['login'].lower():
 			return None
 
-		category = itemType.img['alt']
+		category = itemType.xpath(".//img/@alt")[0]
 		if category.lower() in settings.sadPanda['sadPandaExcludeCategories']:
 			self.log.info("Excluded category: '%s'. Skipping.", category)
 			return False
@@ -100,12 +97,13 @@ class DbLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase, LoginMixin.ExLoginM
 		ret['series_name'] = category.title()
 		# If there is a torrent link, decompose it so the torrent link doesn't
 		# show up in our parsing of the content link.
-		if name.find("div", class_='it3'):
-			name.find("div", class_='it3').decompose()
+		for torrent_div in self.css(name, "div.it3"):
+			torrent_div.drop_tree()
 
-		ret['source_id']   = name.a['href']
-		ret['origin_name'] = name.a.get_text().strip()
-		ret['posted_at']   = self.getUploadTime(pubDate.get_text())
+		link = name.xpath(".//a")[0]
+		ret['source_id']   = link.get('href')
+		ret['origin_name'] = self.get_text(link).strip()
+		ret['posted_at']   = self.getUploadTime(self.get_text(pubDate))
 
 		return ret
 
@@ -118,14 +116,17 @@ class DbLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase, LoginMixin.ExLoginM
 		ret = []
 
 		self.log.info("Loading feed for search: '%s'", searchTag)
-		soup = self.loadFeed(searchTag, pageOverride, includeExpunge, includeLowPower, includeDownvoted)
-
-		itemTable = soup.find("table", class_="itg")
+		page = self.loadFeed(searchTag, pageOverride, includeExpunge, includeLowPower, includeDownvoted)
+		if not page:
+			return []
 
-		if not itemTable:
+		# Only the gallery table is of any interest, so don't build a tree for the rest of the page.
+		tables = self.strain(page, "table", where=r'class=["\'][^"\']*\bitg\b', first=True)
+		if not tables:
 			return []
 
-		rows = itemTable.find_all("tr", class_=re.compile("gtr[01]"))
+		itemTable = self.parse_html(tables[0])
+		rows = self.css(itemTable, "tr.gtr0, tr.gtr1")
 		self.log.info("Found %s items on page.", len(rows))
 		for row in rows:
 
@@ -147,18 +148,16 @@ class DbLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase, LoginMixin.ExLoginM
 
 		for searchTag, includeExpunge, includeLowPower, includeDownvoted in settings.sadPanda['sadPandaSearches']:
 
+			# Paced by the shared host rate limiter (settings.hostRateLimits), so
+			# the feed and content plugins draw from the same budget.
+			if not self.rate_limit(self.urlBase):
+				self.log.info( "Breaking due to exit flag being set")
+				return
+
 			dat = self.get_feed(searchTag, includeExpunge, includeLowPower, includeDownvoted)
 
 			self._process_links_into_db(dat)
 
-			sleeptime = random.randrange(5, 60)
-			self.log.info("Sleeping %s seconds.", sleeptime)
-			for dummy_x in range(sleeptime):
-				time.sleep(1)
-				if not runStatus.run:
-					self.log.info( "Breaking due to exit flag being set")
-					return
-
 
 
 # def getHistory():
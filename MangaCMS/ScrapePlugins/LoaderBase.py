@@ -2,14 +2,21 @@
 
 
 import abc
+import array
+import bisect
+import hashlib
 import datetime
+import contextlib
+import urllib.error
+import urllib.request
 
+import bs4
 import WebRequest
+from sqlalchemy.dialects.postgresql import insert
 
 import settings
 import nameTools as nt
 import MangaCMS.ScrapePlugins.MangaScraperBase
-import MangaCMS.ScrapePlugins.ScrapeExceptions as ScrapeExceptions
 
 
 class LoaderBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
@@ -25,6 +32,9 @@ class LoaderBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		super().__init__(*args, **kwargs)
 		self.wg = WebRequest.WebGetRobust(logPath=self.logger_path+".Web")
 
+		self.page_cache_hits   = 0
+		self.page_cache_misses = 0
+
 	def setup(self):
 		pass
 
@@ -60,47 +70,128 @@ class LoaderBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		assert isinstance(check_dict.get("tags", []), (list, tuple)), "Tags item must be a list!"
 
 
+	# Number of rows per multi-row INSERT statement.
+	insert_batch_size = 1000
+
+	def _check_tags(self, tags):
+		assert isinstance(tags, (list, tuple)), "tags must be a list or tuple!"
+		assert all([len(tag) >= 2 for tag in tags]), "All tags must be at least one character long. Bad tags: %s" % [tag for tag in tags if len(tag) < 2]
+		assert all([len(tag) < 90 for tag in tags]), "All tags must be less then 90 characters long. Bad tags: %s" % [(tag, len(tag)) for tag in tags if len(tag) >= 90]
+
+	def _insert_link_batch(self, sess, links):
+		'''
+		Insert a batch of link dicts with a single multi-row
+		INSERT ... ON CONFLICT (source_site, source_id) DO NOTHING.
+		Returns the set of source_ids that were actually new.
+		'''
+		table = self.target_table.__table__
+		now = datetime.datetime.now()
+
+		# A multi-row VALUES clause needs every row to have the same keys,
+		# so split the batch up by key-set (generally there is only one).
+		by_keys = {}
+		for link in links:
+			by_keys.setdefault(frozenset(link.keys()), []).append(link)
+
+		new_ids = set()
+		for key_group in by_keys.values():
+			rows = []
+			for link in key_group:
+				# Links are allowed to override the initial state.
+				row = {
+						'state'       : 'new',
+						'source_site' : self.plugin_key,
+						'first_seen'  : now,
+					}
+				row.update(link)
+				rows.append(row)
+			stmt = insert(table).values(rows)                                            \
+				.on_conflict_do_nothing(index_elements=['source_site', 'source_id']) \
+				.returning(table.c.source_id)
+			new_ids.update(source_id for source_id, in sess.execute(stmt))
+
+		return new_ids
+
+	def _apply_link_tags(self, sess, link_tags):
+		'''
+		Attach tags to release rows, given a dict of {source_id : [tags, ...]}.
+		Rows whose tags mark them as unwanted are deleted instead.
+		Returns the number of rows deleted.
+		'''
+		if not link_tags:
+			return 0
+
+		table = self.target_table.__table__
+		link_table = self.target_tags_link_table
+
+		res = sess.execute(table.select()
+				.with_only_columns([table.c.id, table.c.source_id])
+				.where(table.c.source_site == self.plugin_key)
+				.where(table.c.source_id.in_(list(link_tags.keys())))
+			)
+		row_ids = {source_id : row_id for row_id, source_id in res}
+
+		tag_ids = self.target_tags_table.resolve_tags([tag for tags in link_tags.values() for tag in tags], sess=sess)
+
+		link_rows = []
+		for source_id, tags in link_tags.items():
+			if source_id not in row_ids:
+				self.log.warning("No release row for '%s'. Not attaching its tags.", source_id)
+				continue
+			for tag in set(tags):
+				link_rows.append({'releases_id' : row_ids[source_id], 'tags_id' : tag_ids[tag.lower()]})
+
+		if link_rows:
+			sess.execute(insert(link_table).values(link_rows).on_conflict_do_nothing())
+
+		# Filtering has to be against the complete tag set of each row, which
+		# includes anything attached on a previous pass.
+		tag_table = self.target_tags_table.__table__
+		res = sess.execute(link_table.join(tag_table).select()
+				.with_only_columns([link_table.c.releases_id, tag_table.c.tag])
+				.where(link_table.c.releases_id.in_(list(row_ids.values())))
+			)
+		row_tags = {}
+		for releases_id, tag in res:
+			row_tags.setdefault(releases_id, []).append(tag)
+
+		unwanted = [row_id for row_id, tags in row_tags.items() if not self.wanted_from_tags(tags)]
+		if unwanted:
+			self.log.info("How does something have masked tags on insertion? Deleting %s rows.", len(unwanted))
+			sess.execute(link_table.delete().where(link_table.c.releases_id.in_(unwanted)))
+			sess.execute(table.delete().where(table.c.id.in_(unwanted)))
+
+		return len(unwanted)
+
 	def _process_links_into_db(self, linksDicts):
 
 		self.log.info( "Inserting...")
 
-
 		newItems = 0
 		with self.db.session_context() as sess:
-			for link in linksDicts:
+			for offset in range(0, len(linksDicts), self.insert_batch_size):
+				batch = []
+				link_tags = {}
+				for link in linksDicts[offset:offset+self.insert_batch_size]:
 
-				self._check_keys(link)
+					self._check_keys(link)
 
-				tags = link.pop("tags", [])
-				assert isinstance(tags, (list, tuple)), "tags must be a list or tuple!"
+					tags = link.pop("tags", [])
+					self._check_tags(tags)
 
-				if 'series_name' in link and self.shouldCanonize:
-					link["series_name"] = nt.getCanonicalMangaUpdatesName(link["series_name"])
+					if 'series_name' in link and self.shouldCanonize:
+						link["series_name"] = nt.getCanonicalMangaUpdatesName(link["series_name"])
 
-				have = sess.query(self.target_table)                            \
-					.filter(self.target_table.source_site == self.plugin_key)     \
-					.filter(self.target_table.source_id == link["source_id"]) \
-					.scalar()
+					batch.append(link)
+					if tags:
+						link_tags.setdefault(link["source_id"], []).extend(tags)
 
-				if not have:
-					newItems += 1
-					have = self.target_table(
-							state       = 'new',            # Should be set automatically.
-							source_site = self.plugin_key,
-							first_seen  = datetime.datetime.now(),
-							**link
-						)
+				new_ids = self._insert_link_batch(sess, batch)
+				newItems += len(new_ids)
 
-					sess.add(have)
+				self._apply_link_tags(sess, link_tags)
 
-					if newItems % 10000 == 0:
-						self.log.info("Added %s rows, doing incremental commit!", newItems)
-						sess.commit()
-				try:
-					self.update_tags(tags=tags, row=have)
-				except ScrapeExceptions.UnwantedContentError:
-					self.log.info("How does something have masked tags on insertion?")
-					sess.delete(have)
+				sess.commit()
 
 		if self.mon_con:
 			self.mon_con.incr('new_links', newItems)
@@ -109,6 +200,249 @@ class LoaderBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 
 		return newItems
 
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+	# Conditional page fetching
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+	def _fetch_conditional(self, url, cached):
+		'''
+		Fetch `url`, sending the validators from `cached` (if any).
+		Returns (content, handle), or (None, None) if the server says the page is not modified.
+		'''
+		headers = {}
+		if cached and cached.etag:
+			headers['If-None-Match'] = cached.etag
+		if cached and cached.last_modified:
+			headers['If-Modified-Since'] = cached.last_modified
+
+		if headers:
+			# The request goes straight through the WebGetRobust opener, since
+			# getpage() treats a 304 as a failed fetch, and logs it and sleeps
+			# before giving up.
+			# Compression is turned off, so only the text decoding is left to do.
+			headers['Accept-Encoding'] = 'identity'
+			request = urllib.request.Request(url, headers=headers)
+			try:
+				with self.wg.opener.open(request, timeout=self.wg.timeout) as handle:
+					content = handle.read()
+			except urllib.error.HTTPError as e:
+				if e.code == 304:
+					return None, None
+				self.log.warning("Conditional fetch of %s failed (%s). Retrying unconditionally.", url, e)
+			except Exception as e:
+				self.log.warning("Conditional fetch of %s failed (%s). Retrying unconditionally.", url, e)
+			else:
+				self.wg._check_waf(content, handle.geturl())
+				return self._decode_page(content, handle), handle
+
+		# Anything else goes through the normal fetch path (and its error handling).
+		return self.wg.getpage(url, returnMultiple=True)
+
+	def _decode_page(self, content, handle):
+		charset = handle.headers.get_content_charset()
+		if charset:
+			try:
+				return content.decode(charset, errors='replace')
+			except LookupError:
+				self.log.warning("Unknown charset '%s' for %s", charset, handle.geturl())
+		# No (usable) charset in the headers, so look at the content itself.
+		return bs4.UnicodeDammit(content, is_html=True).unicode_markup
+
+	@contextlib.contextmanager
+	def changed_page_context(self, url, parser=WebRequest.as_soup):
+		'''
+		Fetch and parse `url`, unless it hasn't changed since this plugin last
+		processed it.
+
+		Yields the output of `parser` (the page soup, by default), or None if the page is unchanged (either the
+		server answered 304 to our ETag/Last-Modified, or the content hashes the
+		same as last time). The page's validators are only recorded once the
+		block exits cleanly, so a page whose contents never made it into the
+		database is fetched again on the next run.
+		'''
+		with self.db.session_context() as sess:
+			cached = sess.query(self.db.FeedPageCache)                           \
+				.filter(self.db.FeedPageCache.source_site == self.plugin_key) \
+				.filter(self.db.FeedPageCache.url == url)                     \
+				.scalar()
+			if cached:
+				sess.expunge(cached)
+
+		content, handle = self._fetch_conditional(url, cached)
+
+		if content is None:
+			self.log.info("Page %s not modified since last fetch. Skipping.", url)
+			self._count_page_cache(hit=True)
+			yield None
+			return
+
+		if isinstance(content, bytes):
+			raise WebRequest.ContentTypeError("Received content not decoded! Cannot parse!", url)
+
+		content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+		etag          = handle.headers.get("ETag")
+		last_modified = handle.headers.get("Last-Modified")
+
+		if cached and cached.content_hash == content_hash:
+			self.log.info("Page %s content unchanged since last fetch. Skipping.", url)
+			self._count_page_cache(hit=True)
+			yield None
+		else:
+			self._count_page_cache(hit=False)
+			yield parser(content)
+
+		with self.db.session_context() as sess:
+			sess.execute(
+					insert(self.db.FeedPageCache.__table__)
+					.values(
+							source_site   = self.plugin_key,
+							url           = url,
+							etag          = etag,
+							last_modified = last_modified,
+							content_hash  = content_hash,
+							last_checked  = datetime.datetime.now(),
+						)
+					.on_conflict_do_update(
+							index_elements = ['source_site', 'url'],
+							set_ = {
+								'etag'          : etag,
+								'last_modified' : last_modified,
+								'content_hash'  : content_hash,
+								'last_checked'  : datetime.datetime.now(),
+							}
+						)
+				)
+
+	def _count_page_cache(self, hit):
+		if hit:
+			self.page_cache_hits += 1
+		else:
+			self.page_cache_misses += 1
+		if self.mon_con:
+			self.mon_con.incr('page_cache_hits' if hit else 'page_cache_misses')
+
+	def _report_page_cache(self):
+		total = self.page_cache_hits + self.page_cache_misses
+		if not total:
+			return
+		ratio = self.page_cache_hits / total
+		self.log.info("Page cache: %s of %s pages unchanged (%0.1f%% hit ratio)", self.page_cache_hits, total, ratio * 100)
+		if self.mon_con:
+			self.mon_con.gauge('page_cache_hit_ratio', ratio)
+
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+	# Per-series crawl watermarks
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+	def get_watermark(self, series_url):
+		'''
+		Return the (source_id, posted_at) of the newest release this plugin has
+		ingested from `series_url`, or None if the series hasn't been crawled yet.
+		'''
+		with self.db.session_context() as sess:
+			row = sess.query(self.db.FeedWatermark.newest_source_id, self.db.FeedWatermark.newest_posted_at) \
+				.filter(self.db.FeedWatermark.source_site == self.plugin_key)                               \
+				.filter(self.db.FeedWatermark.series_url == series_url)                                     \
+				.first()
+		return tuple(row) if row else None
+
+	def past_watermark(self, item, watermark):
+		'''
+		Returns True if `item` is already covered by `watermark`. Feed parsers
+		walking a newest-first listing can stop as soon as this is true.
+		'''
+		if not watermark:
+			return False
+		newest_source_id, newest_posted_at = watermark
+		return item['source_id'] == newest_source_id or item['posted_at'] < newest_posted_at
+
+	def set_watermark(self, series_url, items):
+		'''
+		Advance the watermark for `series_url` to the newest of `items`. Call this
+		only after `items` have been committed by _process_links_into_db().
+		'''
+		if not items:
+			return
+		newest = max(items, key=lambda item: item['posted_at'])
+
+		table = self.db.FeedWatermark.__table__
+		stmt = insert(table).values(
+				source_site      = self.plugin_key,
+				series_url       = series_url,
+				newest_source_id = newest['source_id'],
+				newest_posted_at = newest['posted_at'],
+				last_checked     = datetime.datetime.now(),
+			)
+		stmt = stmt.on_conflict_do_update(
+				index_elements = ['source_site', 'series_url'],
+				set_ = {
+					'newest_source_id' : stmt.excluded.newest_source_id,
+					'newest_posted_at' : stmt.excluded.newest_posted_at,
+					'last_checked'     : stmt.excluded.last_checked,
+				},
+				# Never move a watermark backwards.
+				where = table.c.newest_posted_at <= stmt.excluded.newest_posted_at,
+			)
+		with self.db.session_context() as sess:
+			sess.execute(stmt)
+
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+	# Whole-feed snapshots
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+	@staticmethod
+	def snapshot_key(value):
+		return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], 'little')
+
+	@staticmethod
+	def in_snapshot(snapshot, key):
+		idx = bisect.bisect_left(snapshot, key)
+		return idx < len(snapshot) and snapshot[idx] == key
+
+	def load_feed_snapshot(self):
+		'''
+		Return the sorted array of snapshot_key()s saved by the last
+		save_feed_snapshot() call for this plugin, or None if there isn't one.
+		'''
+		with self.db.session_context() as sess:
+			blob = sess.query(self.db.FeedSnapshot.snapshot)                   \
+				.filter(self.db.FeedSnapshot.source_site == self.plugin_key) \
+				.scalar()
+		if blob is None:
+			return None
+
+		snapshot = array.array('Q')
+		snapshot.frombytes(blob)
+		self.log.info("Loaded feed snapshot with %s entries", len(snapshot))
+		return snapshot
+
+	def save_feed_snapshot(self, keys):
+		'''
+		Store the snapshot_key()s of everything seen in a full crawl of the feed,
+		at 8 bytes per item. Only call this once the crawl's new items have been
+		committed, or they'll be treated as already known on the next run.
+		'''
+		snapshot = array.array('Q', sorted(set(keys)))
+
+		table = self.db.FeedSnapshot.__table__
+		stmt = insert(table).values(
+				source_site  = self.plugin_key,
+				snapshot     = snapshot.tobytes(),
+				entries      = len(snapshot),
+				last_checked = datetime.datetime.now(),
+			)
+		stmt = stmt.on_conflict_do_update(
+				index_elements = ['source_site'],
+				set_ = {
+					'snapshot'     : stmt.excluded.snapshot,
+					'entries'      : stmt.excluded.entries,
+					'last_checked' : stmt.excluded.last_checked,
+				}
+			)
+		with self.db.session_context() as sess:
+			sess.execute(stmt)
+		self.log.info("Saved feed snapshot with %s entries", len(snapshot))
+
 	def do_fetch_feeds(self, *args, **kwargs):
 		self._resetStuckItems()
 		# dat = self.getFeed(list(range(50)))
@@ -116,6 +450,7 @@ class LoaderBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		dat = self.get_feed(*args, **kwargs)
 		self.log.info("Found %s total items", len(dat))
 		self._process_links_into_db(dat)
+		self._report_page_cache()
 
 
 	def go(self):
@@ -73,17 +73,7 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 
 		imageUrls = self.getImageUrls(source_url)
 
-		images = []
-
-		image_counter = 1
-		for imgUrl, referrerUrl in imageUrls:
-			imageContent, imageName = self.wg.getFileAndName(imgUrl, addlHeaders={'Referer': referrerUrl})
-			img_postf = urllib.parse.urlsplit(imgUrl).path.split("/")[-1]
-			imageName = "{:04d} - {} {}".format(image_counter, imageName, img_postf)
-			self.log.info("Found %s byte image named %s", len(imageContent), imageName)
-			images.append([imageName, imageContent])
-			image_counter += 1
-		return images
+		return self.fetch_image_set(imageUrls)
 
 
 	def get_link(self, link_row_id):
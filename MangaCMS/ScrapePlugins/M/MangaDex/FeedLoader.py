@@ -5,7 +5,9 @@ runStatus.preloadDicts = False
 
 
 import urllib.parse
+import traceback
 import time
+import lxml.html
 import calendar
 import parsedatetime
 import datetime
@@ -32,19 +34,19 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 		now = int(time.time() * 1000)
 		self.wg.getpage("https://mangadex.com/ajax/actions.ajax.php?function=hentai_toggle&mode=1&_={}".format(now))
 
-	def getUpdatedSeries(self, url):
-		ret = set()
-
-		soup = self.wg.getSoup(url)
-
-		if soup.find("div", class_='table-responsive'):
-			mainDiv = soup.find("div", class_='table-responsive')
-		else:
+	def strainListingPage(self, content):
+		# Only the listing table is used, so only that gets parsed.
+		listing = self.strain(content, "div", where=r'class=["\'][^"\']*\btable-responsive\b', first=True)
+		if not listing:
 			raise ValueError("Could not find listing table?")
+		return self.parse_fragments(listing)
+
+	def getUpdatedSeries(self, tree):
+		ret = set()
 
-		for child in mainDiv.find_all("a", class_='manga_title'):
-			if child:
-				seriesUrl = urllib.parse.urljoin(self.urlBase, child['href'])
+		for child in self.css(tree, "div.table-responsive a.manga_title"):
+			if child.get('href'):
+				seriesUrl = urllib.parse.urljoin(self.urlBase, child.get('href'))
 				ret.add(seriesUrl)
 
 
@@ -53,12 +55,12 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 		return ret
 
 
-	def getUpdatedSeriesPages(self):
+	def getUpdatedSeriesPages(self, tree):
 		# Historical stuff goes here, if wanted.
 
 		self.log.info("Loading MangaDex Items")
 
-		pages = self.getUpdatedSeries(self.seriesBase)
+		pages = self.getUpdatedSeries(tree)
 
 
 
@@ -67,36 +69,35 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 
 
 
-	def getSeriesInfoFromSoup(self, soup):
+	def strainSeriesPage(self, content):
+		# Only the title and the chapter rows are used, so only those get parsed.
+		title = self.strain(content, "h3", where=r'class=["\'][^"\']*\bpanel-title\b', first=True)
+		rows  = self.strain(content, "tr",  where=r'id=["\']chapter_')
+		return self.parse_fragments(title + ["<table>"] + rows + ["</table>"])
+
+	def getSeriesInfoFromTree(self, tree):
 		# Should probably extract tagging info here. Laaaaazy
 		# MangaUpdates interface does a better job anyways.
-		titleA = soup.find("h3", class_='panel-title')
-		return {"series_name": titleA.get_text(strip=True)}
-
-	def getChaptersFromSeriesPage(self, soup):
-		sname = soup.find("h3", class_='panel-title').get_text(strip=True)
+		titleA = self.css_first(tree, "h3.panel-title")
+		return {"series_name": self.get_text(titleA, strip=True)}
 
-		# import pdb
-		# pdb.set_trace()
+	def getChaptersFromSeriesPage(self, tree, watermark=None):
+		sname = self.get_text(self.css_first(tree, "h3.panel-title"), strip=True)
 
 		items = []
-		for row in soup.find_all("tr"):
-			if not row.a:
+		for row in tree.xpath('.//tr[contains(@id, "chapter_")]'):
+			if not row.xpath(".//a"):
 				continue  # Skip the table header row
 
-			# And any other rows
-			if not "chapter_" in row.get("id", ""):
-				continue
-
-			tds = row.find_all("td")
+			tds = row.xpath("./td")
 			if len(tds) != 8:
 				self.log.warning("Invalid number of table entries: %s", len(tds))
-				self.log.warning("Row: %s", row)
+				self.log.warning("Row: %s", lxml.html.tostring(row, encoding="unicode"))
 				continue
 
 			dummy_something, chapter_name, dummy_discussion, lang, group, dummy_uploader, dummy_views, ultime = tds
 
-			lang = lang.img['title']
+			lang = self.xpath_first(lang, ".//img/@title")
 			if lang != DOWNLOAD_ONLY_LANGUAGE:
 				self.log.warning("Skipping non-english item: %s", lang)
 				continue
@@ -105,33 +106,42 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 
 			# Name is formatted "{seriesName} {bunch of spaces}\n{chapterName}"
 			# Clean up that mess to "{seriesName} - {chapterName}"
-			name = chapter_name.get_text().strip()
+			name = self.get_text(chapter_name).strip()
 			name = name.replace("\n", " - ")
 			while "  " in name:
 				name = name.replace("  ", " ")
 
-			name = "{} - {} [{}, {}]".format(sname, name, "MangaDex", group.get_text(strip=True))
+			name = "{} - {} [{}, {}]".format(sname, name, "MangaDex", self.get_text(group, strip=True))
 
 			item["origin_name"] = name
-			item["source_id"]  = urllib.parse.urljoin(self.urlBase, chapter_name.a['href'])
-			dateStr = ultime['title'].strip()
+			item["source_id"]  = urllib.parse.urljoin(self.urlBase, self.xpath_first(chapter_name, ".//a/@href"))
+			dateStr = ultime.get('title').strip()
 			itemDate, status = parsedatetime.Calendar().parse(dateStr)
 			if status < 1:
 				continue
 
 			item['posted_at'] = datetime.datetime(*itemDate[:6])
+
+			# Chapters are listed newest first, so everything from here down is already known.
+			if self.past_watermark(item, watermark):
+				self.log.info("Reached already known chapter '%s'. Stopping.", item["origin_name"])
+				break
+
 			items.append(item)
 
 
 		return items
 
 	def getChapterLinkFromSeriesPage(self, seriesUrl):
+		page = self.wg.getpage(seriesUrl)
+		return self.getChapterLinkFromSeriesTree(self.strainSeriesPage(page))
+
+	def getChapterLinkFromSeriesTree(self, tree, watermark=None):
 		ret = []
-		soup = self.wg.getSoup(seriesUrl)
 
-		seriesInfo = self.getSeriesInfoFromSoup(soup)
+		seriesInfo = self.getSeriesInfoFromTree(tree)
 
-		chapters = self.getChaptersFromSeriesPage(soup)
+		chapters = self.getChaptersFromSeriesPage(tree, watermark)
 		for chapter in chapters:
 
 			for key, val in seriesInfo.items(): # Copy series info into each chapter
@@ -143,19 +153,37 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 
 		return ret
 
-	def get_feed(self):
-		toScan = self.getUpdatedSeriesPages()
+	def process_series_page(self, url):
+		# Series pages that haven't changed since the last run are skipped outright.
+		with self.changed_page_context(url, parser=self.strainSeriesPage) as tree:
+			if tree is None:
+				return 0
 
-
-		for url in toScan:
 			ret = []
-			items = self.getChapterLinkFromSeriesPage(url)
+			items = self.getChapterLinkFromSeriesTree(tree, self.get_watermark(url))
 			for item in items:
 				if item in ret:
 					raise ValueError("Duplicate items in ret?")
 				ret.append(item)
 
 			self._process_links_into_db(ret)
+			self.set_watermark(url, ret)
+			return len(ret)
+
+	def get_feed(self):
+		# The listing itself isn't skipped when it's unchanged, since it's the only
+		# source of series URLs, and a series can get a new chapter without moving
+		# on it. Each series page gets its own changed-page check instead.
+		toScan = self.getUpdatedSeriesPages(self.strainListingPage(self._get_text_page(self.seriesBase)))
+
+		for url in toScan:
+			# A failed series page doesn't have its validators saved, so it's retried next run.
+			try:
+				self.process_series_page(url)
+			except Exception:
+				self.log.error("Failed to process series page %s", url)
+				for line in traceback.format_exc().split("\n"):
+					self.log.error(line)
 
 		return []
 
@@ -165,31 +193,25 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 		have_spages = True
 
 		while have_spages:
-			soup = self.wg.getSoup("https://mangadex.com/titles/{idx}".format(idx=idx))
+			main_div = self.get_strained("https://mangadex.com/titles/{idx}".format(idx=idx), "div", where=r'class=["\'][^"\']*\brow\b', first=True)
 			idx += 100
-			main_div = soup.find("div", class_='row')
 			tmp_list = []
-			if main_div:
-				divs = main_div.find_all("div", class_='col-sm-6')
-				self.log.info("Found %s series links")
+			if main_div is not None:
+				divs = self.css(main_div, "div.col-sm-6")
+				self.log.info("Found %s series links", len(divs))
 				for row in divs:
-					if row.a:
-						surl = urllib.parse.urljoin(self.urlBase, row.a['href'])
+					href = self.xpath_first(row, ".//a/@href")
+					if href:
+						surl = urllib.parse.urljoin(self.urlBase, href)
 						tmp_list.append(surl)
 
-						ret = []
-						items = self.getChapterLinkFromSeriesPage(surl)
-						for item in items:
-							if item in ret:
-								raise ValueError("Duplicate items in ret?")
-							ret.append(item)
-							found += 1
-						self._process_links_into_db(ret)
+						found += self.process_series_page(surl)
 						self.log.info("Found %s items so far", found)
 
 
 			have_spages = len(tmp_list)
 
+		self._report_page_cache()
 
 
 
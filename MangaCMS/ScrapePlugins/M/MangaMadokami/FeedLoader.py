@@ -1,8 +1,15 @@
 
+import gzip
+import zlib
+import array
+import socket
+import ijson
 import WebRequest
+import http.client
 import html.parser
 import urllib.parse
 import urllib.error
+import urllib.request
 import time
 import settings
 import re
@@ -70,47 +77,84 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 		super().__init__(*args, **kwargs)
 		self.wg = WebRequest.WebGetRobust(creds=HTTPS_CREDS)
 
+		# Keys of every file in the last tree get_feed() fetched completely.
+		self.tree_snapshot = None
+
 
 	def checkLogin(self):
 		pass
 
 
 
-	def process_tree_elements(self, elements, cum_path="/mango"):
-		ret = []
-
-		for element in elements:
-			if element['type'] == "report":
-				continue
-			elif element['type'] == 'directory':
-				item_path = os.path.join(cum_path, element['name'])
-				ret.extend(self.process_tree_elements(element['contents'], item_path))
-			elif element['type'] == 'file':
-				item_path = os.path.join(cum_path, element['name'])
-
-				assert item_path.startswith(STRIP_PREFIX)
-
-				if any([item_path.startswith(prefix) for prefix in MASK_PATHS]):
+	def _place_tree_paths(self, stack, rel_paths):
+		# Directories whose name hasn't been seen yet (the JSON doesn't promise
+		# any key order) hold on to their children's paths until it shows up.
+		maps = [frame for frame in stack if frame is not None]
+		unnamed = [idx for idx, frame in enumerate(maps) if frame['name'] is None]
+		if unnamed:
+			idx = unnamed[-1]
+			prefix = tuple(frame['name'] for frame in maps[idx+1:])
+			maps[idx]['pending'].extend(prefix + rel for rel in rel_paths)
+			return
+
+		base = [frame['name'] for frame in maps]
+		for rel in rel_paths:
+			yield "/" + "/".join(base + list(rel))
+
+	def iter_tree_files(self, fp):
+		'''
+		Stream-parse the `lessdumbtree` JSON from `fp`, yielding the full path
+		of each file in it ("/mango/Manga/..."). The tree itself is never built,
+		only the chain of directories leading to the current element.
+		'''
+
+		# One entry per open JSON container. Objects (tree elements) are dicts,
+		# arrays are None.
+		stack = []
+		for dummy_prefix, event, value in ijson.parse(fp):
+			if event == 'start_map':
+				stack.append({'name' : None, 'type' : None, 'key' : None, 'pending' : []})
+			elif event == 'map_key':
+				stack[-1]['key'] = value
+			elif event == 'start_array':
+				stack.append(None)
+			elif event == 'end_array':
+				stack.pop()
+			elif event == 'end_map':
+				element = stack.pop()
+				if not stack:
+					assert element['name'] == 'mango'
+					assert element['type'] == 'directory'
+				if element['type'] == "report":
 					continue
-
-				# Parse out the series name if we're in a directory we understand,
-				# otherwise just assume the dir name is the series.
-				match = re.search(r'/Manga/[^/]/[^/]{2}/[^/]{4}/([^/]+)/', item_path)
-				if match:
-					sname = match.group(1)
+				elif element['type'] == 'directory':
+					rel_paths = [(element['name'], ) + rel for rel in element['pending']]
+				elif element['type'] == 'file':
+					rel_paths = [(element['name'], )]
 				else:
-					sname = os.path.split(cum_path)[-1]
+					self.log.error("Unknown element type: '%s'", element)
+					continue
+				yield from self._place_tree_paths(stack, rel_paths)
+			elif stack and stack[-1] is not None and stack[-1]['key'] in ('name', 'type'):
+				stack[-1][stack[-1]['key']] = value
 
-				item = {
-					'source_id'   : urllib.parse.urljoin(self.url_base, item_path),
-					'origin_name' : element['name'],
-					'series_name' : nt.getCanonicalMangaUpdatesName(sname),
-				}
-				ret.append(item)
-			else:
-				self.log.error("Unknown element type: '%s'", element)
+	def tree_file_to_item(self, item_path):
+		cum_path = os.path.dirname(item_path)
 
-		return ret
+		# Parse out the series name if we're in a directory we understand,
+		# otherwise just assume the dir name is the series.
+		match = re.search(r'/Manga/[^/]/[^/]{2}/[^/]{4}/([^/]+)/', item_path)
+		if match:
+			sname = match.group(1)
+		else:
+			sname = os.path.split(cum_path)[-1]
+
+		item = {
+			'source_id'   : urllib.parse.urljoin(self.url_base, item_path),
+			'origin_name' : os.path.basename(item_path),
+			'series_name' : nt.getCanonicalMangaUpdatesName(sname),
+		}
+		return item
 
 
 
@@ -231,6 +275,12 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 
 		# return newItems
 
+	def do_fetch_feeds(self, *args, **kwargs):
+		super().do_fetch_feeds(*args, **kwargs)
+
+		# The new files are all in the DB at this point, so it's safe to record the tree.
+		self.save_feed_snapshot(self.tree_snapshot)
+
 	def setup(self):
 
 		# Muck about in the webget internal settings
@@ -238,12 +288,58 @@ class FeedLoader(MangaCMS.ScrapePlugins.LoaderBase.LoaderBase):
 		self.wg.retryDelay    = 5
 
 
+	def open_tree(self):
+		'''
+		Open the tree API response as a file-like stream (un-gzipped, if needed),
+		so it can be parsed as it arrives rather then read into memory first.
+		'''
+		# Straight through the WebGetRobust opener (for the credentials and browser
+		# headers), since getpage() would read the whole (very large) response.
+		request = urllib.request.Request(self.tree_api, headers={'Accept-Encoding' : 'gzip'})
+		handle = self.wg.opener.open(request, timeout=self.wg.timeout)
+
+		coding = handle.headers.get("Content-Encoding", "identity").lower()
+		if coding == "gzip":
+			return gzip.GzipFile(fileobj=handle)
+		if coding != "identity":
+			handle.close()
+			raise ValueError("Unexpected content encoding for tree: '%s'" % coding)
+		return handle
+
 	def get_feed(self):
-		treedata = self.wg.getJson(self.tree_api)
-		assert 'contents' in treedata
-		assert treedata['name'] == 'mango'
-		assert treedata['type'] == 'directory'
-		data_unfiltered = self.process_tree_elements(treedata['contents'])
+
+		# Only files that weren't in the tree last time need to be canonized and inserted.
+		previous = self.load_feed_snapshot()
+
+		for attempt in range(1, self.wg.errorOutCount + 1):
+			snapshot = array.array('Q')
+			data_unfiltered = []
+			try:
+				with self.open_tree() as fp:
+					for item_path in self.iter_tree_files(fp):
+						assert item_path.startswith(STRIP_PREFIX)
+
+						if any([item_path.startswith(prefix) for prefix in MASK_PATHS]):
+							continue
+
+						key = self.snapshot_key(item_path)
+						snapshot.append(key)
+						if previous is not None and self.in_snapshot(previous, key):
+							continue
+
+						data_unfiltered.append(self.tree_file_to_item(item_path))
+				break
+
+			# The tree is parsed as it arrives, so a dropped connection (or the
+			# truncated JSON it leaves) means starting over.
+			except (IOError, EOFError, zlib.error, socket.timeout, http.client.HTTPException, ijson.common.JSONError) as e:
+				if attempt == self.wg.errorOutCount:
+					raise
+				self.log.warning("Failure fetching tree (%s). Retrying (attempt %s).", e, attempt)
+				time.sleep(self.wg.retryDelay)
+
+		self.tree_snapshot = snapshot
+		self.log.info("Tree has %s files, %s of which are new since the last run", len(snapshot), len(data_unfiltered))
 		return data_unfiltered
 
 		data = []
@@ -4,16 +4,11 @@ import MangaCMS.lib.logSetup
 import runStatus
 
 import bs4
-import nameTools as nt
-import os
-import os.path
 import MangaCMS.cleaner.processDownload
 import MangaCMS.ScrapePlugins.RetreivalBase
-import settings
 import traceback
 import urllib.parse
 
-import zipfile
 
 class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 
@@ -98,14 +93,8 @@ class ContentLoader(MangaCMS.ScrapePlugins.RetreivalBase.RetreivalBase):
 					row.err_str = "error-404"
 					return
 
-			images = []
-
-			for image_counter, imgUrl, referrerUrl in imageUrls:
-				imageContent, imageName = self.wg.getFileAndName(imgUrl, addlHeaders={'Referer': referrerUrl})
-				img_postf = urllib.parse.urlsplit(imgUrl).path.split("/")[-1]
-				imageName = "{:04d} - {} {}".format(image_counter, imageName, img_postf)
-				self.log.info("Found %s byte image named %s", len(imageContent), imageName)
-				images.append([imageName, imageContent])
+			imageUrls = [(imgUrl, referrerUrl) for dummy_counter, imgUrl, referrerUrl in sorted(imageUrls)]
+			images = self.fetch_image_set(imageUrls)
 
 			self.save_manga_image_set(link_row_id, series_name, chapter_name, images)
 
@@ -11,20 +11,30 @@ import abc
 import threading
 import settings
 import os
+import datetime
 import traceback
 import contextlib
 
 
 from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import select
 
 import nameTools as nt
 import MangaCMS.db as mdb
 import MangaCMS.lib.LogMixin
 import MangaCMS.lib.MonitorMixin
+import MangaCMS.lib.ParseMixin
+import MangaCMS.lib.processOwner as processOwner
+import MangaCMS.lib.rateLimit
 import MangaCMS.ScrapePlugins.ScrapeExceptions
 
 class MangaScraperDbMixin(MangaCMS.lib.LogMixin.LoggerMixin):
 
+	# How long a row claimed by claim_new_rows() belongs to the worker that claimed it.
+	# _resetStuckItems() leaves claims younger then this alone, unless their owner is
+	# a dead process on this machine.
+	claim_lease = datetime.timedelta(hours=6)
 
 	@abc.abstractmethod
 	def plugin_name(self):
@@ -47,10 +57,12 @@ class MangaScraperDbMixin(MangaCMS.lib.LogMixin.LoggerMixin):
 			self.shouldCanonize = True
 			self.target_table = self.db.MangaReleases
 			self.target_tags_table = self.db.MangaTags
+			self.target_tags_link_table = self.db.manga_releases_tags_link
 		else:
 			self.shouldCanonize = False
 			self.target_table = self.db.HentaiReleases
 			self.target_tags_table = self.db.HentaiTags
+			self.target_tags_link_table = self.db.hentai_releases_tags_link
 
 
 	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -68,23 +80,45 @@ class MangaScraperDbMixin(MangaCMS.lib.LogMixin.LoggerMixin):
 
 		assert url or dbid
 
-		with self.db.session_context(commit=commit) as sess:
-			row_q = sess.query(self.target_table)
+		if url and dbid:
+			raise RuntimeError("Multiple filter parameters (dbid, url) passed to row context manager!")
+
+		unit_of_work = self.db.in_unit_of_work()
 
-			if limit_by_plugin:
-				row_q = row_q.filter(self.target_table.source_site == self.plugin_key)
+		with self.db.session_context(commit=commit) as sess:
 
+			if unit_of_work and dbid:
+				# The row is very probably already in the unit of work's
+				# identity map, in which case this doesn't touch the DB.
+				row = sess.query(self.target_table).get(dbid)
+				if row is not None and limit_by_plugin and row.source_site != self.plugin_key:
+					row = None
 
-			if url and dbid:
-				raise RuntimeError("Multiple filter parameters (dbid, url) passed to row context manager!")
-			elif url:
-				row_q = row_q.filter(self.target_table.source_id == url)
-			elif dbid:
-				row_q = row_q.filter(self.target_table.id == dbid)
 			else:
-				raise RuntimeError("How did this get executed?")
+				row_q = sess.query(self.target_table)
 
-			yield (row_q.scalar(), sess)
+				if limit_by_plugin:
+					row_q = row_q.filter(self.target_table.source_site == self.plugin_key)
+
+				if url:
+					row_q = row_q.filter(self.target_table.source_id == url)
+				elif dbid:
+					row_q = row_q.filter(self.target_table.id == dbid)
+				else:
+					raise RuntimeError("How did this get executed?")
+
+				row = row_q.scalar()
+
+			yield (row, sess)
+
+	@contextlib.contextmanager
+	def item_context(self):
+		'''
+		Treat all the DB work done (on this thread) inside the block as one unit of
+		work on a single session. See MangaCMS.db.unit_of_work_context().
+		'''
+		with self.db.unit_of_work_context() as sess:
+			yield sess
 
 	@contextlib.contextmanager
 	def file_row_context(self, *args, **kwargs):
@@ -103,18 +137,107 @@ class MangaScraperDbMixin(MangaCMS.lib.LogMixin.LoggerMixin):
 
 
 
+	def claim_new_rows(self, count=None, extra_filter=None):
+		'''
+		Atomically move up to `count` of this plugin's rows from `new` to `fetching`,
+		newest first, and return a list of their (id, posted_at) tuples, newest first.
+		The claimed rows are stamped with our process_owner() and the time of the claim,
+		so _resetStuckItems() can tell live claims from abandoned ones.
+
+		Rows are picked with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of
+		processes (or machines) can claim from the same source concurrently
+		without ever being handed the same row.
+
+		`extra_filter` is an optional SQL clause to further restrict the claimed rows.
+		'''
+		table = self.target_table.__table__
+
+		candidates = select([table.c.id])                  \
+			.where(table.c.source_site == self.plugin_key) \
+			.where(table.c.state == 'new')
+		if extra_filter is not None:
+			candidates = candidates.where(extra_filter)
+		candidates = candidates.order_by(table.c.posted_at.desc())
+		if count:
+			candidates = candidates.limit(count)
+		candidates = candidates.with_for_update(skip_locked=True)
+
+		claim = table.update()                   \
+			.where(table.c.id.in_(candidates))   \
+			.where(table.c.state == 'new')       \
+			.values(
+					state      = 'fetching',
+					claimed_by = processOwner.process_owner(),
+					claimed_at = datetime.datetime.now(),
+				)                                \
+			.returning(table.c.id, table.c.posted_at)
+
+		with self.db.session_context() as sess:
+			# This has to run under READ COMMITTED. At REPEATABLE READ, hitting a
+			# row another worker claimed after our snapshot was taken is a
+			# serialization failure, rather then just a skipped row.
+			sess.connection(execution_options={'isolation_level' : 'READ COMMITTED'})
+			claimed = list(sess.execute(claim))
+
+		claimed.sort(key=lambda k: k[1], reverse=True)
+		self.log.info("Claimed %s rows for fetching", len(claimed))
+		return claimed
+
+	def release_claimed_rows(self, row_ids):
+		'''
+		Hand rows claimed with claim_new_rows() (and not yet worked on) back to the `new` state.
+		'''
+		if not row_ids:
+			return
+
+		with self.db.session_context() as sess:
+			res = sess.query(self.target_table)                                      \
+				.filter(self.target_table.id.in_(list(row_ids)))                     \
+				.filter(self.target_table.state == 'fetching')                       \
+				.filter(self.target_table.claimed_by == processOwner.process_owner()) \
+				.update({"state" : 'new', "claimed_by" : None, "claimed_at" : None}, synchronize_session=False)
+			self.log.info("Released %s claimed rows", res)
+
 	def _resetStuckItems(self):
+		'''
+		Put this plugin's rows left in `fetching` or `processing` (and `missing` rows) back
+		to `new`.
+
+		Other workers may be fetching rows for the same plugin right now, so only claims
+		that can't still be live are reset: ones older then `claim_lease`, ones made by
+		a process on this machine that has since exited, and rows that were moved to
+		`fetching` without being claimed through claim_new_rows().
+		'''
 		self.log.info("Resetting stuck downloads in DB")
 
+		in_progress = or_(
+				self.target_table.state == 'fetching',
+				self.target_table.state == 'processing',
+			)
+
 		with self.db.session_context() as sess:
+			owners = sess.query(self.target_table.claimed_by)                 \
+				.filter(self.target_table.source_site == self.plugin_key)   \
+				.filter(in_progress)                                          \
+				.filter(self.target_table.claimed_by != None)                 \
+				.distinct()                                                   \
+				.all()
+			dead_owners = [owner for owner, in owners if processOwner.owner_is_dead(owner)]
+
+			expired = or_(
+					self.target_table.claimed_at == None,
+					self.target_table.claimed_at < datetime.datetime.now() - self.claim_lease,
+				)
+			if dead_owners:
+				expired = or_(expired, self.target_table.claimed_by.in_(dead_owners))
+
 			res = sess.query(self.target_table)                         \
 				.filter(self.target_table.source_site == self.plugin_key) \
 				.filter(or_(
-					self.target_table.state == 'fetching',
-					self.target_table.state == 'processing',
+					and_(in_progress, expired),
 					self.target_table.state == 'missing',
 					))                                                  \
-				.update({"state" : 'new'})
+				.update({"state" : 'new', "claimed_by" : None, "claimed_at" : None}, synchronize_session=False)
 			self.log.info("Reset updated %s rows!", res)
 
 		self.log.info("Download reset complete")
@@ -125,7 +248,24 @@ class MangaScraperDbMixin(MangaCMS.lib.LogMixin.LoggerMixin):
 
 
 
-class MangaScraperBase(MangaScraperDbMixin, MangaCMS.lib.LogMixin.LoggerMixin, MangaCMS.lib.MonitorMixin.MonitorMixin):
+class MangaScraperBase(MangaScraperDbMixin, MangaCMS.lib.LogMixin.LoggerMixin, MangaCMS.lib.MonitorMixin.MonitorMixin, MangaCMS.lib.ParseMixin.ParseMixin):
+
+	def rate_limit(self, url):
+		'''
+		Block until the shared per-host limiter (settings.hostRateLimits) allows
+		a request to `url`. Returns False if the wait was cut short by the exit flag.
+		'''
+		return MangaCMS.lib.rateLimit.acquire(url)
+
+	def reserve_rate_limit(self, urls):
+		'''
+		Batch version of rate_limit(). Reserves a token for each of `urls` up
+		front, and returns a deadline per url for wait_rate_limit().
+		'''
+		return MangaCMS.lib.rateLimit.reserve(urls)
+
+	def wait_rate_limit(self, url, deadline):
+		return MangaCMS.lib.rateLimit.wait_until(url, deadline)
 
 	def update_tags(self, tags, row=None, dbid=None, url=None):
 		assert isinstance(tags, (list, tuple)), "Tags must be a list or tuple"
@@ -1,12 +1,21 @@
 
 import time
 import abc
+import errno
+import socket
 import zipfile
 import traceback
 import os
 import os.path
 import hashlib
 import mimetypes
+import threading
+import collections
+import http.client
+import urllib.parse
+import urllib.error
+import urllib.request
+import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
 import magic
 
@@ -17,18 +26,111 @@ import datetime
 import runStatus
 import nameTools as nt
 
+import MangaCMS.lib.staging as staging
+import MangaCMS.lib.fileIdentity as fileIdentity
+import MangaCMS.cleaner.archCleaner
 import MangaCMS.cleaner.processDownload
 import MangaCMS.ScrapePlugins.MangaScraperBase
 import MangaCMS.ScrapePlugins.ScrapeExceptions as ScrapeExceptions
 
+# Read size for hashing and comparing files on disk.
+FILE_CHUNK_SIZE = 1024 * 1024
+
 def hash_file(filepath):
 
 	with open(filepath, "rb") as f:
 		hash_md5 = hashlib.md5()
-		hash_md5.update(f.read())
+		for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+			hash_md5.update(chunk)
 		fhash = hash_md5.hexdigest()
 	return fhash
 
+# A download written to disk by RetreivalBase.download_to_staging(), along
+# with everything that was worked out about it while it streamed in.
+StagedDownload = collections.namedtuple("StagedDownload", ["path", "fhash", "size", "name", "mime"])
+
+class SavedArchive(str):
+	'''
+	Path of a file saved by RetreivalBase.save_archive() (or save_image_set()),
+	which plugins pass straight on to processDownload() as `archivePath`. It
+	carries what processDownload() should know about the file along with it:
+
+	`identity`           - the FileIdentity worked out while the file was written, if any.
+	`clean_tags`         - the ArchCleaner's tags, if the file was cleaned while it was still
+	                       in the staging directory (None otherwise).
+	`prewrite_duplicate` - the download matched an existing file by hash before anything was
+	                       written, so it's already been through the cleaner and deduper.
+
+	Anything derived from the path (joins, slices, etc) is a plain str again,
+	and just gets processed from scratch.
+	'''
+	def __new__(cls, path, identity=None, clean_tags=None, prewrite_duplicate=False):
+		self = super().__new__(cls, path)
+		self.identity           = identity
+		self.clean_tags         = clean_tags
+		self.prewrite_duplicate = prewrite_duplicate
+		return self
+
+def files_identical(path_1, path_2):
+	'''
+	Byte-for-byte comparison of two files, done in chunks so neither
+	file is ever fully loaded. Bails out on a size mismatch, or at
+	the first differing chunk.
+	'''
+	if os.path.getsize(path_1) != os.path.getsize(path_2):
+		return False
+
+	with open(path_1, "rb") as fp1, open(path_2, "rb") as fp2:
+		while True:
+			chunk_1 = fp1.read(FILE_CHUNK_SIZE)
+			chunk_2 = fp2.read(FILE_CHUNK_SIZE)
+			if chunk_1 != chunk_2:
+				return False
+			if not chunk_1:
+				return True
+
+def file_matches_content(path, content):
+	'''
+	files_identical(), for comparing a file on disk against an in-memory
+	bytes object.
+	'''
+	if os.path.getsize(path) != len(content):
+		return False
+
+	content = memoryview(content)
+	with open(path, "rb") as fp:
+		for offset in range(0, len(content), FILE_CHUNK_SIZE):
+			if fp.read(FILE_CHUNK_SIZE) != content[offset:offset+FILE_CHUNK_SIZE]:
+				return False
+	return True
+
+class HashingWriter(object):
+	'''
+	Write-only file wrapper that md5s everything passing through it.
+
+	It deliberately has no seek(), so zipfile treats it as a stream and
+	appends data descriptors rather than seeking back to patch local headers.
+	That keeps the digest equal to the md5 of the finished file.
+	'''
+	def __init__(self, fp):
+		self.fp       = fp
+		self.hash_md5 = hashlib.md5()
+		self.position = 0
+
+	def write(self, data):
+		self.hash_md5.update(data)
+		self.position += len(data)
+		return self.fp.write(data)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		self.fp.flush()
+
+	def hexdigest(self):
+		return self.hash_md5.hexdigest()
+
 def clean_filename(in_filename):
 	in_filename = in_filename.replace('.zip .zip', '.zip')
 	in_filename = in_filename.replace('.zip.zip', '.zip')
@@ -100,11 +202,19 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 	itemLimit = 250
 	retreival_threads = 1
 
+	# Worker count for fetch_image_set(), and the cap on how many of those
+	# workers may be talking to any single host at one time.
+	image_fetch_threads  = 6
+	image_fetch_per_host = 3
+
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.wg = WebRequest.WebGetRobust(logPath=self.logger_path+".Web")
 		self.die = False
 
+		self._host_semaphores      = {}
+		self._host_semaphores_lock = threading.Lock()
+
 	@abc.abstractmethod
 	def get_link(self, link_row_id):
 		pass
@@ -113,6 +223,14 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 	def checkDelay(self, _):
 		return True
 
+	# SQL version of checkDelay(). If a plugin needs a delay, it should preferentially
+	# return a filter clause against self.target_table here (e.g.
+	# `self.target_table.posted_at < datetime.datetime.now() - delay`), so the
+	# filtering and the item limit can both be done by the database.
+	# Returning None means no filtering.
+	def checkDelayFilter(self):
+		return None
+
 	# And for logging in (if needed)
 	def setup(self):
 		pass
@@ -121,6 +239,16 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		assert "plugin_name" not in kwargs, "You can't pass a plugin name to RetreivalBase.processDownload() (%s)" % kwargs
 		assert        "pron" not in kwargs, "You can't pass a pron to RetreivalBase.processDownload() (%s)" % kwargs
 
+		archivePath = kwargs.get("archivePath")
+		if isinstance(archivePath, SavedArchive):
+			if archivePath.prewrite_duplicate:
+				self.log.info("Archive '%s' is an existing file matched before writing. Not reprocessing.", archivePath)
+				return "binary-duplicate"
+
+			kwargs["archivePath"]      = str(archivePath)
+			kwargs["archiveIdentity"]  = archivePath.identity
+			kwargs["archiveCleanTags"] = archivePath.clean_tags
+
 		kwargs["plugin_name"] = self.plugin_key
 		kwargs[       "pron"] = not self.is_manga
 
@@ -130,39 +258,115 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		return MangaCMS.cleaner.processDownload.processDownload(**kwargs)
 
 	def _retreiveTodoLinksFromDB(self):
+		'''
+		Claim (see claim_new_rows()) up to `itemLimit` new items for this plugin,
+		and return their IDs, newest first. The claimed rows are moved to the
+		`fetching` state, so other retriever processes won't also pick them up.
+		'''
 
 		# self.QUERY_DEBUG = True
 
 		self.log.info( "Fetching items from db...",)
 
-		with self.db.session_context() as sess:
+		# checkDelay() can't be run by the database, so if a plugin overrides it
+		# the candidates have to be filtered here before they're claimed.
+		python_delay = type(self).checkDelay is not RetreivalBase.checkDelay
 
-			res = sess.query(self.target_table)                            \
-				.filter(self.target_table.source_site == self.plugin_key)  \
-				.filter(self.target_table.state == 'new')                  \
-				.order_by(self.target_table.posted_at.desc())              \
-				.all()
+		delay_filter = self.checkDelayFilter()
 
-			res = [(tmp.id, tmp.posted_at) for tmp in res]
+		if python_delay:
+			with self.db.session_context() as sess:
 
-		self.log.info( "Done")
+				# This should be served by the partial `*_releases_todo_idx` index.
+				query = sess.query(self.target_table.id, self.target_table.posted_at) \
+					.filter(self.target_table.source_site == self.plugin_key)      \
+					.filter(self.target_table.state == 'new')
 
-		items = []
-		for item_row_id, posted_at in res:
-			if self.checkDelay(posted_at):
-				items.append((item_row_id, posted_at))
+				if delay_filter is not None:
+					query = query.filter(delay_filter)
 
-		self.log.info( "Have %s new items to retreive in %s Downloader", len(items), self.plugin_key.title())
+				query = query.order_by(self.target_table.posted_at.desc())
 
+				candidates = []
+				for item_row_id, posted_at in query.yield_per(1000):
+					if self.checkDelay(posted_at):
+						candidates.append(item_row_id)
+						if self.itemLimit and len(candidates) >= self.itemLimit:
+							break
 
-		items = sorted(items, key=lambda k: k[1], reverse=True)
-		if self.itemLimit:
-			items = items[:self.itemLimit]
+			items = self.claim_new_rows(len(candidates), self.target_table.id.in_(candidates)) if candidates else []
+		else:
+			items = self.claim_new_rows(self.itemLimit, delay_filter)
+
+		items = [item_row_id for item_row_id, _ in items]
 
-		items = [tmp[0] for tmp in items]
+		self.log.info( "Have %s new items to retreive in %s Downloader (limit: %s)", len(items), self.plugin_key.title(), self.itemLimit)
 
 		return items
 
+	def _get_host_semaphore(self, url):
+		netloc = urllib.parse.urlsplit(url).netloc.lower()
+		with self._host_semaphores_lock:
+			if netloc not in self._host_semaphores:
+				self._host_semaphores[netloc] = threading.BoundedSemaphore(self.image_fetch_per_host)
+			return self._host_semaphores[netloc]
+
+	def _fetch_set_image(self, image_idx, image_url, referrer, not_before):
+		if not runStatus.run:
+			raise RuntimeError("Exit flag set while fetching image set!")
+		if not self.wait_rate_limit(image_url, not_before):
+			raise RuntimeError("Exit flag set while fetching image set!")
+
+		with self._get_host_semaphore(image_url):
+			content, name = self.wg.getFileAndName(image_url, addlHeaders={'Referer': referrer})
+
+		img_postf = urllib.parse.urlsplit(image_url).path.split("/")[-1]
+		name = "{:04d} - {} {}".format(image_idx, name, img_postf)
+		self.log.info("Found %s byte image named %s", len(content), name)
+		return [name, content]
+
+	def iter_image_set(self, image_urls):
+		'''
+		Generator version of fetch_image_set().
+
+		Images are yielded in page order as soon as they (and every page before
+		them) have arrived. No more than `image_fetch_threads` images are
+		held or in flight at once, so this can be fed straight into
+		save_image_set() without ever materializing the whole set.
+		'''
+		if not image_urls:
+			return
+
+		# The rate limit tokens for the whole set are taken in one go.
+		not_before = self.reserve_rate_limit([image_url for image_url, _ in image_urls])
+
+		workers = min(self.image_fetch_threads, len(image_urls))
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			pending = collections.deque()
+			try:
+				for idx, ((image_url, referrer), deadline) in enumerate(zip(image_urls, not_before), 1):
+					pending.append(executor.submit(self._fetch_set_image, idx, image_url, referrer, deadline))
+					if len(pending) >= workers:
+						yield pending.popleft().result()
+
+				while pending:
+					yield pending.popleft().result()
+			finally:
+				for job in pending:
+					job.cancel()
+
+	def fetch_image_set(self, image_urls):
+		'''
+		Fetch a list of (image_url, referrer) 2-tuples concurrently.
+
+		At most `image_fetch_per_host` requests are in flight to any one host.
+		Return is a list of [image_name, image_content] in the same order as
+		`image_urls`, suitable for passing to save_image_set() or
+		save_manga_image_set(). Image names are prefixed with their (1-based)
+		position in the input list.
+		'''
+		return list(self.iter_image_set(image_urls))
+
 	def sync_file_tags(self, link_row_id):
 		self.log.info("Synchronizing tags with file row")
 		with self.row_context(dbid=link_row_id) as row:
@@ -193,42 +397,55 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 				return
 			if self.die:
 				self.log.warning("Skipping job due to die flag!")
+				self.release_claimed_rows([link_row_id])
 				return
 			if not runStatus.run:
 				self.log.info( "Breaking due to exit flag being set")
+				self.release_claimed_rows([link_row_id])
 				return
 
-			with self.row_context(dbid=link_row_id) as row:
-				if row.state != 'new':
-					self.log.warning("Muliple fetch attemps for the same entry (%s) in plugin %s!", link_row_id, self.plugin_name)
-					return
+			# One request token per item from the plugin's site. This is taken before the
+			# item's session is opened, so a long wait doesn't sit on an open transaction.
+			if not self.rate_limit(self.urlBase):
+				self.release_claimed_rows([link_row_id])
+				return
+
+			# Everything for one item runs on a single session, so the row is loaded
+			# once. Each row_context() block is committed as it exits, so nothing is
+			# held open while get_link() is downloading (see MangaCMS.db.unit_of_work_context()).
+			with self.item_context():
+				# Rows are claimed (moved to 'fetching') by _retreiveTodoLinksFromDB()
+				with self.row_context(dbid=link_row_id) as row:
+					if row.state != 'fetching':
+						self.log.warning("Muliple fetch attemps for the same entry (%s) in plugin %s!", link_row_id, self.plugin_name)
+						return
 
-			status = self.get_link(link_row_id=link_row_id)
+				status = self.get_link(link_row_id=link_row_id)
 
-			self.sync_file_tags(link_row_id=link_row_id)
+				self.sync_file_tags(link_row_id=link_row_id)
 
-			ret1 = None
-			if status == 'phash-duplicate':
-				ret1 = self.mon_con.incr('phash_dup_items', 1)
-			elif status == 'binary-duplicate':
-				ret1 = self.mon_con.incr('bin_dup_items', 1)
+				ret1 = None
+				if status == 'phash-duplicate':
+					ret1 = self.mon_con.incr('phash_dup_items', 1)
+				elif status == 'binary-duplicate':
+					ret1 = self.mon_con.incr('bin_dup_items', 1)
 
-			# We /always/ send the "fetched_items" count entry.
-			# However, the deduped result is only send if the item is actually deduped.
-			ret2 = self.mon_con.incr('fetched_items', 1)
-			self.log.info("Retreival complete. Sending log results:")
-			if ret1:
-				self.log.info("	-> %s", ret1)
-			self.log.info("	-> %s", ret2)
+				# We /always/ send the "fetched_items" count entry.
+				# However, the deduped result is only send if the item is actually deduped.
+				ret2 = self.mon_con.incr('fetched_items', 1)
+				self.log.info("Retreival complete. Sending log results:")
+				if ret1:
+					self.log.info("	-> %s", ret1)
+				self.log.info("	-> %s", ret2)
 
 
-			# Finishing checks
-			with self.row_context(dbid=link_row_id) as row:
-				if row and row.state == "complete":
-					assert row.first_seen    > datetime.datetime.min, "Row first_seen column never set in plugin %s!" % self.plugin_name
-					assert row.posted_at     > datetime.datetime.min, "Row posted_at column never set in plugin %s!" % self.plugin_name
-					assert row.downloaded_at > datetime.datetime.min, "Row downloaded_at column never set in plugin %s!" % self.plugin_name
-					assert row.last_checked  > datetime.datetime.min, "Row last_checked column never set in plugin %s!" % self.plugin_name
+				# Finishing checks
+				with self.row_context(dbid=link_row_id) as row:
+					if row and row.state == "complete":
+						assert row.first_seen    > datetime.datetime.min, "Row first_seen column never set in plugin %s!" % self.plugin_name
+						assert row.posted_at     > datetime.datetime.min, "Row posted_at column never set in plugin %s!" % self.plugin_name
+						assert row.downloaded_at > datetime.datetime.min, "Row downloaded_at column never set in plugin %s!" % self.plugin_name
+						assert row.last_checked  > datetime.datetime.min, "Row last_checked column never set in plugin %s!" % self.plugin_name
 
 		except SystemExit:
 			self.die = True
@@ -278,27 +495,206 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 
 
 
+	def _timed_fetch_link(self, link_row_id):
+		start = time.time()
+		try:
+			return self._fetch_link(link_row_id)
+		finally:
+			duration = time.time() - start
+			self.log.info("Item %s finished in %0.2f seconds", link_row_id, duration)
+			if self.mon_con:
+				self.mon_con.timing('item_duration', int(duration * 1000))
+
 	def processTodoLinks(self, links):
-		if links:
+		'''
+		Run _fetch_link() over `links` on `retreival_threads` workers.
 
-			with ThreadPoolExecutor(max_workers=self.retreival_threads) as executor:
+		Only a fixed window of jobs is ever queued on the executor. A new job
+		is submitted as each one finishes, so memory use doesn't grow with the
+		number of links. If the run flag is cleared, queued jobs are cancelled
+		and every link that never started is handed back to the `new` state.
+		'''
+		if not links:
+			return
 
-				futures = [executor.submit(self._fetch_link, link) for link in links]
+		window = self.retreival_threads * 2
+		pending = iter(links)
+		in_flight = {}
 
-				while futures:
-					futures = [tmp for tmp in futures if not (tmp.done() or tmp.cancelled())]
-					if not runStatus.run:
-						self.log.warning("Cancelling all pending futures")
-						for job in futures:
-							job.cancel()
-						self.log.warning("Jobs cancelled. Exiting executor context.")
+		with ThreadPoolExecutor(max_workers=self.retreival_threads) as executor:
+
+			def fill():
+				while len(in_flight) < window:
+					link = next(pending, None)
+					if link is None:
 						return
-					time.sleep(1)
+					in_flight[executor.submit(self._timed_fetch_link, link)] = link
+
+			fill()
+			while in_flight:
+				# Wake up as soon as a job completes. The timeout only bounds how
+				# long a cleared run flag can go unnoticed.
+				done, _ = concurrent.futures.wait(in_flight, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+
+				for job in done:
+					link = in_flight.pop(job)
+					if not job.cancelled() and job.exception():
+						self.log.error("Job for item %s exited with exception: %s", link, job.exception())
+
+				if not runStatus.run:
+					self.log.warning("Cancelling all pending futures")
+					cancelled = [link for job, link in in_flight.items() if job.cancel()]
+					# Neither the cancelled nor the never-submitted jobs ran, so hand their rows back.
+					self.release_claimed_rows(cancelled + list(pending))
+					self.log.warning("Jobs cancelled. Exiting executor context.")
+					return
 
+				fill()
 
 
 
 
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+	# Streaming downloads
+	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+	# How many times a dropped transfer is resumed before download_to_staging() gives up.
+	download_resume_attempts = 5
+
+	def _open_download_stream(self, url, headers):
+		# This goes through the WebGetRobust opener, so it gets the same cookies,
+		# credentials and browser headers as everything else, but bypasses
+		# getpage(), which reads the whole response into memory.
+		request = urllib.request.Request(url, headers=headers)
+		return self.wg.opener.open(request, timeout=self.wg.timeout)
+
+	def _download_name_mime(self, handle):
+		# Same rules as WebGetRobust.getFileAndName()
+		info = handle.info()
+		disposition = info.get('Content-Disposition', '')
+		fname = disposition.split('filename=')[1] if 'filename=' in disposition else ''
+		if len(fname) >= 2 and fname[0] == fname[-1] and fname[0] in ("'", '"'):
+			fname = fname[1:-1]
+		if not fname.strip():
+			fname = urllib.parse.urlsplit(handle.geturl()).path.split("/")[-1].strip()
+		if "/" in fname:
+			fname = fname.split("/")[-1]
+		return fname, info.get_content_type()
+
+	def download_to_staging(self, url, referrer=None):
+		'''
+		Stream `url` to a file in the staging directory, hashing it as it
+		arrives, and return a StagedDownload that can be handed straight to
+		save_archive(). The content is never held in memory.
+
+		If the connection drops part way through, the transfer picks up where
+		it left off with a Range request (guarded by If-Range, when the server
+		sent a validator). A server that ignores the range gets the download
+		restarted from scratch.
+
+		The URL and validator are kept in a metadata file next to the staged
+		content, so a transfer that is still incomplete when the retries run
+		out (or the process is stopped or dies) is resumed by the next call
+		for the same URL, from any process, even in a later run. The download
+		is locked while it's being worked on, so no two processes ever write
+		to it at once. Any other failure removes the staged file.
+		'''
+		staged_path, meta_path = staging.download_paths(hashlib.md5(url.encode("utf-8")).hexdigest())
+
+		# Only one process at a time can work on a given download.
+		with staging.download_lock(staged_path):
+			fhash     = hashlib.md5()
+			written   = 0
+			total     = None
+			validator = None
+			fname     = None
+			mime      = None
+			attempt   = 0
+			resumable = False
+
+			meta = staging.load_download_meta(meta_path)
+			if meta and meta.get('url') == url and os.path.exists(staged_path):
+				with open(staged_path, "rb") as fp:
+					for chunk in iter(lambda: fp.read(FILE_CHUNK_SIZE), b''):
+						fhash.update(chunk)
+						written += len(chunk)
+				validator = meta.get('validator')
+				fname     = meta.get('name')
+				mime      = meta.get('mime')
+				self.log.info("Resuming interrupted download of %s from %s bytes", url, written)
+			else:
+				# Nothing (usable) to resume from.
+				open(staged_path, "wb").close()
+				staging.discard(meta_path)
+
+			try:
+				with open(staged_path, "ab") as fp:
+					while True:
+						headers = {'Accept-Encoding' : 'identity'}
+						if referrer:
+							headers['Referer'] = referrer
+						if written:
+							headers['Range'] = 'bytes=%d-' % written
+							if validator:
+								headers['If-Range'] = validator
+
+						try:
+							with self._open_download_stream(url, headers) as handle:
+								if written and handle.getcode() != 206:
+									self.log.warning("Server did not honour range request. Restarting download of %s", url)
+									fp.seek(0)
+									fp.truncate()
+									fhash   = hashlib.md5()
+									written = 0
+
+								if fname is None:
+									fname, mime = self._download_name_mime(handle)
+								validator = handle.headers.get("ETag") or handle.headers.get("Last-Modified")
+								length = handle.headers.get("Content-Length")
+								if length:
+									total = written + int(length)
+
+								staging.save_download_meta(meta_path, {'url' : url, 'validator' : validator, 'name' : fname, 'mime' : mime})
+
+								for chunk in iter(lambda: handle.read(FILE_CHUNK_SIZE), b''):
+									fp.write(chunk)
+									fhash.update(chunk)
+									written += len(chunk)
+
+							if total is None or written >= total:
+								break
+							raise IOError("Connection closed after %s of %s bytes" % (written, total))
+
+						except urllib.error.HTTPError as e:
+							if e.code < 500:
+								raise
+							err = e
+						except (IOError, socket.timeout, http.client.HTTPException) as e:
+							err = e
+
+						attempt += 1
+						if attempt > self.download_resume_attempts or not runStatus.run:
+							resumable = True
+							raise err
+						self.log.warning("Download of %s interrupted at %s bytes (%s). Resuming (attempt %s).", url, written, err, attempt)
+						time.sleep(self.wg.retryDelay)
+
+			except BaseException:
+				# An interrupted transfer is left for the next attempt to resume.
+				if (resumable or not runStatus.run) and written:
+					self.log.warning("Keeping partial download of %s (%s bytes) for a later resume.", url, written)
+				else:
+					staging.discard(staged_path, meta_path)
+				raise
+
+			# The content file goes on to be promoted into the library, so it's done with
+			# as a resumable download, and moved out of reach of other processes.
+			staging.discard(meta_path)
+			staged_path = staging.detach_download(staged_path)
+
+			self.log.info("Downloaded %s bytes from %s to staging file %s", written, url, staged_path)
+			return StagedDownload(staged_path, fhash.hexdigest(), written, fname, mime)
+
 	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
 	# Filesystem stuff
 	# ---------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -350,7 +746,7 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 			.scalar()
 		return have_row
 
-	def get_create_file_row(self, sess, row, fqfilename):
+	def get_create_file_row(self, sess, row, fqfilename, fhash=None):
 		'''
 		Given a path to a file, return a row for that file's contents.
 		If no row exits, it is created. If a row for another file
@@ -363,10 +759,13 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 		Note that the file pointed to by the input parameter fqfilename
 		may actually be deleted, if it is found to be a binary duplicate
 		of another existing file.
+
+		If the caller already has the md5 of the file (e.g. it was computed
+		while writing it), pass it as `fhash` to skip re-reading the file.
 		'''
 
-		# Round-trip via the filesystem because why not
-		fhash = hash_file(fqfilename)
+		if fhash is None:
+			fhash = hash_file(fqfilename)
 
 		have = self._get_existing_file_by_hash(sess, fhash)
 
@@ -379,12 +778,7 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 				raise RuntimeError
 			if os.path.exists(have_fqp):
 
-				with open(have_fqp, "rb") as fp1:
-					fc1 = fp1.read()
-				with open(fqfilename, "rb") as fp2:
-					fc2 = fp2.read()
-
-				if fc1 != fc2:
+				if not files_identical(have_fqp, fqfilename):
 					self.log.error("Multiple instances of a releasefile with the same md5, but different contents?")
 					self.log.error("Files: %s, %s. Row id: %s", have_fqp, fqfilename, row.id)
 					raise RuntimeError
@@ -425,93 +819,190 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 
 			return new_row, fqfilename
 
+	def _link_prewrite_duplicate(self, sess, row, fhash, content):
+		'''
+		If a file with md5 `fhash` and the same bytes as `content` (either the
+		file contents, or a StagedDownload) is already on disk, point `row` at
+		it and return its path (flagged as a `prewrite_duplicate`). Otherwise,
+		return None.
+		'''
+		have = self._get_existing_file_by_hash(sess, fhash)
+		if not have:
+			return None
+
+		have_fqp = os.path.join(have.dirpath, have.filename)
+		if not os.path.exists(have_fqp):
+			return None
+
+		# Same check as get_create_file_row(), so a hash collision is never linked.
+		if isinstance(content, StagedDownload):
+			identical = files_identical(have_fqp, content.path)
+		else:
+			identical = file_matches_content(have_fqp, content)
+		if not identical:
+			self.log.warning("Download has the same md5 as '%s', but different contents. Not linking.", have_fqp)
+			return None
+
+		self.log.info("Download is a binary duplicate of existing file '%s'. Linking without writing.", have_fqp)
+		row.fileid = have.id
+
+		if self.mon_con:
+			self.mon_con.incr('binary-duplicate', 1)
+
+		return SavedArchive(have_fqp, prewrite_duplicate=True)
+
 	def save_archive(self, row, sess, fqfilename, file_content):
 
+		if isinstance(file_content, StagedDownload):
+			return self._save_staged_archive(row, sess, fqfilename, file_content)
+
+		# The content is already in memory, so check for a binary duplicate
+		# before touching the disk at all.
+		fhash = hashlib.md5(file_content).hexdigest()
+		have_fqp = self._link_prewrite_duplicate(sess, row, fhash, file_content)
+		if have_fqp:
+			return have_fqp
+
 		fqfilename = prep_check_fq_filename(fqfilename)
-		filepath, fileN = os.path.split(fqfilename)
 		self.log.info("Complete filepath: %s", fqfilename)
 
-		chop = len(fileN)-4
+		staged_path = staging.new_temp_path()
+		try:
+			with open(staged_path, "wb") as fp:
+				fp.write(file_content)
+			fqfilename, fhash = self._clean_and_promote(staged_path, fqfilename, fhash, magic.from_buffer(file_content, mime=True))
+		finally:
+			staging.discard(staged_path)
 
-		while 1:
-			try:
-				with open(fqfilename, "wb") as fp:
-					fp.write(file_content)
+		file_row, have_fqp = self.get_create_file_row(sess, row, fqfilename, fhash=fhash)
+		row.fileid = file_row.id
 
-				file_row, have_fqp = self.get_create_file_row(sess, row, fqfilename)
-				row.fileid = file_row.id
+		return self._saved_as(fqfilename, have_fqp)
 
-				return have_fqp
 
-			except (IOError, OSError):
-				chop = chop - 1
-				filepath, fileN = os.path.split(fqfilename)
 
-				fileN = fileN[:chop]+fileN[-4:]
-				self.log.warn("Truncating file length to %s characters and re-encoding.", chop)
-				fileN = fileN.encode('utf-8','ignore').decode('utf-8')
-				fileN = nt.makeFilenameSafe(fileN)
-				fqfilename = os.path.join(filepath, fileN)
-				fqfilename = insertCountIfFilenameExists(fqfilename)
 
+	def _save_staged_archive(self, row, sess, fqfilename, staged):
+		'''
+		save_archive() for a file download_to_staging() already put on disk.
+		The staged file is moved into place (or deleted, if it's a binary
+		duplicate), so the content never has to be read back in.
+		'''
+		have_fqp = self._link_prewrite_duplicate(sess, row, staged.fhash, staged)
+		if have_fqp:
+			os.unlink(staged.path)
+			return have_fqp
 
+		fqfilename = prep_check_fq_filename(fqfilename)
+		self.log.info("Complete filepath: %s", fqfilename)
 
+		# The server's content-type isn't trusted, so the mime type is left to be sniffed.
+		try:
+			fqfilename, fhash = self._clean_and_promote(staged.path, fqfilename, staged.fhash)
+		finally:
+			staging.discard(staged.path)
 
-	def save_image_set(self, row, sess, fqfilename, image_list):
+		file_row, have_fqp = self.get_create_file_row(sess, row, fqfilename, fhash=fhash)
+		row.fileid = file_row.id
 
-		fqfilename = prep_check_fq_filename(fqfilename)
+		return self._saved_as(fqfilename, have_fqp)
 
-		self.log.info("Saving to complete filepath: %s", fqfilename)
+	def _fix_image_name(self, imageName, imageContent):
+		assert isinstance(imageName, str)
+		assert isinstance(imageContent, bytes)
+
+		mtype = magic.from_buffer(imageContent, mime=True)
+		if imageName.lower().endswith(".png") and mtype == 'application/octet-stream':
+			# So libmagic is somehow misidentifiying pngs as being of type
+			# 'application/octet-stream'. Anyways, short circut that specific case.
+			pass
+		else:
+			assert "image" in mtype.lower(), "Image not in mimetype ('%s') of file '%s'?" % (mtype, imageName)
+
+		_, ext = os.path.splitext(imageName)
+		fext = mimetypes.guess_extension(mtype)
+		if fext == '.jpe':
+			fext = ".jpg"
+		if ext == '.jpeg':
+			ext = ".jpg"
+
+		if not ext:
+			self.log.warning("Missing extension in archive file: %s", imageName)
+			self.log.warning("Appending guessed file-extension %s", fext)
+			imageName += fext
+		elif fext != ext:
+			self.log.warning("Archive file extension %s mismatches guessed extension: %s", (imageName, ext), fext)
+			self.log.warning("Appending guessed file-extension %s", fext)
+			imageName += fext
+
+		return imageName
+
+	def _clean_and_promote(self, staged_path, fqfilename, fhash, mime=None):
+		'''
+		Run the ArchCleaner over the finished file `staged_path` while it's still
+		in the staging directory, and then move the result into the library as
+		`fqfilename` (see _promote_truncating()), so the library only sees the
+		one write.
+
+		Returns the final path (a SavedArchive, carrying the cleaner's tags and
+		the file's identity), and the md5 of the final file.
+
+		Files the cleaner doesn't handle (or fails on) are moved into place
+		as-is, and are left to processDownload() to deal with (and report).
+		'''
+		staged     = fileIdentity.FileIdentity(staged_path, md5=fhash, mime=mime)
+		clean_tags = None
+		try:
+			if staged.mime in ('application/zip', 'application/x-rar'):
+				clean_tags, staged = MangaCMS.cleaner.archCleaner.ArchCleaner().processNewArchive(staged)
+		except Exception:
+			self.log.error("Failed to clean '%s' in staging. Leaving it to processDownload().", fqfilename)
+			for line in traceback.format_exc().split("\n"):
+				self.log.error(line)
+			staged = fileIdentity.identify(staged)
+
+		try:
+			# Anything the cleaner rebuilt is now a zip (see ArchCleaner.cleanZip()).
+			if staged.path != staged_path and not fqfilename.endswith(".zip"):
+				fqfilename = insertCountIfFilenameExists(os.path.splitext(fqfilename)[0] + ".zip")
+
+			fhash = staged.md5
+			fqfilename = self._promote_truncating(staged.path, fqfilename)
+		finally:
+			staging.discard(staged.path)
 
+		identity = fileIdentity.FileIdentity(fqfilename, md5=fhash, mime=staged.mime)
+		return SavedArchive(fqfilename, identity=identity, clean_tags=clean_tags), fhash
+
+	def _saved_as(self, saved, fqfilename):
+		'''
+		`fqfilename` (the path get_create_file_row() settled on) as a SavedArchive,
+		carrying over what's known about `saved`. processDownload() ignores the
+		identity (and so the cleaner's tags) if the two are different files.
+		'''
+		return SavedArchive(fqfilename,
+				identity   = getattr(saved, "identity", None),
+				clean_tags = getattr(saved, "clean_tags", None),
+			)
+
+	def _promote_truncating(self, staged_path, fqfilename):
+		'''
+		Move the finished file `staged_path` into the library as `fqfilename`
+		(see staging.promote()), shortening the filename until the filesystem
+		accepts it. Returns the final fq filename.
+		'''
 		filepath, fileN = os.path.split(fqfilename)
-		assert len(image_list) >= 1
 		chop = len(fileN)-4
 
 		while 1:
 			try:
-				arch = zipfile.ZipFile(fqfilename, "w")
-
-				#Write all downloaded files to the archive.
-				for imageName, imageContent in image_list:
-					assert isinstance(imageName, str)
-					assert isinstance(imageContent, bytes)
-
-					mtype = magic.from_buffer(imageContent, mime=True)
-					if imageName.lower().endswith(".png") and mtype == 'application/octet-stream':
-						# So libmagic is somehow misidentifiying pngs as being of type
-						# 'application/octet-stream'. Anyways, short circut that specific case.
-						pass
-					else:
-						assert "image" in mtype.lower(), "Image not in mimetype ('%s') of file '%s'?" % (mtype, imageName)
-
-					_, ext = os.path.splitext(imageName)
-					fext = mimetypes.guess_extension(mtype)
-					if fext == '.jpe':
-						fext = ".jpg"
-					if ext == '.jpeg':
-						ext = ".jpg"
-
-					if not ext:
-						self.log.warning("Missing extension in archive file: %s", imageName)
-						self.log.warning("Appending guessed file-extension %s", fext)
-						imageName += fext
-					elif fext != ext:
-						self.log.warning("Archive file extension %s mismatches guessed extension: %s", (imageName, ext), fext)
-						self.log.warning("Appending guessed file-extension %s", fext)
-						imageName += fext
-
-
-					arch.writestr(imageName, imageContent)
-				arch.close()
-
-				file_row, have_fqp = self.get_create_file_row(sess, row, fqfilename)
-				row.fileid = file_row.id
-
-				return have_fqp
-
-			except (IOError, OSError):
-				traceback.print_exc()
+				staging.promote(staged_path, fqfilename)
+				return fqfilename
 
+			except OSError as e:
+				if e.errno not in (errno.ENAMETOOLONG, errno.EINVAL):
+					raise
+				traceback.print_exc()
 
 				chop = chop - 1
 				filepath, fileN = os.path.split(fqfilename)
@@ -523,6 +1014,69 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 				fqfilename = os.path.join(filepath, fileN)
 				fqfilename = insertCountIfFilenameExists(fqfilename)
 
+	def save_image_set(self, row, sess, fqfilename, image_list):
+		'''
+		Pack `image_list` into a zip at `fqfilename` (see write_image_set()),
+		and attach the resulting file row to `row`.
+
+		If `image_list` is a generator that fetches the images, the download
+		happens while `sess` is open. Call write_image_set() outside of the
+		session, and then attach_file_row(), to avoid that.
+		'''
+		fqfilename, fhash = self.write_image_set(fqfilename, image_list)
+		return self.attach_file_row(row, sess, fqfilename, fhash)
+
+	def write_image_set(self, fqfilename, image_list):
+		'''
+		Pack `image_list` into a zip at `fqfilename`. Returns the final
+		filename (which may have been changed to make it unique and short
+		enough) as a SavedArchive, and the md5 of the file.
+
+		`image_list` can be any iterable of (image_name, image_content) pairs,
+		including a generator (see iter_image_set()). Each image is checked and
+		written into the archive as it arrives, so only one image has to be
+		held in memory at a time. The file md5 is computed in the same pass.
+		No database access is done here.
+		'''
+
+		fqfilename = prep_check_fq_filename(fqfilename)
+
+		self.log.info("Saving to complete filepath: %s", fqfilename)
+
+		# The archive is built in the staging directory, and only moved
+		# into the library once it's complete.
+		staged_path = staging.new_temp_path()
+
+		image_count = 0
+		try:
+			with open(staged_path, "wb") as fp:
+				hashing_fp = HashingWriter(fp)
+				with zipfile.ZipFile(hashing_fp, "w") as arch:
+
+					#Write all downloaded files to the archive.
+					for imageName, imageContent in image_list:
+						imageName = self._fix_image_name(imageName, imageContent)
+						arch.writestr(imageName, imageContent)
+						image_count += 1
+
+			assert image_count >= 1, "No images in image set for file %s!" % fqfilename
+
+			return self._clean_and_promote(staged_path, fqfilename, hashing_fp.hexdigest(), 'application/zip')
+
+		finally:
+			# Don't leave a partial archive lying about.
+			staging.discard(staged_path)
+
+	def attach_file_row(self, row, sess, fqfilename, fhash):
+		'''
+		Point `row` at the file row for `fqfilename` (creating it if needed),
+		and return the path to pass to processDownload().
+		'''
+		file_row, have_fqp = self.get_create_file_row(sess, row, fqfilename, fhash=fhash)
+		row.fileid = file_row.id
+
+		return self._saved_as(fqfilename, have_fqp)
+
 
 	def save_manga_image_set(self, row_id, series_name, chapter_name, image_list):
 			dlPath, newDir = self.locateOrCreateDirectoryForSeries(series_name)
@@ -533,9 +1087,13 @@ class RetreivalBase(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase):
 
 			fqFName = os.path.join(dlPath, chapter_name+".zip")
 
+			# The images may still be downloading as they're written (if `image_list`
+			# is a generator), so the row session is only opened afterwards.
+			fqFName, fhash = self.write_image_set(fqFName, image_list)
+
 			with self.row_sess_context(dbid=row_id) as row_tup:
 				row, sess = row_tup
-				fqFName = self.save_image_set(row, sess, fqFName, image_list)
+				fqFName = self.attach_file_row(row, sess, fqFName, fhash)
 
 			self.processDownload(seriesName = series_name, archivePath = fqFName, doUpload = self.is_manga)
 
@@ -4,36 +4,63 @@
 import os
 import os.path
 
+import copy
+import zlib
+import struct
+import shutil
+import threading
+import collections
 import hashlib
+import contextlib
+import zipfile as std_zipfile
 import settings
 import logging
-import magic
 import UniversalArchiveInterface
 
 import rarfile
 import traceback
 
 try:
-	import pyximport
-	pyximport.install()
 	import czipfile.czipfile as zipfile
 
 except ImportError:
-	print("Unzipping performance can be increased MASSIVELY by")
-	print("installing cython, which will result in the use of a ")
-	print("cythonized unzipping package, rather then the (default)")
-	print("pure-python zip decyption. ")
-	print("")
-	print("The speedup achieved via cython can reach ~100x faster then ")
-	print("the pure-python implementation!")
-	traceback.print_exc()
-
-	print("Falling back to the pure-python implementation due to the lack of cython.")
+	_log = logging.getLogger("Main.ZipClean")
+	_log.warning("Unzipping performance can be increased MASSIVELY by building the czipfile extension,")
+	_log.warning("which will result in the use of a cythonized unzipping package, rather then the (default)")
+	_log.warning("pure-python zip decyption. The speedup achieved via cython can reach ~100x faster then")
+	_log.warning("the pure-python implementation!")
+	_log.warning("To build it (requires cython, a C compiler and the zlib headers, see README.md):")
+	_log.warning("	cd czipfile && python3 setup.py build_ext --inplace")
+	for line in traceback.format_exc().split("\n"):
+		_log.warning(line)
+
+	_log.warning("Falling back to the pure-python implementation due to the lack of the czipfile extension.")
 
 	import zipfile
 
 
 
+# Read size when copying compressed archive members across.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Header ID of the zip64 extended information extra field.
+ZIP64_EXTRA_ID = 0x0001
+
+def _strip_zip64_extra(extra):
+	'''
+	Remove any zip64 records from the extra field data `extra`. Their sizes and
+	offsets describe the member as it was in its old archive, so the zipfile
+	module has to be left to write fresh ones (where needed) for the new one.
+	'''
+	ret = []
+	pos = 0
+	while pos + 4 <= len(extra):
+		header_id, size = struct.unpack("<HH", extra[pos:pos+4])
+		if header_id != ZIP64_EXTRA_ID:
+			ret.append(extra[pos:pos+4+size])
+		pos += 4 + size
+	return b"".join(ret)
+
 class NotAnArchive(Exception):
 	pass
 class DamagedArchive(Exception):
@@ -56,221 +83,339 @@ class DamagedArchive(Exception):
 # (WIP)
 
 import MangaCMS.cleaner.processDownload
+import MangaCMS.lib.staging as staging
+import MangaCMS.lib.fileIdentity as fileIdentity
 
-class ArchCleaner(object):
-
-	loggerPath = "Main.ZipClean"
-	def __init__(self):
-		self.log = logging.getLogger(self.loggerPath)
+# Fingerprints of the images in settings.badImageDir. Loaded once, and shared by every
+# ArchCleaner in the process. It's rebuilt only when the directory's mtime changes
+# (i.e. an image is added, removed or renamed).
+BadImageIndex = collections.namedtuple("BadImageIndex", ["mtime", "md5s", "fingerprints"])
 
-		badIms = os.listdir(settings.badImageDir)
+_bad_image_lock  = threading.Lock()
+_bad_image_index = None
 
-		self.badHashes = []
+def get_bad_image_index():
+	global _bad_image_index
+	log = logging.getLogger(ArchCleaner.loggerPath)
 
-		for im in badIms:
-			with open(os.path.join(settings.badImageDir, im), "rb") as fp:
-				md5 = hashlib.md5()
-				md5.update(fp.read())
-				self.badHashes.append(md5.hexdigest())
-				self.log.info("Bad Image = '%s', Hash = '%s'", im, md5.hexdigest())
+	mtime = os.stat(settings.badImageDir).st_mtime_ns
+	with _bad_image_lock:
+		if _bad_image_index is not None and _bad_image_index.mtime == mtime:
+			return _bad_image_index
 
+		md5s = set()
+		# (size, crc32) of each bad image. A zip's central directory has both for every
+		# member, so anything not in here can be ruled out without decompressing it.
+		fingerprints = set()
 
-	# So starkana, in an impressive feat of douchecopterness, inserts an annoying self-promotion image
-	# in EVERY manga archive the serve. Furthermore, they insert it in the MIDDLE of the manga.
-	# Therefore, this function edits the zip and removes this stupid annoying file.
-	def cleanZip(self, archPath):
+		for im in os.listdir(settings.badImageDir):
+			with open(os.path.join(settings.badImageDir, im), "rb") as fp:
+				content = fp.read()
+			md5s.add(hashlib.md5(content).hexdigest())
+			fingerprints.add((len(content), zlib.crc32(content) & 0xffffffff))
 
-		origPath = archPath
+		_bad_image_index = BadImageIndex(mtime, frozenset(md5s), frozenset(fingerprints))
+		log.info("Loaded %s bad images from '%s'", len(md5s), settings.badImageDir)
+		return _bad_image_index
 
-		if not os.path.exists(archPath):
-			raise ValueError("Trying to clean non-existant file?")
-
-		fType = magic.from_file(archPath, mime=True)
-		if not fType == 'application/zip' and \
-		   not fType == 'application/x-rar' and \
-		   not fType == 'application/x-7z-compressed':
-			raise NotAnArchive("Trying to clean a file that is not a zip/rar/7z archive! File=%s" % archPath)
 
+class ArchCleaner(object):
 
-		file_count = 0
+	loggerPath = "Main.ZipClean"
+	def __init__(self):
+		self.log = logging.getLogger(self.loggerPath)
 
+		badImages = get_bad_image_index()
+		self.badHashes       = badImages.md5s
+		self.badFingerprints = badImages.fingerprints
 
-		self.log.info("Scanning arch '%s'", archPath)
 
+	# Context manager for writing a new zip, which is swapped in at `archPath` on success.
+	# The zip is built in the staging directory, so a crash part way through leaves the original
+	# file untouched, and the library only ever sees the finished archive (with a single rename).
+	@contextlib.contextmanager
+	def _staged_zip(self, archPath):
+		staged_path = staging.new_temp_path()
 		try:
-			old_zfp = UniversalArchiveInterface.ArchiveReader(archPath)
-
-
-			files = []
-			hadBadFile = False
-
-			if fType == 'application/x-7z-compressed':
-				# Cause fuck 7z files. They're slowwwww
-				hadBadFile = True
-
-			if fType == 'application/x-rar':
-				# Fukkit, convert ALL THE FILES
-				hadBadFile = True
-
-
-
-			for fileN, fileCtnt in old_zfp:
-				file_count += 1
-
-				if fileN.endswith("Thumbs.db"):
-					hadBadFile = True
-					self.log.info("Had windows 'Thumbs.db' file. Removing")
-					continue
+			with std_zipfile.ZipFile(staged_path, "w") as new_zfp:
+				yield new_zfp
+
+			staging.promote(staged_path, archPath)
+		finally:
+			staging.discard(staged_path)
+
+	# Append member `info` of the zip open as `old_fp` to `new_zfp`, by copying its compressed
+	# data as-is. Only the local header is regenerated (the central directory entry is written
+	# when `new_zfp` is closed), so nothing is decompressed or recompressed, and only one chunk
+	# of the member is ever in memory.
+	def _copy_raw_member(self, old_fp, info, new_zfp):
+		old_fp.seek(info.header_offset)
+		header = old_fp.read(std_zipfile.sizeFileHeader)
+		if len(header) != std_zipfile.sizeFileHeader or header[0:4] != std_zipfile.stringFileHeader:
+			raise DamagedArchive("Bad local file header for member '%s'" % info.filename)
+		fields = struct.unpack(std_zipfile.structFileHeader, header)
+		old_fp.seek(fields[std_zipfile._FH_FILENAME_LENGTH] + fields[std_zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+		new_info = copy.copy(info)
+		new_info.header_offset = new_zfp.fp.tell()
+		# The sizes and CRC are known up front, so there's no trailing data descriptor.
+		new_info.flag_bits &= ~0x08
+		# `info.extra` is the central directory's copy of the extra field, whose zip64 record
+		# (if any) doesn't match what the local header needs. The zip64 records are rebuilt
+		# here for the local header, and by the zipfile module for the central directory.
+		new_info.extra = _strip_zip64_extra(info.extra)
+		zip64 = info.file_size > std_zipfile.ZIP64_LIMIT or info.compress_size > std_zipfile.ZIP64_LIMIT
+		new_zfp.fp.write(new_info.FileHeader(zip64))
+
+		remaining = info.compress_size
+		while remaining:
+			chunk = old_fp.read(min(remaining, COPY_CHUNK_SIZE))
+			if not chunk:
+				raise DamagedArchive("Member '%s' is truncated" % info.filename)
+			new_zfp.fp.write(chunk)
+			remaining -= len(chunk)
+
+		new_zfp.filelist.append(new_info)
+		new_zfp.NameToInfo[new_info.filename] = new_info
+		new_zfp.start_dir = new_zfp.fp.tell()
+
+	def _is_junk_file(self, fileN):
+		if fileN.endswith("Thumbs.db"):
+			self.log.info("Had windows 'Thumbs.db' file. Removing")
+			return True
+
+		if "/__MACOSX/" in fileN or fileN.startswith("__MACOSX/"):
+			self.log.info("Have apple bullshit files. Removing")
+			return True
+
+		if ".DS_Store" in fileN:
+			self.log.info("Have apple bullshit '.DS_Store' files. Removing")
+			return True
+
+		return False
+
+	def _ad_placeholder(self, fileN):
+		# Replace bad image with a text-file with the same name, and an explanation in it.
+		fctnt  = "This was an advertisement. It has been automatically removed.\n"
+		fctnt += "Don't worry, there are no missing files, despite the gap in the numbering."
+		return fileN + ".deleted.txt", fctnt
+
+	# Confirm a (size, crc32) match against the bad images by md5.
+	def _is_bad_image(self, content):
+		return hashlib.md5(content).hexdigest() in self.badHashes
+
+	# Clean a zip file. Junk files are found from their names, and bad images are ruled out
+	# from the (size, crc32) in the central directory, so only the members that match a bad
+	# image's fingerprint are ever decompressed (to confirm the match by md5). For a clean
+	# archive, that's just the one read of the central directory.
+	# If anything has to be removed, the archive is rebuilt by copying the compressed data of
+	# the members being kept straight across (see _copy_raw_member()).
+	def _clean_zip_file(self, archPath, zipPath):
+		file_count = 0
+		plan = []
 
-				if "/__MACOSX/" in fileN or fileN.startswith("__MACOSX/"):
-					hadBadFile = True
-					self.log.info("Have apple bullshit files. Removing")
+		with std_zipfile.ZipFile(archPath, "r") as old_zfp:
+			for info in old_zfp.infolist():
+				if info.filename.endswith("/"):
+					plan.append((info, 'keep'))
 					continue
 
-				if ".DS_Store" in fileN:
-					hadBadFile = True
-					self.log.info("Have apple bullshit '.DS_Store' files. Removing")
+				file_count += 1
+				if self._is_junk_file(info.filename):
+					plan.append((info, 'drop'))
 					continue
 
-				fctnt = fileCtnt.read()
+				if (info.file_size, info.CRC) in self.badFingerprints and self._is_bad_image(old_zfp.read(info)):
+					self.log.info("File %s was the advert. Removing!", info.filename)
+					plan.append((info, 'replace'))
+				else:
+					plan.append((info, 'keep'))
+
+		if all(action == 'keep' for dummy_info, action in plan):
+			self.log.info("No offending contents. No changes made to file.")
+			return file_count, False
+
+		self.log.info("Had advert. Rebuilding zip as '%s'.", zipPath)
+		with open(archPath, "rb") as old_fp, self._staged_zip(zipPath) as new_zfp:
+			for info, action in plan:
+				if action == 'keep':
+					self._copy_raw_member(old_fp, info, new_zfp)
+				elif action == 'replace':
+					new_zfp.writestr(*self._ad_placeholder(info.filename))
+
+		return file_count, True
+
+	# Convert a rar or 7z archive to a zip, with the same cleaning as _clean_zip_file(). Each
+	# member is written to the new zip as it's read.
+	def _convert_to_zip(self, archPath, zipPath):
+		file_count = 0
+		old_zfp = UniversalArchiveInterface.ArchiveReader(archPath)
+		try:
+			with self._staged_zip(zipPath) as new_zfp:
+				for fileN, fileCtnt in old_zfp:
+					file_count += 1
+					if self._is_junk_file(fileN):
+						continue
+
+					fctnt = fileCtnt.read()
+					if (len(fctnt), zlib.crc32(fctnt) & 0xffffffff) in self.badFingerprints and self._is_bad_image(fctnt):
+						self.log.info("File %s was the advert. Removing!", fileN)
+						fileN, fctnt = self._ad_placeholder(fileN)
+
+					new_zfp.writestr(fileN, fctnt)
+		finally:
+			old_zfp.close()
 
+		return file_count
 
-				md5 = hashlib.md5()
-				md5.update(fctnt)
 
-				# Replace bad image with a text-file with the same name, and an explanation in it.
-				if md5.hexdigest() in self.badHashes:
-					self.log.info("File %s was the advert. Removing!", fileN)
-					fileN = fileN + ".deleted.txt"
-					fctnt  = "This was an advertisement. It has been automatically removed.\n"
-					fctnt += "Don't worry, there are no missing files, despite the gap in the numbering."
+	# So starkana, in an impressive feat of douchecopterness, inserts an annoying self-promotion image
+	# in EVERY manga archive the serve. Furthermore, they insert it in the MIDDLE of the manga.
+	# Therefore, this function edits the zip and removes this stupid annoying file.
+	# `archPath` can be a path, or a FileIdentity (see MangaCMS.lib.fileIdentity). Returns a
+	# FileIdentity for the cleaned file (which is `archPath`'s, if nothing had to change), and
+	# the number of files in it.
+	def cleanZip(self, archPath):
 
-					hadBadFile = True
+		if not isinstance(archPath, fileIdentity.FileIdentity) and not os.path.exists(archPath):
+			raise ValueError("Trying to clean non-existant file?")
 
-				files.append((fileN, fctnt))
+		fileIdent = fileIdentity.identify(archPath)
+		archPath  = fileIdent.path
+		origPath  = archPath
 
-			old_zfp.close()
-
-			# only replace the file if we need to
-			if hadBadFile:
-				# Now, recreate the zip file without the ad
-				if not archPath.endswith(".zip"):
+		fType = fileIdent.mime
+		if not fType == 'application/zip' and \
+		   not fType == 'application/x-rar' and \
+		   not fType == 'application/x-7z-compressed':
+			raise NotAnArchive("Trying to clean a file that is not a zip/rar/7z archive! File=%s" % archPath)
 
-					archPath = os.path.splitext(archPath)[0]
-					archPath += ".zip"
 
-				self.log.info("Had advert. Rebuilding zip as '%s'.", archPath)
-				new_zfp = zipfile.ZipFile(archPath, "w")
-				for fileInfo, contents in files:
-					new_zfp.writestr(fileInfo, contents)
-				new_zfp.close()
+		# Anything that gets rebuilt is rebuilt as a zip.
+		zipPath = archPath
+		if not zipPath.endswith(".zip"):
+			zipPath = os.path.splitext(zipPath)[0] + ".zip"
 
-				if origPath != archPath:
-					os.remove(origPath)
+		self.log.info("Scanning arch '%s'", archPath)
 
+		try:
+			if fType == 'application/zip':
+				file_count, rebuilt = self._clean_zip_file(archPath, zipPath)
 			else:
-				self.log.info("No offending contents. No changes made to file.")
+				# Cause fuck 7z files. They're slowwwww
+				# And for rars, fukkit, convert ALL THE FILES
+				file_count, rebuilt = self._convert_to_zip(archPath, zipPath), True
 
-		except UniversalArchiveInterface.ArchiveError:
+		except (UniversalArchiveInterface.ArchiveError, zipfile.BadZipFile, std_zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError):
 			self.log.error("Bad archive file!")
 			for line in traceback.format_exc().split("\n"):
 				self.log.error(line)
 			raise DamagedArchive()
 
-		return archPath, file_count
+		if rebuilt:
+			fileIdent = fileIdentity.FileIdentity(zipPath, mime='application/zip')
+			if origPath != zipPath:
+				os.remove(origPath)
+
+		return fileIdent, file_count
 
 
 	# Rebuild zipfile `zipPath` that has a password as a non-password protected zip
-	# Pre-emptively checks if the zip is really password-protected, and does not
-	# rebuild zips that are not password protected.
+	# Whether the zip is really password-protected is read from the encryption flag (bit 0 of
+	# the general purpose flags) of each member in the central directory, so zips that are not
+	# password protected are neither decompressed nor rebuilt.
 	def unprotectZip(self, zipPath, password):
 		password = password.encode("ascii")
 		try:
-			old_zfp = zipfile.ZipFile(zipPath, "r")
-			files = old_zfp.infolist()
-			for fileN in files:
-				old_zfp.open(fileN).read()
-			self.log.info("Do not need to decrypt zip")
-			return
-
-		except RuntimeError:
-			self.log.error("Error in archive checker?")
-			for line in traceback.format_exc().split("\n"):
-				self.log.error(line)
-			return
+			with std_zipfile.ZipFile(zipPath, "r") as zfp:
+				infos = zfp.infolist()
 
-		except zipfile.BadZipFile:
+		except std_zipfile.BadZipFile:
 			self.log.error("Archive is corrupt/damaged?")
 			for line in traceback.format_exc().split("\n"):
 				self.log.error(line)
 			return
 
-		except:
-			self.log.error("Unknown error??")
-			for line in traceback.format_exc().split("\n"):
-				self.log.error(line)
+		encrypted = [info for info in infos if info.flag_bits & 0x1]
+		if not encrypted:
+			self.log.info("Do not need to decrypt zip")
 			return
 
-		self.log.info("Removing password from zip '%s'", zipPath)
-		old_zfp = zipfile.ZipFile(zipPath, "r")
-		old_zfp.setpassword(password)
-		fileNs = old_zfp.namelist()
-		files = []
-
+		self.log.info("Removing password from zip '%s' (%s of %s members encrypted)", zipPath, len(encrypted), len(infos))
 
 		# The zip decryption is STUPID slow. It's really insane how shitty
 		# the python integrated library is.
 		# See czipfile.pyd for some work on making it faster.
-		for fileInfo in fileNs:
-
-			fctnt = old_zfp.open(fileInfo).read()
-			files.append((fileInfo, fctnt))
-
-		old_zfp.close()
+		try:
+			with zipfile.ZipFile(zipPath, "r") as old_zfp, open(zipPath, "rb") as old_fp, self._staged_zip(zipPath) as new_zfp:
+				old_zfp.setpassword(password)
+				for info in infos:
+					if info.flag_bits & 0x1:
+						self._copy_decrypted_member(old_zfp, info, new_zfp)
+					else:
+						self._copy_raw_member(old_fp, info, new_zfp)
+
+		except (RuntimeError, zipfile.BadZipFile, std_zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, DamagedArchive):
+			self.log.error("Could not decrypt zip. Leaving it as-is.")
+			for line in traceback.format_exc().split("\n"):
+				self.log.error(line)
+			return
 
-		os.remove(zipPath)
+		self.log.info("Rebuilt zip without password.")
 
-		# only replace the file if we need to
-		# Now, recreate the zip file without the ad
-		self.log.info("Rebuilding zip without password.")
+	# Decrypt member `info` of `old_zfp` (which has the password set), and write it to `new_zfp`
+	# with the same compression, a chunk at a time.
+	def _copy_decrypted_member(self, old_zfp, info, new_zfp):
+		new_info = std_zipfile.ZipInfo(info.filename, info.date_time)
+		new_info.compress_type = info.compress_type
+		new_info.external_attr = info.external_attr
+		new_info.comment       = info.comment
+		# Lets the writer decide up front if the member needs zip64 extensions.
+		new_info.file_size     = info.file_size
 
-		new_zfp = zipfile.ZipFile(zipPath, "w")
-		for fileInfo, contents in files:
-			new_zfp.writestr(fileInfo, contents)
-		new_zfp.close()
+		with old_zfp.open(info.filename) as src, new_zfp.open(new_info, "w") as dst:
+			shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
 
 
 	# Process a newly downloaded archive. If deleteDups is true, and the archive is duplicated, it is deleted.
 	# If includePHash is true as well, the duplicate search is done using phashes of the images, in addition
 	# to just raw file-hashing.
+	# `archPath` can be a path, or a FileIdentity. Returns the tags, and a FileIdentity for the
+	# resulting file.
 	def processNewArchive(self, archPath, passwd=""):
-		if magic.from_file(archPath, mime=True) == 'application/zip':
+		fileIdent = fileIdentity.identify(archPath)
+		archPath  = fileIdent.path
+
+		if fileIdent.mime == 'application/zip':
 			self.unprotectZip(archPath, passwd)
-		elif magic.from_file(archPath, mime=True) == 'application/x-rar':
+			# Unprotecting rewrites the file (as a zip) when it does anything.
+			if not fileIdent.is_current():
+				fileIdent = fileIdent.rewritten()
+		elif fileIdent.mime == 'application/x-rar':
 			pass
 		else:
 			self.log.error("ArchCleaner called on file that isn't a rar or zip!")
 			self.log.error("Called on file %s", archPath)
 			self.log.error("Specified password '%s'", passwd)
-			self.log.error("Inferred file type %s", magic.from_file(archPath, mime=True))
+			self.log.error("Inferred file type %s", fileIdent.mime)
 			raise NotAnArchive("ArchCleaner called on file that isn't a rar or zip!")
 
-		# ArchPath will convert from rar to zip if needed, and returns the name of the resulting
+		# cleanZip will convert from rar to zip if needed, and returns the identity of the resulting
 		# file in either case
 		try:
-			archPath, filecount = self.cleanZip(archPath)
+			fileIdent, filecount = self.cleanZip(fileIdent)
 			if filecount <= 2:
-				return "fewfiles", archPath
-			return "", archPath
+				return "fewfiles", fileIdent
+			return "", fileIdent
 		except (zipfile.BadZipFile, rarfile.BadRarFile, DamagedArchive, NotAnArchive):
 			self.log.error("Ignoring archive because it appears damaged.")
-			return "damaged", archPath
+			return "damaged", fileIdent
 
 		except:
 			self.log.error("Unknown error??")
 			for line in traceback.format_exc().split("\n"):
 				self.log.error(line)
-			return "damaged", archPath
+			return "damaged", fileIdent
 
 
 
@@ -289,8 +434,8 @@ if __name__ == "__main__":
 			if not os.path.exists(fileP):
 				raise ValueError
 
-			fType = magic.from_file(fileP, mime=True)
+			fileIdent = fileIdentity.FileIdentity(fileP)
 
-			if fType == 'application/zip' or fType == 'application/x-rar':
-				run.processNewArchive(fileP)
+			if fileIdent.mime == 'application/zip' or fileIdent.mime == 'application/x-rar':
+				run.processNewArchive(fileIdent)
 
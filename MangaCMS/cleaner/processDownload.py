@@ -9,6 +9,7 @@ import runStatus
 import deduplicator.archChecker
 import MangaCMS.ScrapePlugins.MangaScraperBase
 import MangaCMS.cleaner.archCleaner as ac
+import MangaCMS.lib.fileIdentity as fileIdentity
 import UploadPlugins.Madokami.uploader as up
 
 PHASH_DISTANCE = 4
@@ -29,7 +30,7 @@ class DownloadProcessor(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase
 	plugin_key  = None
 	plugin_type = 'Utility'
 
-	def _create_or_update_file_entry_path(self, oldPath, newPath, setDeleted=False, setDuplicate=False, setPhash=False, reuse_sess=None):
+	def _create_or_update_file_entry_path(self, oldPath, newPath, setDeleted=False, setDuplicate=False, setPhash=False, reuse_sess=None, newFhash=None):
 		oldItemRoot, oldItemFile = os.path.split(oldPath)
 		newItemRoot, newItemFile = os.path.split(newPath)
 
@@ -47,10 +48,12 @@ class DownloadProcessor(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase
 				.scalar()
 
 			if not new_row:
-				hash_md5 = hashlib.md5()
-				with open(newPath, "rb") as f:
-					hash_md5.update(f.read())
-				fhash = hash_md5.hexdigest()
+				fhash = newFhash
+				if fhash is None:
+					hash_md5 = hashlib.md5()
+					with open(newPath, "rb") as f:
+						hash_md5.update(f.read())
+					fhash = hash_md5.hexdigest()
 
 				# Use an existing file row (if present), via the md5sum
 				new_row = sess.query(self.db.ReleaseFile)          \
@@ -134,6 +137,8 @@ class DownloadProcessor(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase
 				pathPositiveFilter = None,
 				crossReference     = True,
 				doUpload           = True,
+				archiveIdentity    = None,
+				archiveCleanTags   = None,
 				**kwargs
 			):
 
@@ -158,15 +163,31 @@ class DownloadProcessor(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase
 
 
 
+		# The stat/mime sniff/md5 of the file is worked out once here (if the caller
+		# didn't already have it), and shared by the cleaner and the deduper.
+		if archiveIdentity and archiveIdentity.path == os.path.abspath(archivePath):
+			fileIdent = fileIdentity.identify(archiveIdentity)
+		else:
+			fileIdent = fileIdentity.identify(archivePath)
+
+		# The retriever may have already run the cleaner over the file before it was
+		# moved into the library. That only holds if it's still the same file.
+		if fileIdent is not archiveIdentity:
+			archiveCleanTags = None
+
 		if moveToPath:
 			retTags = ""
+		elif archiveCleanTags is not None:
+			self.log.info("Archive '%s' was cleaned before being saved.", archivePath)
+			retTags = archiveCleanTags
 		else:
 			archCleaner = MangaCMS.cleaner.archCleaner.ArchCleaner()
 			try:
-				retTags, archivePath_updated = archCleaner.processNewArchive(archivePath, **kwargs)
-				if archivePath_updated != archivePath:
-					self._create_or_update_file_entry_path(archivePath, archivePath_updated)
-					archivePath = archivePath_updated
+				retTags, fileIdent_updated = archCleaner.processNewArchive(fileIdent, **kwargs)
+				if fileIdent_updated.path != fileIdent.path:
+					self._create_or_update_file_entry_path(fileIdent.path, fileIdent_updated.path, newFhash=fileIdent_updated.md5)
+				fileIdent   = fileIdent_updated
+				archivePath = fileIdent.path
 
 			except Exception:
 				self.log.critical("Error processing archive '%s'", archivePath)
@@ -188,7 +209,7 @@ class DownloadProcessor(MangaCMS.ScrapePlugins.MangaScraperBase.MangaScraperBase
 			phashThresh = phashThreshIn
 
 			while True:
-				dc = deduplicator.archChecker.ArchChecker(archivePath, phashDistance=phashThresh, pathPositiveFilter=pathPositiveFilter, lock=False)
+				dc = deduplicator.archChecker.ArchChecker(fileIdent, phashDistance=phashThresh, pathPositiveFilter=pathPositiveFilter, lock=False)
 				retTagsTmp, bestMatch, intersections = dc.process(moveToPath=moveToPath)
 
 				if 'deleted' in retTagsTmp:
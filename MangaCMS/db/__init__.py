@@ -8,6 +8,10 @@ from .db_models import MangaTags
 from .db_models import HentaiTags
 from .db_models import ReleaseFile
 from .db_models import PluginStatus
+from .db_models import HostRateLimit
+from .db_models import FeedPageCache
+from .db_models import FeedWatermark
+from .db_models import FeedSnapshot
 
 from .db_models import manga_files_tags_link
 from .db_models import manga_releases_tags_link
@@ -28,6 +32,8 @@ from .db_base import Base
 # from .db_engine import delete_db_session
 from .db_engine import session
 from .db_engine import session_context
+from .db_engine import unit_of_work_context
+from .db_engine import in_unit_of_work
 
 import sqlalchemy as sa
 sa.orm.configure_mappers()
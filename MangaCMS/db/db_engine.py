@@ -2,6 +2,7 @@
 import sys
 import logging
 import contextlib
+import threading
 import traceback
 
 
@@ -38,6 +39,46 @@ session = scoped_session(SessionFactory)
 
 context_logger = logging.getLogger("Main.SessionContext")
 
+_thread_state = threading.local()
+
+def in_unit_of_work():
+	return getattr(_thread_state, 'unit_of_work', False)
+
+@contextlib.contextmanager
+def unit_of_work_context():
+	'''
+	Run a block of work against a single session.
+
+	Any session_context() entered on the same thread inside the block shares
+	this session rather then opening its own, and runs in a savepoint of it.
+	Each outermost session_context() is one DB phase, and its transaction is
+	committed when it exits, so no transaction (or pooled connection) is held
+	open across whatever the block does between phases (e.g. downloading).
+	Objects are not expired on commit, so rows loaded once stay loaded from
+	one phase to the next, and later phases find them in the identity map
+	rather then re-querying them.
+	'''
+	if in_unit_of_work():
+		yield session()
+		return
+
+	sess = session()
+	sess.expire_on_commit = False
+	_thread_state.unit_of_work = True
+	_thread_state.phase_depth  = 0
+	try:
+		yield sess
+		sess.commit()
+
+	except Exception as e:
+		context_logger.error("Error in unit of work! Rolling back.")
+		sess.rollback()
+		raise e
+
+	finally:
+		_thread_state.unit_of_work = False
+		session.remove()
+
 @contextlib.contextmanager
 def session_context(commit=True, reuse_sess=None):
 
@@ -47,6 +88,37 @@ def session_context(commit=True, reuse_sess=None):
 		yield reuse_sess
 		return
 
+	# Inside a unit of work, share its session. Each context runs in its own
+	# savepoint, so a failure (or commit=False) only discards what that
+	# context did. Nested contexts just release their savepoint, the
+	# outermost one ends the phase's transaction.
+	elif in_unit_of_work():
+		sess = session()
+		savepoint = sess.begin_nested()
+		_thread_state.phase_depth += 1
+		try:
+			yield sess
+			if commit:
+				sess.flush()
+
+		except Exception as e:
+			context_logger.error("Error in transaction (within unit of work)!")
+			for line in traceback.format_exc().split("\n"):
+				context_logger.error(line)
+			context_logger.warning("Rolling back to savepoint.")
+			savepoint.rollback()
+			raise e
+
+		finally:
+			_thread_state.phase_depth -= 1
+
+		if commit:
+			savepoint.commit()
+			if not _thread_state.phase_depth:
+				sess.commit()
+		else:
+			savepoint.rollback()
+
 	else:
 
 		sess = session()
@@ -70,4 +142,3 @@ def session_context(commit=True, reuse_sess=None):
 			if commit:
 				sess.commit()
 			session.remove()
-
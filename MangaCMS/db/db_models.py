@@ -1,13 +1,21 @@
 
 import datetime
+import threading
+import collections
 
 from sqlalchemy.orm import backref
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select
 from sqlalchemy import Table
 from sqlalchemy import Index
 
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import BigInteger
+from sqlalchemy import Float
+from sqlalchemy import LargeBinary
 from sqlalchemy import Text
 from sqlalchemy import Interval
 from sqlalchemy import Boolean
@@ -29,12 +37,122 @@ ischema_names['citext'] = citext.CIText
 
 
 from .db_engine import session
+from .db_engine import in_unit_of_work
 from .db_base import Base
 from .db_types import file_type
 from .db_types import dir_type
 from .db_types import dlstate_enum
 
 
+########################################################################################
+
+# Upper bound on the number of entries held by each per-table tag cache.
+TAG_CACHE_SIZE = 50000
+
+class TagIdCache(object):
+	'''
+	Process-wide, thread-safe LRU map of {tag.lower() : (tag_id, tag)}.
+
+	Only tags whose rows are known to be committed are ever put in here,
+	and tag rows are never deleted, so entries don't go stale.
+	'''
+	def __init__(self, max_size=TAG_CACHE_SIZE):
+		self.max_size = max_size
+		self.lock     = threading.Lock()
+		self.items    = collections.OrderedDict()
+
+	def get(self, tag):
+		with self.lock:
+			ret = self.items.get(tag.lower())
+			if ret:
+				self.items.move_to_end(tag.lower())
+			return ret
+
+	def put(self, tag_id, tag):
+		with self.lock:
+			self.items[tag.lower()] = (tag_id, tag)
+			self.items.move_to_end(tag.lower())
+			while len(self.items) > self.max_size:
+				self.items.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+
+def _tag_instance_from_cache(cls, tag_id, tag):
+	# If the row is already in the session, hand that back. Otherwise, build
+	# a detached instance with a known identity, which the session will
+	# attach without having to query for it.
+	have = session.identity_map.get(identity_key(cls, tag_id))
+	if have is not None:
+		return have
+	tmp = cls(id=tag_id, tag=tag)
+	make_transient_to_detached(tmp)
+	return tmp
+
+def _tag_get_or_create(cls, tag):
+	have = cls.id_cache.get(tag)
+	if have:
+		return _tag_instance_from_cache(cls, *have)
+
+	tmp = session.query(cls)    \
+		.filter(cls.tag == tag) \
+		.scalar()
+	if tmp:
+		cls.id_cache.put(tmp.id, tmp.tag)
+		session.expunge(tmp)
+		return tmp
+
+	tmp = cls(tag=tag)
+	session.add(tmp)
+	session.flush()
+
+	# Inside a unit of work, committing is up to the unit of work, and the
+	# new tag isn't cached until it's known to have been committed.
+	if in_unit_of_work():
+		return tmp
+
+	tag_id = tmp.id
+	session.commit()
+	session.expunge(tmp)
+	cls.id_cache.put(tag_id, tag)
+	return tmp
+
+def _tag_resolve(cls, tags, sess):
+	if sess is None:
+		sess = session
+
+	ret = {}
+	missing = []
+	for tag in set(tags):
+		have = cls.id_cache.get(tag)
+		if have:
+			ret[tag.lower()] = have[0]
+		else:
+			missing.append(tag)
+
+	if not missing:
+		return ret
+
+	table = cls.__table__
+	res = sess.execute(insert(table)
+			.values([{'tag' : tag} for tag in missing])
+			.on_conflict_do_nothing()
+			.returning(table.c.id)
+		)
+	created = set(tag_id for tag_id, in res)
+
+	# The tag column is citext, so matching here is case-insensitive.
+	res = sess.execute(select([table.c.id, table.c.tag]).where(table.c.tag.in_(missing)))
+	for tag_id, tag in res:
+		ret[tag.lower()] = tag_id
+		# Rows we just created aren't committed yet, so they can't be cached
+		# (the caller may still roll back).
+		if tag_id not in created:
+			cls.id_cache.put(tag_id, tag)
+
+	return ret
+
 ########################################################################################
 
 manga_files_tags_link = Table(
@@ -60,21 +178,20 @@ class MangaTags(Base):
 			CheckConstraint('length(tag) >= 2'),
 		)
 
+	id_cache = TagIdCache()
+
 	@classmethod
 	def get_or_create(cls, tag):
-		tmp = session.query(cls)    \
-			.filter(cls.tag == tag) \
-			.scalar()
-		if tmp:
-			session.expunge(tmp)
-			return tmp
-
-		# print("manga_tag_creator", tag)
-		tmp = cls(tag=tag)
-		session.add(tmp)
-		session.commit()
-		session.expunge(tmp)
-		return tmp
+		return _tag_get_or_create(cls, tag)
+
+	@classmethod
+	def resolve_tags(cls, tags, sess=None):
+		'''
+		Make sure every tag in `tags` exists, and return {tag.lower() : tag_id}.
+		Uncached tags are resolved with one INSERT ... ON CONFLICT DO NOTHING
+		and one SELECT, run in `sess` (or the scoped session, if not passed).
+		'''
+		return _tag_resolve(cls, tags, sess)
 
 ########################################################################################
 
@@ -101,21 +218,20 @@ class HentaiTags(Base):
 			CheckConstraint('length(tag) >= 2'),
 		)
 
+	id_cache = TagIdCache()
+
 	@classmethod
 	def get_or_create(cls, tag):
-		tmp = session.query(cls)    \
-			.filter(cls.tag == tag) \
-			.scalar()
-		if tmp:
-			session.expunge(tmp)
-			return tmp
-
-		# print("hentai_tag_creator", tag)
-		tmp = cls(tag=tag)
-		session.add(tmp)
-		session.commit()
-		session.expunge(tmp)
-		return tmp
+		return _tag_get_or_create(cls, tag)
+
+	@classmethod
+	def resolve_tags(cls, tags, sess=None):
+		'''
+		Make sure every tag in `tags` exists, and return {tag.lower() : tag_id}.
+		Uncached tags are resolved with one INSERT ... ON CONFLICT DO NOTHING
+		and one SELECT, run in `sess` (or the scoped session, if not passed).
+		'''
+		return _tag_resolve(cls, tags, sess)
 
 
 ########################################################################################
@@ -134,6 +250,10 @@ class MangaReleases(Base):
 	downloaded_at       = Column(DateTime, nullable=False, default=datetime.datetime.min)
 	last_checked        = Column(DateTime, nullable=False, default=datetime.datetime.min)
 
+	# Who moved the row to `fetching`, and when. See MangaScraperDbMixin.claim_new_rows()
+	claimed_by          = Column(Text)
+	claimed_at          = Column(DateTime)
+
 	deleted             = Column(Boolean, default=False, nullable=False)
 	was_duplicate       = Column(Boolean, default=False, nullable=False)
 	phash_duplicate     = Column(Boolean, default=False, nullable=False)
@@ -157,7 +277,8 @@ class MangaReleases(Base):
 
 	__table_args__ = (
 			UniqueConstraint('source_site', 'source_id'),
-			Index('manga_releases_source_site_id_idx', 'source_site', 'source_id')
+			Index('manga_releases_source_site_id_idx', 'source_site', 'source_id'),
+			Index('manga_releases_todo_idx', source_site, posted_at.desc(), postgresql_where=(state == 'new')),
 		)
 
 
@@ -176,6 +297,10 @@ class HentaiReleases(Base):
 	downloaded_at       = Column(DateTime, nullable=False, default=datetime.datetime.min)
 	last_checked        = Column(DateTime, nullable=False, default=datetime.datetime.min)
 
+	# Who moved the row to `fetching`, and when. See MangaScraperDbMixin.claim_new_rows()
+	claimed_by          = Column(Text)
+	claimed_at          = Column(DateTime)
+
 	deleted             = Column(Boolean, default=False, nullable=False)
 	was_duplicate       = Column(Boolean, default=False, nullable=False)
 	phash_duplicate     = Column(Boolean, default=False, nullable=False)
@@ -199,7 +324,8 @@ class HentaiReleases(Base):
 
 	__table_args__ = (
 			UniqueConstraint('source_site', 'source_id'),
-			Index('hentai_releases_source_site_id_idx', 'source_site', 'source_id')
+			Index('hentai_releases_source_site_id_idx', 'source_site', 'source_id'),
+			Index('hentai_releases_todo_idx', source_site, posted_at.desc(), postgresql_where=(state == 'new')),
 		)
 
 
@@ -252,3 +378,61 @@ class PluginStatus(Base):
 	run_time       = Column(Interval, nullable=False, default=datetime.timedelta)
 
 
+class HostRateLimit(Base):
+	__tablename__ = 'host_rate_limit'
+	host           = Column(Text, primary_key=True)
+
+	# Token bucket state, see MangaCMS.lib.rateLimit
+	tokens         = Column(Float, nullable=False)
+	updated_at     = Column(DateTime, nullable=False)
+
+
+class FeedPageCache(Base):
+	__tablename__ = 'feed_page_cache'
+	id             = Column(BigInteger, primary_key=True)
+	source_site    = Column(Text, nullable=False)
+	url            = Column(Text, nullable=False)
+
+	# HTTP validators from the last response, and the md5 of its content.
+	etag           = Column(Text)
+	last_modified  = Column(Text)
+	content_hash   = Column(Text, nullable=False)
+
+	last_checked   = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+	__table_args__ = (
+			UniqueConstraint('source_site', 'url'),
+		)
+
+
+class FeedWatermark(Base):
+	__tablename__ = 'feed_watermark'
+	id               = Column(BigInteger, primary_key=True)
+	source_site      = Column(Text, nullable=False)
+	series_url       = Column(Text, nullable=False)
+
+	# The newest release seen on the series page the last time it was crawled.
+	newest_source_id = Column(Text, nullable=False)
+	newest_posted_at = Column(DateTime, nullable=False)
+
+	last_checked     = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+	__table_args__ = (
+			UniqueConstraint('source_site', 'series_url'),
+		)
+
+
+class FeedSnapshot(Base):
+	__tablename__ = 'feed_snapshot'
+	id             = Column(BigInteger, primary_key=True)
+	source_site    = Column(Text, nullable=False, unique=True)
+
+	# Sorted array of 64 bit keys, one per item seen in the last full crawl.
+	# See LoaderBase.save_feed_snapshot().
+	snapshot       = Column(LargeBinary, nullable=False)
+	entries        = Column(Integer, nullable=False)
+
+	last_checked   = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+
@@ -0,0 +1,179 @@
+
+import re
+
+import lxml.html
+import WebRequest
+
+# Tags that HTML lets you leave unclosed, and the elements that scope them.
+# When straining one of these, a new opening tag of the same name ends the
+# previous element, unless it's inside a new scope (e.g. a `<tr>` in a table
+# nested in the `<tr>` being strained). Closing the enclosing scope element
+# ends it too.
+IMPLIED_END_TAGS = {
+	'tr'     : ('table', ),
+	'td'     : ('table', ),
+	'th'     : ('table', ),
+	'li'     : ('ul', 'ol'),
+	'option' : ('select', 'datalist'),
+	'p'      : (),
+}
+
+# Other tags that end an unclosed element in the same scope, when either
+# opened or closed (e.g. a table cell ends at the next cell, or with its row).
+IMPLIED_END_BY = {
+	'td'     : ('th', 'tr'),
+	'th'     : ('td', 'tr'),
+}
+
+# The rest of an opening or closing tag. Quoted attribute values may contain `>`.
+TAG_REST = r"""\b(?:[^>"']|"[^"]*"|'[^']*')*>"""
+
+
+def strain(content, tag, where=None, first=False):
+	'''
+	SoupStrainer-style pre-filter for raw page text.
+
+	Returns the source of every `tag` element whose opening tag matches the
+	regex `where` (or every `tag` element, if `where` is None), so only those
+	fragments ever have to be handed to a parser. Nested elements of the same
+	name are balanced (including unclosed ones, see IMPLIED_END_TAGS).
+	Elements that are never closed run to the end of the content, and the
+	parser is left to recover.
+
+	This is a text scan, not a parser, so it's only meant for locating a
+	well-known element (a listing table, a set of rows) on a known page.
+	'''
+	tag      = tag.lower()
+	scopes   = IMPLIED_END_TAGS.get(tag, ())
+	enders   = IMPLIED_END_BY.get(tag, ())
+	open_re  = re.compile(r"<{tag}".format(tag=tag) + TAG_REST, re.IGNORECASE)
+	tok_re   = re.compile(r"<(/?)({names})".format(names="|".join((tag, ) + scopes + enders)) + TAG_REST, re.IGNORECASE)
+	where_re = re.compile(where, re.IGNORECASE) if where else None
+
+	ret = []
+	pos = 0
+	while True:
+		match = open_re.search(content, pos)
+		if not match:
+			break
+		if where_re and not where_re.search(match.group(0)):
+			pos = match.end()
+			continue
+
+		end = len(content)
+
+		# The scope depth each open `tag` element was opened at, and the current scope depth,
+		# relative to the element being strained.
+		open_elements = []
+		scope = 0
+		for tok in tok_re.finditer(content, match.start()):
+			closing, name = tok.group(1), tok.group(2).lower()
+
+			if name in enders:
+				if open_elements and open_elements[-1] == scope:
+					open_elements.pop()
+					if not open_elements:
+						end = tok.start()
+						break
+
+			elif name != tag:
+				if not closing:
+					scope += 1
+					continue
+				# The scope closes any elements that were left open in it.
+				scope -= 1
+				while open_elements and open_elements[-1] > scope:
+					open_elements.pop()
+				if not open_elements:
+					end = tok.start()
+					break
+
+			elif closing:
+				open_elements.pop()
+				if not open_elements:
+					end = tok.end()
+					break
+
+			elif tok.group(0).endswith("/>"):
+				if not open_elements:
+					end = tok.end()
+					break
+
+			else:
+				if tag in IMPLIED_END_TAGS and open_elements and open_elements[-1] == scope:
+					open_elements.pop()
+					if not open_elements:
+						end = tok.start()
+						break
+				open_elements.append(scope)
+
+		ret.append(content[match.start():end])
+		if first:
+			break
+		pos = end
+
+	return ret
+
+def parse_html(content):
+	assert isinstance(content, str), "parse_html() needs decoded content, received %s" % type(content)
+	return lxml.html.fromstring(content)
+
+def parse_fragments(fragments, wrapper="div"):
+	'''
+	Parse a list of strain()ed fragments into a single tree, under a
+	`wrapper` element.
+	'''
+	return parse_html("<{wrapper}>{content}</{wrapper}>".format(wrapper=wrapper, content="".join(fragments)))
+
+def get_text(element, strip=False):
+	'''
+	Equivalent of bs4's Tag.get_text(), including the `strip` behaviour.
+	'''
+	if strip:
+		return "".join(chunk.strip() for chunk in element.itertext())
+	return "".join(element.itertext())
+
+def css(element, selector):
+	return element.cssselect(selector)
+
+def css_first(element, selector):
+	found = element.cssselect(selector)
+	return found[0] if found else None
+
+def xpath_first(element, path):
+	found = element.xpath(path)
+	return found[0] if found else None
+
+
+class ParseMixin(object):
+	'''
+	Fast-path parsing on lxml, for the pages where building a full
+	BeautifulSoup tree is the bulk of the work. Requires `self.wg`.
+	'''
+
+	strain          = staticmethod(strain)
+	parse_html      = staticmethod(parse_html)
+	parse_fragments = staticmethod(parse_fragments)
+	get_text        = staticmethod(get_text)
+	css             = staticmethod(css)
+	css_first       = staticmethod(css_first)
+	xpath_first     = staticmethod(xpath_first)
+
+	def _get_text_page(self, url, **kwargs):
+		page = self.wg.getpage(url, **kwargs)
+		if isinstance(page, bytes):
+			raise WebRequest.ContentTypeError("Received content not decoded! Cannot parse!", url)
+		return page
+
+	def get_etree(self, url, **kwargs):
+		return parse_html(self._get_text_page(url, **kwargs))
+
+	def get_strained(self, url, tag, where=None, first=False, **kwargs):
+		'''
+		Fetch `url`, and parse only the `tag` elements matching `where`
+		(see strain()). Returns None if there were no matching elements.
+		'''
+		fragments = strain(self._get_text_page(url, **kwargs), tag, where, first)
+		if not fragments:
+			return None
+		return parse_fragments(fragments)
@@ -0,0 +1,88 @@
+'''
+What's known about a file on disk, worked out once and passed along.
+
+A freshly downloaded archive goes through the retriever, processDownload(),
+the ArchCleaner and then the ArchChecker, and each of those used to stat,
+sniff (with libmagic) or md5 the file again for itself. A FileIdentity
+carries the answers from one stage to the next instead.
+
+The size and mtime are read when the identity is made. The mime type and
+md5 are only worked out the first time they're asked for (unless the
+creator already knows them, e.g. the md5 computed while the file was being
+written), and are then kept.
+'''
+
+import os
+import os.path
+import hashlib
+import threading
+
+import magic
+
+# Read size for hashing files.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FileIdentity(object):
+
+	def __init__(self, path, md5=None, mime=None):
+		self.path = os.path.abspath(path)
+
+		stat = os.stat(self.path)
+		self.size  = stat.st_size
+		self.mtime = stat.st_mtime_ns
+
+		self._md5  = md5
+		self._mime = mime
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return "<FileIdentity %r, %s bytes, mime %r, md5 %r>" % (self.path, self.size, self._mime, self._md5)
+
+	@property
+	def mime(self):
+		with self._lock:
+			if self._mime is None:
+				self._mime = magic.from_file(self.path, mime=True)
+			return self._mime
+
+	@property
+	def md5(self):
+		with self._lock:
+			if self._md5 is None:
+				hash_md5 = hashlib.md5()
+				with open(self.path, "rb") as fp:
+					for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+						hash_md5.update(chunk)
+				self._md5 = hash_md5.hexdigest()
+			return self._md5
+
+	def is_current(self):
+		'''
+		Is the file at `path` still the one this identity describes?
+		'''
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return False
+		return stat.st_size == self.size and stat.st_mtime_ns == self.mtime
+
+	def rewritten(self, path=None):
+		'''
+		Identity for the file after it was rewritten as the same type of file
+		(in place, or at `path`). The mime type is carried over, the md5 isn't.
+		'''
+		return FileIdentity(path or self.path, mime=self._mime)
+
+
+def identify(path_or_identity):
+	'''
+	Return a FileIdentity for `path_or_identity`, which can be a path or an
+	existing FileIdentity. An existing identity is passed straight through,
+	unless the file has changed since it was made.
+	'''
+	if isinstance(path_or_identity, FileIdentity):
+		if path_or_identity.is_current():
+			return path_or_identity
+		return FileIdentity(path_or_identity.path)
+	return FileIdentity(path_or_identity)
@@ -0,0 +1,31 @@
+'''
+Names for "this process", for recording who owns something that several
+scraper processes (possibly on several machines) share, such as a claimed
+release row or a staging directory.
+'''
+
+import os
+import socket
+
+
+def process_owner():
+	'''
+	Name of the current process, as `hostname:pid`.
+	'''
+	return "%s:%s" % (socket.gethostname(), os.getpid())
+
+def owner_is_dead(owner):
+	'''
+	Is `owner` (as returned by process_owner()) a process on this machine that's no longer running?
+	Owners on other machines can't be checked, so they're never considered dead.
+	'''
+	host, _, pid = owner.rpartition(":")
+	if host != socket.gethostname() or not pid.isdigit():
+		return False
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return True
+	except PermissionError:
+		pass
+	return False
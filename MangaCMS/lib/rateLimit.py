@@ -0,0 +1,151 @@
+
+import time
+import logging
+import urllib.parse
+
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+
+import runStatus
+import settings
+
+import MangaCMS.db as db
+from MangaCMS.db.db_engine import engine
+
+log = logging.getLogger("Main.RateLimit")
+
+# host -> (rate, burst), or None. Settings don't change at runtime, so each
+# host is only looked up once per process.
+_host_limits = {}
+
+def host_for_url(url):
+	host = urllib.parse.urlsplit(url).hostname or ''
+	return host.lower()
+
+def limits_for_host(host):
+	'''
+	Look up the (rate, burst) configured for `host` in settings.hostRateLimits.
+
+	An entry for "example.org" also covers any subdomain of it
+	("i.example.org"), with the most specific entry winning. Returns None if
+	the host isn't limited.
+	'''
+	if host not in _host_limits:
+		_host_limits[host] = _lookup_limits(host)
+	return _host_limits[host]
+
+def _lookup_limits(host):
+	limits = getattr(settings, 'hostRateLimits', {})
+	parts = host.split(".")
+	for idx in range(len(parts)):
+		conf = limits.get(".".join(parts[idx:]))
+		if conf:
+			return conf['rate'], conf.get('burst', 1)
+	return None
+
+def _reserve_tokens(host, rate, burst, count=1):
+	'''
+	Take `count` tokens from the shared bucket for `host`, in one round
+	trip, and return how many seconds the caller has to wait before it may
+	use each of them.
+
+	The bucket lives in the `host_rate_limit` table, so every process (and
+	every thread) talking to the same host draws from the same bucket. The
+	token is reserved up front (the bucket is allowed to go negative), so
+	concurrent callers queue up behind each other rather then all waking up
+	at once and racing for the next token.
+
+	This deliberately uses its own connection, so it never commits (or
+	rolls back) the calling thread's session.
+	'''
+	table = db.HostRateLimit.__table__
+
+	with engine.connect().execution_options(isolation_level='READ COMMITTED') as conn:
+		with conn.begin():
+			conn.execute(
+					insert(table)
+					.values(host=host, tokens=burst, updated_at=func.clock_timestamp())
+					.on_conflict_do_nothing(index_elements=['host'])
+				)
+
+			tokens, elapsed = conn.execute(
+					select([table.c.tokens, func.extract('epoch', func.clock_timestamp() - table.c.updated_at)])
+					.where(table.c.host == host)
+					.with_for_update()
+				).fetchone()
+
+			tokens = min(burst, tokens + float(elapsed) * rate)
+
+			conn.execute(
+					update(table)
+					.where(table.c.host == host)
+					.values(tokens=tokens - count, updated_at=func.clock_timestamp())
+				)
+
+	# Token n (1-based) becomes available once the bucket has refilled to n.
+	return [max(0, (idx - tokens) / rate) for idx in range(1, count + 1)]
+
+def _wait(host, delay):
+	if delay <= 0:
+		return True
+
+	log.info("Rate limiting requests to %s. Sleeping %0.1f seconds.", host, delay)
+	deadline = time.time() + delay
+	while time.time() < deadline:
+		time.sleep(min(1, deadline - time.time()))
+		if not runStatus.run:
+			log.info("Breaking due to exit flag being set")
+			return False
+	return True
+
+
+def acquire(url):
+	'''
+	Block until a request to `url` is allowed by the per-host limit in
+	settings.hostRateLimits. Hosts without an entry return immediately,
+	without touching the database.
+
+	Returns False if the wait was interrupted by the exit flag, True
+	otherwise.
+	'''
+	host = host_for_url(url)
+	conf = limits_for_host(host)
+	if not conf:
+		return True
+
+	rate, burst = conf
+	delay, = _reserve_tokens(host, rate, burst)
+	return _wait(host, delay)
+
+def reserve(urls):
+	'''
+	Reserve a token for every url in `urls` up front, with one round trip
+	per limited host rather then one per url.
+
+	Returns a list of deadlines (as time.time() values), one per url, to be
+	passed to wait_until() right before each request is made. Urls on hosts
+	without a limit get a deadline of 0.
+	'''
+	by_host = {}
+	for idx, url in enumerate(urls):
+		by_host.setdefault(host_for_url(url), []).append(idx)
+
+	now = time.time()
+	deadlines = [0] * len(urls)
+	for host, indices in by_host.items():
+		conf = limits_for_host(host)
+		if not conf:
+			continue
+		rate, burst = conf
+		for idx, delay in zip(indices, _reserve_tokens(host, rate, burst, len(indices))):
+			deadlines[idx] = now + delay
+	return deadlines
+
+def wait_until(url, deadline):
+	'''
+	Sleep until `deadline` (from reserve()). Returns False if the wait was
+	interrupted by the exit flag, True otherwise.
+	'''
+	return _wait(host_for_url(url), deadline - time.time())
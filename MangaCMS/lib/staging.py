@@ -0,0 +1,258 @@
+'''
+Scratch space for files that are still being written.
+
+Downloads, freshly packed image sets and archive rewrites are all built in
+the staging directory (settings.stagingDir), and only moved into the library
+once they're complete, with a single os.rename(). Anything that looks at the
+library (the DirNameProxy observers, the importer and cleaner utilities)
+therefore only ever sees finished files, and a crash leaves its debris in the
+staging directory rather then next to real content.
+
+Several scraper processes (on one or more machines) can share the staging
+directory. Each process keeps its temporary files in a subdirectory of its
+own (named for its process_owner()), which is only ever cleared out once that
+process is known to be dead. Resumable downloads are shared, so any process
+can pick up an interrupted one, and are locked (with flock()) while in use.
+
+For the rename to be atomic, settings.stagingDir has to be on the same
+filesystem as the download directories. If it isn't, promote() still works,
+but has to fall back to a copy (into a hidden file beside the target, which
+is then renamed into place).
+'''
+
+import os
+import os.path
+import time
+import json
+import fcntl
+import errno
+import shutil
+import logging
+import tempfile
+import contextlib
+
+import settings
+import MangaCMS.lib.processOwner as processOwner
+
+log = logging.getLogger("Main.Staging")
+
+# Suffixes of the two kinds of staging entries. Resumable downloads
+# (see RetreivalBase.download_to_staging()) are a ".part" file, with the
+# information needed to resume them in a ".json" file of the same name,
+# in the shared downloads directory.
+# Everything else (image sets, archive rewrites, finished downloads) is a
+# ".tmp" file in the directory of the process that made it.
+PART_SUFFIX = ".part"
+META_SUFFIX = ".json"
+TEMP_SUFFIX = ".tmp"
+
+DOWNLOADS_DIR = "downloads"
+
+# How long an interrupted download is kept around for a later resume.
+RESUME_MAX_AGE = 60 * 60 * 24 * 2
+
+
+def get_staging_dir():
+	staging_dir = getattr(settings, 'stagingDir', None)
+	if not staging_dir:
+		staging_dir = os.path.join(tempfile.gettempdir(), "MangaCMS-staging")
+	os.makedirs(staging_dir, exist_ok=True)
+	return staging_dir
+
+def get_process_dir():
+	'''
+	This process's own directory in the staging area.
+	'''
+	process_dir = os.path.join(get_staging_dir(), processOwner.process_owner())
+	os.makedirs(process_dir, exist_ok=True)
+	return process_dir
+
+def get_downloads_dir():
+	downloads_dir = os.path.join(get_staging_dir(), DOWNLOADS_DIR)
+	os.makedirs(downloads_dir, exist_ok=True)
+	return downloads_dir
+
+def new_temp_path(suffix=TEMP_SUFFIX):
+	'''
+	Create a new, empty, uniquely named file in this process's staging
+	directory, and return its path.
+	'''
+	fd, path = tempfile.mkstemp(dir=get_process_dir(), suffix=suffix)
+	os.close(fd)
+	return path
+
+def download_paths(key):
+	'''
+	Return the (content, metadata) paths for resumable download `key`.
+	'''
+	base = os.path.join(get_downloads_dir(), key)
+	return base + PART_SUFFIX, base + META_SUFFIX
+
+@contextlib.contextmanager
+def download_lock(staged_path):
+	'''
+	Hold an exclusive lock on resumable download `staged_path` (creating it,
+	if needed), waiting for any other process using it to finish.
+
+	The lock is taken on the ".part" content file, and covers its metadata
+	file as well, since that is replaced (rather then rewritten) on each save.
+	A download can only be resumed, written, detached or discarded with the
+	lock held.
+	'''
+	while True:
+		fd = os.open(staged_path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				log.info("Download '%s' is in use by another process. Waiting for it.", staged_path)
+				fcntl.flock(fd, fcntl.LOCK_EX)
+
+			# Whoever held the lock may have moved or deleted the file, in
+			# which case the lock is on a file that's no longer the download.
+			try:
+				current = os.stat(staged_path).st_ino == os.fstat(fd).st_ino
+			except FileNotFoundError:
+				current = False
+
+			if current:
+				yield staged_path
+				return
+		finally:
+			os.close(fd)
+
+def detach_download(staged_path):
+	'''
+	Move the finished download `staged_path` (which must be locked, see
+	download_lock()) out of the shared downloads directory and into this
+	process's own, so nothing else can resume it. Returns the new path.
+	'''
+	new_path = new_temp_path()
+	os.replace(staged_path, new_path)
+	return new_path
+
+def load_download_meta(meta_path):
+	try:
+		with open(meta_path, "r") as fp:
+			return json.load(fp)
+	except (IOError, ValueError):
+		return None
+
+def save_download_meta(meta_path, meta):
+	tmp_path = meta_path + TEMP_SUFFIX
+	with open(tmp_path, "w") as fp:
+		json.dump(meta, fp)
+	os.replace(tmp_path, meta_path)
+
+def discard(*paths):
+	for path in paths:
+		if os.path.exists(path):
+			os.unlink(path)
+
+
+def promote(staged_path, fqfilename):
+	'''
+	Move `staged_path` to `fqfilename`, replacing anything already there.
+	On the same filesystem this is a single atomic rename.
+	'''
+	try:
+		os.replace(staged_path, fqfilename)
+		return
+
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+
+	# Different filesystem. Copy in beside the target, and then rename,
+	# so a partial copy is never visible under the real name.
+	filepath, fileN = os.path.split(fqfilename)
+	fd, tmp_path = tempfile.mkstemp(dir=filepath, prefix=".", suffix=TEMP_SUFFIX)
+	os.close(fd)
+	try:
+		shutil.copyfile(staged_path, tmp_path)
+		os.replace(tmp_path, fqfilename)
+	except BaseException:
+		discard(tmp_path)
+		raise
+	os.unlink(staged_path)
+
+
+def _recover_downloads(downloads_dir, now):
+	kept    = 0
+	removed = 0
+
+	# Metadata (and half-written metadata) files are dealt with along with their content file.
+	parts = set()
+	for fileN in os.listdir(downloads_dir):
+		if fileN.endswith(PART_SUFFIX):
+			parts.add(fileN[:-len(PART_SUFFIX)])
+
+	for key in parts:
+		staged_path = os.path.join(downloads_dir, key + PART_SUFFIX)
+		meta_path   = os.path.join(downloads_dir, key + META_SUFFIX)
+		try:
+			fd = os.open(staged_path, os.O_RDONLY)
+		except FileNotFoundError:
+			continue
+		try:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				# Being downloaded right now.
+				kept += 1
+				continue
+
+			age = now - os.fstat(fd).st_mtime
+			if os.path.exists(meta_path) and age < RESUME_MAX_AGE:
+				kept += 1
+				continue
+
+			log.info("Removing stale partial download '%s'", staged_path)
+			discard(staged_path, meta_path, meta_path + TEMP_SUFFIX)
+			removed += 1
+		finally:
+			os.close(fd)
+
+	# Metadata whose content file is gone. It's written after the content file
+	# is created, and removed before it's moved, so this is never in use.
+	for fileN in os.listdir(downloads_dir):
+		if fileN.endswith(PART_SUFFIX):
+			continue
+		key = fileN.split(".")[0]
+		if not os.path.exists(os.path.join(downloads_dir, key + PART_SUFFIX)):
+			log.info("Removing orphaned download metadata '%s'", fileN)
+			discard(os.path.join(downloads_dir, fileN))
+			removed += 1
+
+	return kept, removed
+
+def recover_staging():
+	'''
+	Clean up after any process that died while using the staging directory.
+	This is safe to run while other processes are using it.
+
+	The directories of processes on this machine that are no longer running
+	are deleted. Directories of processes on other machines are left alone,
+	since there's no way to tell if they're still running.
+
+	Interrupted downloads that are young enough to be worth resuming are kept,
+	and picked up by the next download_to_staging() call for the same URL
+	(from any process). Stale ones, and ones missing their metadata, are
+	deleted, unless they're being downloaded right now.
+	'''
+	staging_dir = get_staging_dir()
+	own_dir     = processOwner.process_owner()
+
+	dirs_removed = 0
+	for dirN in os.listdir(staging_dir):
+		if dirN in (DOWNLOADS_DIR, own_dir) or not os.path.isdir(os.path.join(staging_dir, dirN)):
+			continue
+		if processOwner.owner_is_dead(dirN):
+			log.info("Removing staging directory of dead process '%s'", dirN)
+			shutil.rmtree(os.path.join(staging_dir, dirN), ignore_errors=True)
+			dirs_removed += 1
+
+	kept, removed = _recover_downloads(get_downloads_dir(), time.time())
+
+	log.info("Staging directory recovery: %s dead process directories removed, %s resumable downloads kept, %s stale files removed.",
+			dirs_removed, kept, removed)
@@ -0,0 +1,216 @@
+'''
+Record/replay layer for WebRequest.WebGetRobust.
+
+Every request a WebGetRobust instance makes (getpage(), getSoup(), getJson(),
+getFileAndName(), and the streaming downloads in RetreivalBase) goes through
+its `opener`. install() wraps that opener, so in "record" mode each exchange
+is saved to disk as it happens, and in "replay" mode the saved exchanges are
+served back without touching the network.
+
+What's stored is the raw exchange (status, headers, and the body exactly as
+received, still compressed if it was), so a replayed page goes through
+WebGetRobust's normal decompression, decoding and WAF checks, just like a
+live one.
+
+Recordings are laid out as one pair of files per exchange:
+
+	{key}.{seq}.json    url, status, reason, headers and final (redirected) url
+	{key}.{seq}.body    the raw response body
+
+Where `key` is a hash of the method, url, post body and any conditional/range
+request headers, and `seq` counts repeated requests for the same key. When
+replaying, repeats are handed out in the order they were recorded, with the
+last one being reused once they run out.
+'''
+
+import io
+import os
+import os.path
+import json
+import time
+import hashlib
+import logging
+import threading
+import email.parser
+import http.client
+import urllib.error
+import urllib.response
+
+log = logging.getLogger("Main.WebRecorder")
+
+# Request headers that change what the server sends back, and so have to be part of the key.
+KEY_HEADERS = ['If-None-Match', 'If-Modified-Since', 'If-Range', 'Range']
+
+
+def _parse_headers(header_text):
+	return email.parser.Parser(_class=http.client.HTTPMessage).parsestr(header_text)
+
+
+class HttpRecorder(object):
+	'''
+	Storage for recorded exchanges, shared by any number of openers (and threads).
+	Also keeps count of the requests and bytes it's handled, and the time spent
+	waiting on them.
+	'''
+
+	def __init__(self, record_dir, mode):
+		assert mode in ("record", "replay"), "Recorder mode must be 'record' or 'replay', not '%s'" % mode
+		self.record_dir = record_dir
+		self.mode       = mode
+
+		self.lock      = threading.Lock()
+		self.sequence  = {}
+
+		self.requests  = 0
+		self.misses    = 0
+		self.bytes     = 0
+		self.wait_time = 0.0
+
+		if mode == "record":
+			os.makedirs(record_dir, exist_ok=True)
+		elif not os.path.isdir(record_dir):
+			raise ValueError("No recordings at '%s'!" % record_dir)
+
+	def request_key(self, request):
+		key = hashlib.sha1()
+		key.update(request.get_method().encode("utf-8"))
+		key.update(request.get_full_url().encode("utf-8"))
+		if request.data:
+			key.update(request.data if isinstance(request.data, bytes) else str(request.data).encode("utf-8"))
+		for header in KEY_HEADERS:
+			if request.has_header(header.capitalize()):
+				key.update(("%s: %s" % (header, request.get_header(header.capitalize()))).encode("utf-8"))
+		return key.hexdigest()
+
+	def _paths(self, key, seq):
+		base = os.path.join(self.record_dir, "%s.%s" % (key, seq))
+		return base + ".json", base + ".body"
+
+	def _next_seq(self, key):
+		with self.lock:
+			seq = self.sequence.get(key, 0)
+			self.sequence[key] = seq + 1
+			self.requests += 1
+			return seq
+
+	def save(self, request, meta, body):
+		key = self.request_key(request)
+		seq = self._next_seq(key)
+		meta_path, body_path = self._paths(key, seq)
+
+		meta['request_url'] = request.get_full_url()
+		meta['method']      = request.get_method()
+		with open(body_path, "wb") as fp:
+			fp.write(body)
+		with open(meta_path, "w") as fp:
+			json.dump(meta, fp, indent=4)
+
+		with self.lock:
+			self.bytes += len(body)
+
+	def load(self, request):
+		'''
+		Return the (meta, body) recorded for `request`, or None if there isn't one.
+		'''
+		key = self.request_key(request)
+		seq = self._next_seq(key)
+
+		while seq >= 0:
+			meta_path, body_path = self._paths(key, seq)
+			if os.path.exists(meta_path):
+				break
+			seq -= 1
+		else:
+			with self.lock:
+				self.misses += 1
+			return None
+
+		with open(meta_path, "r") as fp:
+			meta = json.load(fp)
+		with open(body_path, "rb") as fp:
+			body = fp.read()
+
+		with self.lock:
+			self.bytes += len(body)
+		return meta, body
+
+
+class RecordingOpener(object):
+	'''
+	Stand-in for the urllib OpenerDirector inside a WebGetRobust instance.
+	'''
+
+	def __init__(self, opener, recorder):
+		self.opener   = opener
+		self.recorder = recorder
+
+	def __getattr__(self, name):
+		# Anything else (addheaders, handlers) is the real opener's.
+		return getattr(self.opener, name)
+
+	def _response(self, meta, body):
+		headers = _parse_headers(meta['headers'])
+		if meta.get('code', 200) >= 400 or meta.get('code') == 304:
+			raise urllib.error.HTTPError(meta['url'], meta['code'], meta['reason'], headers, io.BytesIO(body))
+		return urllib.response.addinfourl(io.BytesIO(body), headers, meta['url'], meta['code'])
+
+	def open(self, request, data=None, timeout=None):
+		assert not isinstance(request, str), "The recording opener only handles Request objects"
+
+		start = time.time()
+		try:
+			if self.recorder.mode == "replay":
+				return self._replay(request)
+			return self._record(request, data, timeout)
+		finally:
+			with self.recorder.lock:
+				self.recorder.wait_time += time.time() - start
+
+	def _replay(self, request):
+		recorded = self.recorder.load(request)
+		if recorded is None:
+			log.warning("No recording for %s %s", request.get_method(), request.get_full_url())
+			raise urllib.error.URLError("No recorded response for '%s'" % request.get_full_url())
+
+		meta, body = recorded
+		if 'error' in meta:
+			raise urllib.error.URLError(meta['error'])
+		return self._response(meta, body)
+
+	def _record(self, request, data, timeout):
+		try:
+			handle = self.opener.open(request, data, timeout)
+
+		except urllib.error.HTTPError as e:
+			body = e.read() if e.fp else b''
+			meta = {'url' : e.geturl() or request.get_full_url(), 'code' : e.code, 'reason' : str(e.reason), 'headers' : str(e.hdrs)}
+			self.recorder.save(request, meta, body)
+			return self._response(meta, body)
+
+		except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+			self.recorder.save(request, {'error' : str(e)}, b'')
+			raise
+
+		# The whole body has to be read to save it, so streamed downloads
+		# are held in memory while recording (but not when replaying).
+		with handle:
+			body = handle.read()
+			meta = {'url' : handle.geturl(), 'code' : handle.getcode(), 'reason' : getattr(handle, 'reason', ''), 'headers' : str(handle.info())}
+		self.recorder.save(request, meta, body)
+		return self._response(meta, body)
+
+
+def install(wg, recorder):
+	'''
+	Route all of `wg`'s (a WebGetRobust instance) requests through `recorder`.
+	When replaying, the retry delay is also dropped, so a recorded failure
+	doesn't stall the run.
+	'''
+	if not isinstance(wg.opener, RecordingOpener):
+		wg.opener = RecordingOpener(wg.opener, recorder)
+	else:
+		wg.opener.recorder = recorder
+
+	if recorder.mode == "replay":
+		wg.retryDelay = 0
+	return wg
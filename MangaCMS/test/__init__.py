@@ -1,2 +1,5 @@
 
 from . import duper_test
+from . import truncating_test
+from . import strain_test
+from . import archcleaner_test
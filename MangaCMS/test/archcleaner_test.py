@@ -0,0 +1,81 @@
+
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import MangaCMS.cleaner.archCleaner as archCleaner
+
+# An extended timestamp record, which has to survive the copy.
+TIMESTAMP_EXTRA = struct.pack("<HHBL", 0x5455, 5, 1, 1500000000)
+
+class TestCopyRawMember(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmpdir)
+
+		# _copy_raw_member() doesn't need the bad image index the constructor loads.
+		self.cleaner = archCleaner.ArchCleaner.__new__(archCleaner.ArchCleaner)
+
+		self.contents = {
+			"stored.txt"   : b"stored " * 500,
+			"deflated.txt" : b"deflated " * 500,
+			"zip64.txt"    : b"zip64 " * 500,
+		}
+
+		self.src_path = os.path.join(self.tmpdir, "src.zip")
+		with zipfile.ZipFile(self.src_path, "w") as zfp:
+			zfp.writestr(zipfile.ZipInfo("stored.txt"), self.contents["stored.txt"], compress_type=zipfile.ZIP_STORED)
+			zfp.writestr(zipfile.ZipInfo("deflated.txt"), self.contents["deflated.txt"], compress_type=zipfile.ZIP_DEFLATED)
+
+			# A zip64 record the member doesn't need (as some archivers always write), with
+			# the old archive's sizes in it.
+			info = zipfile.ZipInfo("zip64.txt")
+			info.extra = struct.pack("<HHQQ", archCleaner.ZIP64_EXTRA_ID, 16, 3000, 3000) + TIMESTAMP_EXTRA
+			zfp.writestr(info, self.contents["zip64.txt"], compress_type=zipfile.ZIP_DEFLATED)
+
+	def copy_all(self):
+		dst_path = os.path.join(self.tmpdir, "dst.zip")
+		with zipfile.ZipFile(self.src_path, "r") as old_zfp, open(self.src_path, "rb") as old_fp, zipfile.ZipFile(dst_path, "w") as new_zfp:
+			for info in old_zfp.infolist():
+				self.cleaner._copy_raw_member(old_fp, info, new_zfp)
+		return dst_path
+
+	def test_round_trip(self):
+		dst_path = self.copy_all()
+
+		with zipfile.ZipFile(dst_path, "r") as zfp:
+			self.assertIsNone(zfp.testzip())
+			self.assertEqual(sorted(zfp.namelist()), sorted(self.contents.keys()))
+			for name, content in self.contents.items():
+				self.assertEqual(zfp.read(name), content)
+
+			self.assertEqual(zfp.getinfo("stored.txt").compress_type, zipfile.ZIP_STORED)
+			self.assertEqual(zfp.getinfo("deflated.txt").compress_type, zipfile.ZIP_DEFLATED)
+
+	def test_zip64_extra_stripped(self):
+		dst_path = self.copy_all()
+
+		with zipfile.ZipFile(dst_path, "r") as zfp:
+			extra = zfp.getinfo("zip64.txt").extra
+		self.assertEqual(extra, TIMESTAMP_EXTRA)
+
+		# The local header's extra field too.
+		with open(dst_path, "rb") as fp, zipfile.ZipFile(dst_path, "r") as zfp:
+			info = zfp.getinfo("zip64.txt")
+			fp.seek(info.header_offset)
+			fields = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+			fp.seek(fields[zipfile._FH_FILENAME_LENGTH], os.SEEK_CUR)
+			self.assertEqual(fp.read(fields[zipfile._FH_EXTRA_FIELD_LENGTH]), TIMESTAMP_EXTRA)
+
+	def test_strip_zip64_extra(self):
+		zip64 = struct.pack("<HHQ", archCleaner.ZIP64_EXTRA_ID, 8, 1234)
+		self.assertEqual(archCleaner._strip_zip64_extra(b""), b"")
+		self.assertEqual(archCleaner._strip_zip64_extra(zip64), b"")
+		self.assertEqual(archCleaner._strip_zip64_extra(TIMESTAMP_EXTRA + zip64), TIMESTAMP_EXTRA)
+		self.assertEqual(archCleaner._strip_zip64_extra(zip64 + TIMESTAMP_EXTRA), TIMESTAMP_EXTRA)
+
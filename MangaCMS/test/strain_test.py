@@ -0,0 +1,57 @@
+
+
+import unittest
+
+from MangaCMS.lib.ParseMixin import strain
+
+class TestStrain(unittest.TestCase):
+
+	def test_nested_li(self):
+		content = "<ul><li>a<ul><li>b<li>c</ul><li>d</ul>"
+		self.assertEqual(strain(content, "li"), ["<li>a<ul><li>b<li>c</ul>", "<li>d"])
+
+	def test_nested_p(self):
+		# A new <p> always ends the open one, since <p> has no scope.
+		content = "<div><p>a<p>b</p><p class='x'>c</div>"
+		self.assertEqual(strain(content, "p"), ["<p>a", "<p>b</p>", "<p class='x'>c</div>"])
+
+	def test_nested_td(self):
+		content = "<table><tr><td>a<table><tr><td>b<td>c</table><td>d</tr></table>"
+		self.assertEqual(strain(content, "td"), ["<td>a<table><tr><td>b<td>c</table>", "<td>d"])
+		self.assertEqual(strain(content, "td", first=True), ["<td>a<table><tr><td>b<td>c</table>"])
+
+		# Cells also end at the next header cell, or the next row.
+		content = "<table><tr><td>a<th>b<tr><td>c</table>"
+		self.assertEqual(strain(content, "td"), ["<td>a", "<td>c"])
+
+	def test_nested_same_tag(self):
+		content = "<div class='outer'><div>a</div><div>b</div></div><div>c</div>"
+		self.assertEqual(strain(content, "div", where="outer"), ["<div class='outer'><div>a</div><div>b</div></div>"])
+
+	def test_unclosed_ancestors(self):
+		# The <li>s are closed by their list, and the list by nothing at all.
+		content = "<div><ul><li>a<li>b</ul><p>c"
+		self.assertEqual(strain(content, "li"), ["<li>a", "<li>b"])
+
+		# An element whose ancestors are never closed runs to the end.
+		content = "<div><div class='x'><span>a"
+		self.assertEqual(strain(content, "div", where="x"), ["<div class='x'><span>a"])
+
+	def test_unclosed_rows(self):
+		content = "<table><tr><td>a<tr><td>b</table><p>c"
+		self.assertEqual(strain(content, "tr"), ["<tr><td>a", "<tr><td>b"])
+
+	def test_attribute_containing_gt(self):
+		content = '<div title="a > b" class="x">a</div><div data-q=\'>\'>b</div>'
+		self.assertEqual(strain(content, "div", where="class=.x"), ['<div title="a > b" class="x">a</div>'])
+		self.assertEqual(strain(content, "div"), ['<div title="a > b" class="x">a</div>', "<div data-q='>'>b</div>"])
+
+	def test_where_and_first(self):
+		content = "<a href='1'>a</a><a href='2' class='x'>b</a><a class='x'>c</a>"
+		self.assertEqual(strain(content, "a", where="class='x'", first=True), ["<a href='2' class='x'>b</a>"])
+		self.assertEqual(strain(content, "span"), [])
+
+	def test_self_closing(self):
+		content = "<div/><div>a</div>"
+		self.assertEqual(strain(content, "div"), ["<div/>", "<div>a</div>"])
+
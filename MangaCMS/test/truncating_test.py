@@ -0,0 +1,62 @@
+
+
+import os
+import errno
+import shutil
+import logging
+import tempfile
+import unittest
+import unittest.mock
+
+import MangaCMS.ScrapePlugins.RetreivalBase as RetreivalBase
+
+class StubLoader(object):
+	log = logging.getLogger("Main.Test.Truncating")
+
+	_promote_truncating = RetreivalBase.RetreivalBase._promote_truncating
+
+class TestPromoteTruncating(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmpdir)
+
+		self.staged_path = os.path.join(self.tmpdir, "staged.tmp")
+		with open(self.staged_path, "wb") as fp:
+			fp.write(b"archive contents")
+
+		self.loader = StubLoader()
+
+	def test_short_name(self):
+		fqfilename = os.path.join(self.tmpdir, "short.zip")
+		self.assertEqual(self.loader._promote_truncating(self.staged_path, fqfilename), fqfilename)
+		self.assertFalse(os.path.exists(self.staged_path))
+
+	def test_overlong_name(self):
+		# Longer then any common filesystem allows (255 bytes).
+		fqfilename = os.path.join(self.tmpdir, "a" * 300 + ".zip")
+
+		final = self.loader._promote_truncating(self.staged_path, fqfilename)
+
+		self.assertNotEqual(final, fqfilename)
+		self.assertEqual(os.path.dirname(final), self.tmpdir)
+		self.assertTrue(os.path.basename(final).endswith(".zip"))
+		self.assertLessEqual(len(os.path.basename(final).encode("utf-8")), 255)
+		self.assertFalse(os.path.exists(self.staged_path))
+		with open(final, "rb") as fp:
+			self.assertEqual(fp.read(), b"archive contents")
+
+	def test_retries_only_on_name_errors(self):
+		fqfilename = os.path.join(self.tmpdir, "b" * 20 + ".zip")
+
+		for err in (errno.ENAMETOOLONG, errno.EINVAL):
+			with unittest.mock.patch.object(RetreivalBase.staging, "promote", side_effect=[OSError(err, "Bad name"), None]) as promote:
+				final = self.loader._promote_truncating(self.staged_path, fqfilename)
+			self.assertEqual(promote.call_count, 2)
+			self.assertLess(len(os.path.basename(final)), len(os.path.basename(fqfilename)))
+
+		with unittest.mock.patch.object(RetreivalBase.staging, "promote", side_effect=OSError(errno.EACCES, "Denied")) as promote:
+			with self.assertRaises(OSError):
+				self.loader._promote_truncating(self.staged_path, fqfilename)
+		self.assertEqual(promote.call_count, 1)
+
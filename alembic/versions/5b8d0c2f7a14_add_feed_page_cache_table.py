@@ -0,0 +1,48 @@
+"""Add feed page validator cache table
+
+Revision ID: 5b8d0c2f7a14
+Revises: e71b3f0a9c25
+Create Date: 2026-10-18 15:02:37.104388
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8d0c2f7a14'
+down_revision = 'e71b3f0a9c25'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.create_table('feed_page_cache',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('source_site', sa.Text(), nullable=False),
+    sa.Column('url', sa.Text(), nullable=False),
+    sa.Column('etag', sa.Text(), nullable=True),
+    sa.Column('last_modified', sa.Text(), nullable=True),
+    sa.Column('content_hash', sa.Text(), nullable=False),
+    sa.Column('last_checked', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_site', 'url')
+    )
+
+
+def downgrade():
+    op.drop_table('feed_page_cache')
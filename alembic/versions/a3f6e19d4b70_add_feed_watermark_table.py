@@ -0,0 +1,47 @@
+"""Add per-series feed watermark table
+
+Revision ID: a3f6e19d4b70
+Revises: 5b8d0c2f7a14
+Create Date: 2026-10-18 16:21:54.873105
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3f6e19d4b70'
+down_revision = '5b8d0c2f7a14'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.create_table('feed_watermark',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('source_site', sa.Text(), nullable=False),
+    sa.Column('series_url', sa.Text(), nullable=False),
+    sa.Column('newest_source_id', sa.Text(), nullable=False),
+    sa.Column('newest_posted_at', sa.DateTime(), nullable=False),
+    sa.Column('last_checked', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_site', 'series_url')
+    )
+
+
+def downgrade():
+    op.drop_table('feed_watermark')
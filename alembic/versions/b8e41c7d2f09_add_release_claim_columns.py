@@ -0,0 +1,44 @@
+"""Add release claim columns
+
+Revision ID: b8e41c7d2f09
+Revises: c4a9d2e6f183
+Create Date: 2026-10-18 11:27:53.604112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b8e41c7d2f09'
+down_revision = 'c4a9d2e6f183'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.add_column('hentai_releases', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+    op.add_column('hentai_releases', sa.Column('claimed_by', sa.Text(), nullable=True))
+    op.add_column('manga_releases', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+    op.add_column('manga_releases', sa.Column('claimed_by', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('manga_releases', 'claimed_by')
+    op.drop_column('manga_releases', 'claimed_at')
+    op.drop_column('hentai_releases', 'claimed_by')
+    op.drop_column('hentai_releases', 'claimed_at')
@@ -0,0 +1,44 @@
+"""Add partial index for new-item todo queries
+
+Revision ID: c4a9d2e6f183
+Revises: 1d6c79218b3e
+Create Date: 2026-10-18 10:12:41.207316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9d2e6f183'
+down_revision = '1d6c79218b3e'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.create_index('manga_releases_todo_idx', 'manga_releases',
+        ['source_site', sa.text('posted_at DESC')],
+        unique=False, postgresql_where=sa.text("state = 'new'"))
+    op.create_index('hentai_releases_todo_idx', 'hentai_releases',
+        ['source_site', sa.text('posted_at DESC')],
+        unique=False, postgresql_where=sa.text("state = 'new'"))
+
+
+def downgrade():
+    op.drop_index('hentai_releases_todo_idx', table_name='hentai_releases')
+    op.drop_index('manga_releases_todo_idx', table_name='manga_releases')
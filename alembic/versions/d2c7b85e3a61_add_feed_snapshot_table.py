@@ -0,0 +1,46 @@
+"""Add feed snapshot table
+
+Revision ID: d2c7b85e3a61
+Revises: a3f6e19d4b70
+Create Date: 2026-10-18 18:07:12.339420
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2c7b85e3a61'
+down_revision = 'a3f6e19d4b70'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.create_table('feed_snapshot',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('source_site', sa.Text(), nullable=False),
+    sa.Column('snapshot', sa.LargeBinary(), nullable=False),
+    sa.Column('entries', sa.Integer(), nullable=False),
+    sa.Column('last_checked', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_site')
+    )
+
+
+def downgrade():
+    op.drop_table('feed_snapshot')
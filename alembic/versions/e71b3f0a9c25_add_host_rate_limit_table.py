@@ -0,0 +1,43 @@
+"""Add shared per-host rate limit table
+
+Revision ID: e71b3f0a9c25
+Revises: b8e41c7d2f09
+Create Date: 2026-10-18 13:40:02.551870
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e71b3f0a9c25'
+down_revision = 'b8e41c7d2f09'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+import sqlalchemy_utils
+import sqlalchemy_jsonfield
+
+# Patch in knowledge of the citext type, so it reflects properly.
+from sqlalchemy.dialects.postgresql.base import ischema_names
+import citext
+import queue
+import datetime
+from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import TSVECTOR
+ischema_names['citext'] = citext.CIText
+
+
+
+def upgrade():
+    op.create_table('host_rate_limit',
+    sa.Column('host', sa.Text(), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('host')
+    )
+
+
+def downgrade():
+    op.drop_table('host_rate_limit')
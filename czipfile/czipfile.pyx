@@ -13,8 +13,33 @@ import stat
 import shutil
 import struct
 import binascii
+import threading
+import collections
+import concurrent.futures
 
 cimport cpython as python
+from libc.string cimport memset
+from libc.limits cimport UINT_MAX
+
+# zlib is used directly for the batch reads (ZipFile.readmany()), so whole
+# members can be inflated and checksummed without holding the GIL.
+cdef extern from "zlib.h" nogil:
+	ctypedef unsigned char Bytef
+	ctypedef unsigned int uInt
+	ctypedef unsigned long uLong
+	ctypedef struct z_stream:
+		Bytef *next_in
+		uInt avail_in
+		Bytef *next_out
+		uInt avail_out
+		uLong total_out
+	int Z_OK
+	int Z_STREAM_END
+	int Z_FINISH
+	int inflateInit2(z_stream *strm, int windowBits)
+	int inflate(z_stream *strm, int flush)
+	int inflateEnd(z_stream *strm)
+	uLong zlib_crc32 "crc32"(uLong crc, const Bytef *buf, uInt len)
 
 try:
 	import zlib # We may need its compression method
@@ -507,15 +532,9 @@ cdef class _ZipDecrypter:
 		self.key1 = (self.key1 * 134775813 + 1) & 4294967295UL
 		self.key2 = self._crc32((self.key1 >> 24) & 255, self.key2)
 
-	def __call__(self, data):
+	cdef void _decrypt(self, const unsigned char *data_s, unsigned char *ret_s, Py_ssize_t datalen) noexcept nogil:
 		cdef unsigned long k
-		cdef Py_ssize_t i, datalen
-		cdef char *data_s
-		cdef char *ret_s
-
-		python.PyBytes_AsStringAndSize(data, &data_s, &datalen)
-		ret = python.PyBytes_FromStringAndSize(NULL, datalen)
-		ret_s = python.PyBytes_AsString(ret)
+		cdef Py_ssize_t i
 		for 0 <= i < datalen:
 			k = self.key2 | 2
 			ret_s[i] = data_s[i] ^ (((k * (k^1)) >> 8) & 255);
@@ -528,6 +547,20 @@ cdef class _ZipDecrypter:
 			self.key1 = (self.key1 * 134775813 + 1) & 4294967295UL
 			self.key2 = ((self.key2 >> 8) & 0xFFFFFF) ^ self.crctable[(self.key2 ^ ((self.key1 >> 24) & 255)) & 0xFF]
 
+	def __call__(self, data):
+		cdef Py_ssize_t datalen
+		cdef char *data_s
+		cdef char *ret_s
+
+		python.PyBytes_AsStringAndSize(data, &data_s, &datalen)
+		ret = python.PyBytes_FromStringAndSize(NULL, datalen)
+		ret_s = python.PyBytes_AsString(ret)
+
+		# The key state is only touched by the thread using this decrypter, so the
+		# loop can run without the GIL (`data` and `ret` are kept alive by this frame).
+		with nogil:
+			self._decrypt(<const unsigned char *>data_s, <unsigned char *>ret_s, datalen)
+
 		return ret
 
 class LZMACompressor:
@@ -902,6 +935,76 @@ class ZipExtFile(io.BufferedIOBase):
 			super().close()
 
 
+cdef bytes _inflate_member(bytes data, Py_ssize_t size):
+	"""Inflate raw deflate stream `data`, which must come out to exactly
+	`size` bytes, without holding the GIL.
+	"""
+	cdef z_stream strm
+	cdef int ret
+	cdef char *data_s
+	cdef char *ret_s
+	cdef Py_ssize_t datalen
+
+	python.PyBytes_AsStringAndSize(data, &data_s, &datalen)
+	out = python.PyBytes_FromStringAndSize(NULL, size)
+	ret_s = python.PyBytes_AsString(out)
+
+	memset(&strm, 0, sizeof(z_stream))
+	with nogil:
+		ret = inflateInit2(&strm, -15)
+		if ret == Z_OK:
+			strm.next_in   = <Bytef *>data_s
+			strm.avail_in  = <uInt>datalen
+			strm.next_out  = <Bytef *>ret_s
+			strm.avail_out = <uInt>size
+			ret = inflate(&strm, Z_FINISH)
+			inflateEnd(&strm)
+
+	if ret != Z_STREAM_END or <Py_ssize_t>strm.total_out != size:
+		raise BadZipFile("Error %d while decompressing data" % ret)
+	return out
+
+cdef unsigned long _member_crc(bytes data):
+	cdef char *data_s
+	cdef Py_ssize_t datalen
+	cdef uLong crc
+
+	python.PyBytes_AsStringAndSize(data, &data_s, &datalen)
+	with nogil:
+		crc = zlib_crc32(0, <const Bytef *>data_s, <uInt>datalen)
+	return crc & 0xffffffff
+
+def _decode_member(zinfo, zd, data):
+	"""Decrypt (if `zd` is a decrypter), decompress and CRC check the
+	whole compressed content `data` of member `zinfo`.
+	"""
+	if len(data) != zinfo.compress_size - (12 if zd is not None else 0):
+		raise EOFError("Truncated data for file %r" % zinfo.filename)
+
+	if zd is not None:
+		data = zd(data)
+
+	if zinfo.compress_type == ZIP_STORED:
+		out = data
+	elif zinfo.compress_type == ZIP_DEFLATED and 0 < zinfo.file_size < UINT_MAX and len(data) < UINT_MAX:
+		out = _inflate_member(data, zinfo.file_size)
+	else:
+		# Anything else goes through the normal decompressors (which
+		# release the GIL themselves, for the larger reads).
+		decompressor = _get_decompressor(zinfo.compress_type)
+		out = decompressor.decompress(data)
+		if zinfo.compress_type == ZIP_DEFLATED:
+			out += decompressor.flush()
+
+	if len(out) < UINT_MAX:
+		crc = _member_crc(out)
+	else:
+		crc = crc32(out) & 0xffffffff
+	if len(out) != zinfo.file_size or crc != zinfo.CRC:
+		raise BadZipFile("Bad CRC-32 for file %r" % zinfo.filename)
+	return out
+
+
 class ZipFile:
 	""" Class with methods to open, read, write, close, list zip files.
 
@@ -1169,65 +1272,8 @@ class ZipFile:
 			else:
 				# Get info object for name
 				zinfo = self.getinfo(name)
-			zef_file.seek(zinfo.header_offset, 0)
-
-			# Skip the file header:
-			fheader = zef_file.read(sizeFileHeader)
-			if len(fheader) != sizeFileHeader:
-				raise BadZipFile("Truncated file header")
-			fheader = struct.unpack(structFileHeader, fheader)
-			if fheader[_FH_SIGNATURE] != stringFileHeader:
-				raise BadZipFile("Bad magic number for file header")
-
-			fname = zef_file.read(fheader[_FH_FILENAME_LENGTH])
-			if fheader[_FH_EXTRA_FIELD_LENGTH]:
-				zef_file.read(fheader[_FH_EXTRA_FIELD_LENGTH])
-
-			if zinfo.flag_bits & 0x20:
-				# Zip 2.7: compressed patched data
-				raise NotImplementedError("compressed patched data (flag bit 5)")
-
-			if zinfo.flag_bits & 0x40:
-				# strong encryption
-				raise NotImplementedError("strong encryption (flag bit 6)")
-
-			if zinfo.flag_bits & 0x800:
-				# UTF-8 filename
-				fname_str = fname.decode("utf-8")
-			else:
-				fname_str = fname.decode("cp437")
-
-			if fname_str != zinfo.orig_filename:
-				raise BadZipFile(
-					'File name in directory %r and header %r differ.'
-					% (zinfo.orig_filename, fname))
-
-			# check for encrypted flag & handle password
-			is_encrypted = zinfo.flag_bits & 0x1
-			zd = None
-			if is_encrypted:
-				if not pwd:
-					pwd = self.pwd
-				if not pwd:
-					raise RuntimeError("File %s is encrypted, password "
-									   "required for extraction" % name)
-
-				zd = _ZipDecrypter(pwd)
-				# The first 12 bytes in the cypher stream is an encryption header
-				#  used to strengthen the algorithm. The first 11 bytes are
-				#  completely random, while the 12th contains the MSB of the CRC,
-				#  or the MSB of the file time depending on the header type
-				#  and is used to check the correctness of the password.
-				header = zef_file.read(12)
-				h = zd(header[0:12])
-				if zinfo.flag_bits & 0x8:
-					# compare against the file type from extended local headers
-					check_byte = (zinfo._raw_time >> 8) & 0xff
-				else:
-					# compare against the CRC otherwise
-					check_byte = (zinfo.CRC >> 24) & 0xff
-				if h[11] != check_byte:
-					raise RuntimeError("Bad password for file", name)
+
+			zd = self._seek_member_data(zef_file, zinfo, pwd or self.pwd)
 
 			return ZipExtFile(zef_file, mode, zinfo, zd,
 							  close_fileobj=not self._filePassed)
@@ -1236,6 +1282,124 @@ class ZipFile:
 				zef_file.close()
 			raise
 
+	def _seek_member_data(self, zef_file, zinfo, pwd):
+		"""Check the local header of member `zinfo`, and leave `zef_file`
+		positioned at the start of its compressed data. Returns the
+		decrypter for the member, or None if it isn't encrypted.
+		"""
+		zef_file.seek(zinfo.header_offset, 0)
+
+		# Skip the file header:
+		fheader = zef_file.read(sizeFileHeader)
+		if len(fheader) != sizeFileHeader:
+			raise BadZipFile("Truncated file header")
+		fheader = struct.unpack(structFileHeader, fheader)
+		if fheader[_FH_SIGNATURE] != stringFileHeader:
+			raise BadZipFile("Bad magic number for file header")
+
+		fname = zef_file.read(fheader[_FH_FILENAME_LENGTH])
+		if fheader[_FH_EXTRA_FIELD_LENGTH]:
+			zef_file.read(fheader[_FH_EXTRA_FIELD_LENGTH])
+
+		if zinfo.flag_bits & 0x20:
+			# Zip 2.7: compressed patched data
+			raise NotImplementedError("compressed patched data (flag bit 5)")
+
+		if zinfo.flag_bits & 0x40:
+			# strong encryption
+			raise NotImplementedError("strong encryption (flag bit 6)")
+
+		if zinfo.flag_bits & 0x800:
+			# UTF-8 filename
+			fname_str = fname.decode("utf-8")
+		else:
+			fname_str = fname.decode("cp437")
+
+		if fname_str != zinfo.orig_filename:
+			raise BadZipFile(
+				'File name in directory %r and header %r differ.'
+				% (zinfo.orig_filename, fname))
+
+		# check for encrypted flag & handle password
+		is_encrypted = zinfo.flag_bits & 0x1
+		zd = None
+		if is_encrypted:
+			if not pwd:
+				raise RuntimeError("File %s is encrypted, password "
+								   "required for extraction" % zinfo.filename)
+
+			zd = _ZipDecrypter(pwd)
+			# The first 12 bytes in the cypher stream is an encryption header
+			#  used to strengthen the algorithm. The first 11 bytes are
+			#  completely random, while the 12th contains the MSB of the CRC,
+			#  or the MSB of the file time depending on the header type
+			#  and is used to check the correctness of the password.
+			header = zef_file.read(12)
+			h = zd(header[0:12])
+			if zinfo.flag_bits & 0x8:
+				# compare against the file type from extended local headers
+				check_byte = (zinfo._raw_time >> 8) & 0xff
+			else:
+				# compare against the CRC otherwise
+				check_byte = (zinfo.CRC >> 24) & 0xff
+			if h[11] != check_byte:
+				raise RuntimeError("Bad password for file", zinfo.filename)
+
+		return zd
+
+	def readmany(self, members=None, pwd=None, workers=None):
+		"""Generator yielding the contents of `members` (names or ZipInfo
+		objects, default all of them) as bytes, in the same order.
+
+		The compressed data of each member is read from the file one member
+		at a time, but decryption, decompression and the CRC check run on a
+		pool of `workers` threads (default: one per CPU). For deflated and
+		stored members all three are done without holding the GIL, so they
+		really do run in parallel. No more than twice `workers` members are
+		read ahead of the one being yielded, so only that many are ever
+		held in memory.
+		"""
+		if pwd and not isinstance(pwd, bytes):
+			raise TypeError("pwd: expected bytes, got %s" % type(pwd))
+		if not self.fp:
+			raise RuntimeError(
+				"Attempt to read ZIP archive that was already closed")
+
+		if members is None:
+			members = self.infolist()
+		zinfos = [member if isinstance(member, ZipInfo) else self.getinfo(member) for member in members]
+		pwd = pwd or self.pwd
+		workers = workers or os.cpu_count() or 1
+
+		if self._filePassed:
+			zef_file = self.fp
+		else:
+			zef_file = io.open(self.filename, 'rb')
+
+		lock = threading.Lock()
+		def read_member(zinfo):
+			with lock:
+				zd = self._seek_member_data(zef_file, zinfo, pwd)
+				data = zef_file.read(zinfo.compress_size - (12 if zd is not None else 0))
+			return _decode_member(zinfo, zd, data)
+
+		try:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+				pending = collections.deque()
+				try:
+					for zinfo in zinfos:
+						pending.append(pool.submit(read_member, zinfo))
+						if len(pending) >= workers * 2:
+							yield pending.popleft().result()
+					while pending:
+						yield pending.popleft().result()
+				finally:
+					for job in pending:
+						job.cancel()
+		finally:
+			if not self._filePassed:
+				zef_file.close()
+
 	def extract(self, member, path=None, pwd=None):
 		"""Extract a member from the archive to the current working directory,
 		   using its full name. Its file information is extracted as accurately
@@ -0,0 +1,27 @@
+'''
+Build script for the czipfile extension.
+
+Build it in place (so `import czipfile.czipfile` picks it up) with:
+
+	cd czipfile && python3 setup.py build_ext --inplace
+
+This needs cython, a C compiler, and the zlib headers (zlib1g-dev on debian/ubuntu).
+setuptools/installDeps.sh does this as part of setting up a new install.
+'''
+
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+extensions = [
+	Extension(
+			"czipfile",
+			["czipfile.pyx"],
+			libraries          = ["z"],
+			extra_compile_args = ["-O3"],
+		),
+]
+
+setup(
+	name        = "czipfile",
+	ext_modules = cythonize(extensions, compiler_directives={'language_level' : 3}),
+)
@@ -1,30 +1,103 @@
+'''
+Benchmark czipfile against the stdlib zipfile.
 
-import pyximport
-pyximport.install()
-import czipfile as zipfile
+Usage (from the repository root, after building czipfile, see setup.py):
+
+	python3 -m czipfile.test [zipfile] [password] [--workers=N] [--repeat=N]
+
+Reads every member of `zipfile` (decrypting with `password`, if given)
+with the stdlib zipfile, czipfile one member at a time, and czipfile's
+threaded ZipFile.readmany() on one and on N threads (default: one per CPU).
+The output of each is checked against the stdlib's.
+
+If no zipfile is given, a deflated test archive of image-sized members
+is generated. The stdlib can't write encrypted zips, so to time
+decryption, pass an encrypted archive (e.g. made with `zip -P`).
+'''
+
+import io
+import os
+import sys
+import time
+import random
+import zipfile
+import tempfile
+
+import czipfile.czipfile as czipfile
+
+# Generated archive: member count, and member size.
+TEST_MEMBERS     = 64
+TEST_MEMBER_SIZE = 2 * 1024 * 1024
+
+
+def make_test_zip(path):
+	# Partially compressible content (runs of random bytes), so inflate has some work to do.
+	rand = random.Random(0)
+	with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zfp:
+		for idx in range(TEST_MEMBERS):
+			content = io.BytesIO()
+			while content.tell() < TEST_MEMBER_SIZE:
+				content.write(bytes([rand.randrange(256)]) * rand.randrange(1, 8))
+				content.write(rand.getrandbits(8 * 64).to_bytes(64, "little"))
+			zfp.writestr("%04d.png" % idx, content.getvalue()[:TEST_MEMBER_SIZE])
+
+
+def read_stdlib(path, pwd, workers):
+	with zipfile.ZipFile(path, "r") as zfp:
+		return [zfp.read(info, pwd=pwd) for info in zfp.infolist()]
+
+def read_czipfile(path, pwd, workers):
+	with czipfile.ZipFile(path, "r") as zfp:
+		return [zfp.read(info, pwd=pwd) for info in zfp.infolist()]
+
+def read_czipfile_batch(path, pwd, workers):
+	with czipfile.ZipFile(path, "r") as zfp:
+		return list(zfp.readmany(pwd=pwd, workers=workers))
+
+
+def bench(func, path, pwd, workers, repeat):
+	best = None
+	for dummy_x in range(repeat):
+		start = time.perf_counter()
+		contents = func(path, pwd, workers)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, contents
 
-def pr(val):
-	print("Val", val, type(val))
 
 def go():
-	print("WAT?")
-	list(map(pr, b"watttt"))
-	old_zfp = zipfile.ZipFile("/media/Storage/Scripts/MangaCMS/czipfile/325.zip", "r")
-	old_zfp.setpassword(b"www.mangababy.com")
-	fileNs = old_zfp.namelist()
-	files = []
+	args  = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	flags = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
 
-	for fileInfo in fileNs:
+	workers = int(flags.get("workers", os.cpu_count() or 1))
+	repeat  = int(flags.get("repeat", 3))
+	pwd     = args[1].encode("utf-8") if len(args) > 1 else None
 
-		fctnt = old_zfp.open(fileInfo).read()
-		files.append((fileInfo, fctnt))
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		if args:
+			path = args[0]
+		else:
+			path = os.path.join(tmp_dir, "test.zip")
+			print("Generating test archive (%s members of %s bytes)" % (TEST_MEMBERS, TEST_MEMBER_SIZE))
+			make_test_zip(path)
+
+		runs = [
+			("stdlib zipfile",                            read_stdlib,         1),
+			("czipfile",                                  read_czipfile,       1),
+			("czipfile readmany(), 1 thread",             read_czipfile_batch, 1),
+			("czipfile readmany(), %s threads" % workers, read_czipfile_batch, workers),
+		]
+
+		reference = None
+		for name, func, run_workers in runs:
+			elapsed, contents = bench(func, path, pwd, run_workers, repeat)
+			total = sum(len(content) for content in contents)
+			if reference is None:
+				reference = (elapsed, contents)
+			assert contents == reference[1], "%s output differs from the stdlib's!" % name
+
+			print("%-36s %8.3f s  %8.1f MB/s  %6.2fx" % (name, elapsed, total / elapsed / 1024 / 1024, reference[0] / elapsed))
 
-	loop = 0
-	for fileN, fctnt in files:
-		print("fileN, %s, fctnt, %s" % (fileN, len(fctnt)))
-		with open("(2)" + fileN, "wb") as fp:
-			fp.write(fctnt)
 
 if __name__ == "__main__":
 	go()
-
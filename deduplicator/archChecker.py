@@ -5,6 +5,8 @@ import logging
 import rpyc
 import settings
 
+import MangaCMS.lib.fileIdentity as fileIdentity
+
 
 PHASH_DISTANCE_THRESHOLD = 4
 
@@ -27,10 +29,12 @@ class ArchChecker(object):
 
 		self.lock = lock
 
-		self.arch = archPath
+		# `archPath` can also be a FileIdentity (see MangaCMS.lib.fileIdentity).
+		self.fileIdent = fileIdentity.identify(archPath)
+		self.arch = self.fileIdent.path
 
 	def process(self, moveToPath=None):
-		self.log.info("Processing download '%s'", self.arch)
+		self.log.info("Processing download '%s' (%s, %s bytes)", self.arch, self.fileIdent.mime, self.fileIdent.size)
 		status, bestMatch, intersections = self.remote.root.processDownload(self.arch, pathPositiveFilter=self.maskedPaths, negativeKeywords=self.negativeKeywords, distance=self.pdist, moveToPath=moveToPath)
 		self.log.info("Processed archive. Return status '%s'", status)
 		if bestMatch:
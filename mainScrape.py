@@ -22,6 +22,7 @@ import MangaCMS.util.runPlugin
 import MangaCMS.activePlugins
 import MangaCMS.lib.logSetup
 import MangaCMS.lib.statusManager
+import MangaCMS.lib.staging
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
@@ -150,6 +151,9 @@ def preflight():
 	MangaCMS.lib.statusManager.resetAllRunningFlags()
 	schemaUpdater.schemaRevisioner.updateDatabaseSchema()
 
+	# Clear out (or keep for resuming) anything left in the staging directory by a previous run.
+	MangaCMS.lib.staging.recover_staging()
+
 	nt.dirNameProxy.startDirObservers()
 
 
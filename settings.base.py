@@ -43,6 +43,11 @@ tadanohitoDir    = r"/SOMETHING/H/Tadanohito"
 
 globalDedupContext = [pickedDir, baseDir, unlinkedDir, mangaCmsHContext]
 
+# Scratch directory where downloads and archive rewrites are built before being moved into the
+# paths above. It must be on the same filesystem as them (so the final move is an atomic rename),
+# and must NOT be inside any of them (otherwise it'll get picked up as a series directory).
+stagingDir       = r"/SOMETHING/MangaCMS-staging"
+
 # Paths for database and web content
 webCtntPath      = '/SOMETHING/MangaCMS/ctnt/oldCtnt'
 webMvcPath       = '/SOMETHING/MangaCMS/ctnt/mvcCtnt'
@@ -187,6 +192,16 @@ noHighlightAddresses = [
 pronWhiteList = '10.1.1.0/24'
 
 
+# Per-host request rate limits, shared by every scraper process (the bucket state is kept in the database).
+# "rate" is the sustained requests per second, "burst" how many requests can go through back-to-back
+# after an idle period. An entry also covers the subdomains of that host. Hosts not listed are not limited.
+# The SadPanda entries default to the average of the random 10-300 second sleep the plugin used to make
+# after each gallery (one request per 155 seconds, no bursts). Its feed searches draw from the same budget.
+hostRateLimits = {
+	"exhentai.org"   : {"rate" : 1 / 155.0, "burst" : 1},
+	"e-hentai.org"   : {"rate" : 1 / 155.0, "burst" : 1},
+}
+
 # Directory of files/images that will be removed from any and all downloads.
 badImageDir  = r"/somepath/dir"
 
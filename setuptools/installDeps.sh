@@ -65,4 +65,7 @@ sudo pip3 install --upgrade pylzma markdown
 
 sudo pip3 install git+https://github.com/fake-name/UniversalArchiveInterface.git
 
+# Build the cythonized zip decryption/decompression extension (see czipfile/setup.py).
+(cd "$(dirname "$0")/../czipfile" && python3 setup.py build_ext --inplace)
+
 echo "done"
\ No newline at end of file
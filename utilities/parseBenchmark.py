@@ -0,0 +1,97 @@
+'''
+Compare BeautifulSoup (as used by WebGetRobust.getSoup()) against the lxml
+fast path in MangaCMS.lib.ParseMixin, on saved copies of real pages.
+
+Usage:
+	python3 -m utilities.parseBenchmark {fixture} [{fixture} ...]
+
+What gets extracted from a fixture is picked from its file name. Anything
+with "sadpanda" in the name is treated as a SadPanda search page (the `itg`
+gallery table), and anything with "mangadex" in it as a MangaDex series page
+(the chapter rows). Save fixtures with e.g. `wg.getpage(url)` and write the
+result out as utf-8.
+'''
+
+import re
+import sys
+import os.path
+import timeit
+
+import WebRequest
+
+from MangaCMS.lib import ParseMixin as pm
+
+ITERATIONS = 20
+
+
+def sadpanda_bs4(content):
+	soup = WebRequest.as_soup(content)
+	return soup.find("table", class_="itg").find_all("tr", class_=re.compile("gtr[01]"))
+
+def sadpanda_lxml(content):
+	tree = pm.parse_html(content)
+	return pm.css(tree, "table.itg tr.gtr0, table.itg tr.gtr1")
+
+def sadpanda_strained(content):
+	tables = pm.strain(content, "table", where=r'class=["\'][^"\']*\bitg\b', first=True)
+	return pm.css(pm.parse_html(tables[0]), "tr.gtr0, tr.gtr1")
+
+
+def mangadex_bs4(content):
+	soup = WebRequest.as_soup(content)
+	return [row for row in soup.find_all("tr") if "chapter_" in row.get("id", "")]
+
+def mangadex_lxml(content):
+	tree = pm.parse_html(content)
+	return tree.xpath('//tr[contains(@id, "chapter_")]')
+
+def mangadex_strained(content):
+	rows = pm.strain(content, "tr", where=r'id=["\']chapter_')
+	tree = pm.parse_fragments(["<table>"] + rows + ["</table>"])
+	return tree.xpath('.//tr[contains(@id, "chapter_")]')
+
+
+TARGETS = {
+	'sadpanda' : [
+			("BeautifulSoup",   sadpanda_bs4),
+			("lxml (full)",     sadpanda_lxml),
+			("lxml (strained)", sadpanda_strained),
+		],
+	'mangadex' : [
+			("BeautifulSoup",   mangadex_bs4),
+			("lxml (full)",     mangadex_lxml),
+			("lxml (strained)", mangadex_strained),
+		],
+}
+
+
+def bench_fixture(fpath):
+	fname = os.path.basename(fpath).lower()
+	targets = [funcs for key, funcs in TARGETS.items() if key in fname]
+	if not targets:
+		print("Don't know what to extract from '%s', skipping. (File name must contain one of %s)" % (fpath, list(TARGETS.keys())))
+		return
+
+	with open(fpath, "r", encoding="utf-8") as fp:
+		content = fp.read()
+
+	print("%s (%0.1f KB):" % (fpath, len(content) / 1024.0))
+	baseline = None
+	for name, func in targets[0]:
+		rows = len(func(content))
+		elapsed = timeit.timeit(lambda: func(content), number=ITERATIONS) / ITERATIONS
+		if baseline is None:
+			baseline = elapsed
+		print("	%-16s %8.2f ms per page, %4s rows, %5.1fx" % (name, elapsed * 1000, rows, baseline / elapsed))
+
+
+def go():
+	if len(sys.argv) < 2:
+		print(__doc__)
+		return
+	for fpath in sys.argv[1:]:
+		bench_fixture(fpath)
+
+
+if __name__ == "__main__":
+	go()
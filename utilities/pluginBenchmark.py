@@ -0,0 +1,253 @@
+'''
+Offline throughput benchmark for a scraper plugin.
+
+Usage:
+	python3 -m utilities.pluginBenchmark record {plugin_key} {recording_dir} [feeds|content|both]
+	python3 -m utilities.pluginBenchmark replay {plugin_key} {recording_dir} [feeds|content|both] [--reset]
+	python3 -m utilities.pluginBenchmark standin {plugin_key} {server_url} [feeds|content|both] [--reset]
+
+`record` runs the plugin's do_fetch_feeds() and/or do_fetch_content() against
+the live site, saving every HTTP exchange its WebGetRobust instance makes into
+{recording_dir} (see MangaCMS.lib.webRecorder). `replay` runs the same phases
+again, served entirely from the recordings, so the numbers reflect only the
+plugin's own parsing and ingest work (per-host rate limits are disabled while
+replaying).
+
+`standin` runs the phases live, against the local stand-in server at
+{server_url} (see utilities.standinServer), with the plugin's site URLs
+pointed at it. Only plugins whose pages the stand-in imitates (MangaDex,
+Hitomi) will find anything there.
+
+Run this with a settings.py pointing at a scratch database, and scratch
+download directories. `--reset` deletes the plugin's releases (and its page
+cache, watermarks and feed snapshot) before each run, so every replay ingests
+the same items. It refuses to run unless the database name contains "test".
+
+For each phase, the report has:
+	- Wall time, and items per second. For feeds, items are rows added to the
+	  release table. For content, they're rows moved out of the `new` state.
+	- Fetch time: time spent in (recorded or replayed) requests. Not
+	  available in `standin` mode.
+	- Parse time: time spent building BeautifulSoup/lxml trees, straining
+	  pages, and decoding JSON.
+	- DB time: time spent executing SQL statements, and the statement count.
+	- Peak RSS of the process, and how much it grew during the phase.
+Fetch, parse and DB times are summed over all threads, so with a threaded
+content loader they can add up to more than the wall time.
+'''
+
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+
+import bs4
+import lxml.html
+from sqlalchemy import event
+
+import runStatus
+import settings
+import utilities.testBase as tb
+
+import MangaCMS.db as db
+from MangaCMS.db.db_engine import engine
+import MangaCMS.activePlugins
+import MangaCMS.lib.ParseMixin
+import MangaCMS.lib.webRecorder as webRecorder
+import utilities.standinServer
+
+PHASES = ['feeds', 'content']
+
+# (owner, attribute) of each function whose run time counts as parsing.
+PARSE_ENTRY_POINTS = [
+		(bs4.BeautifulSoup,                     '__init__'),
+		(lxml.html,                             'fromstring'),
+		(MangaCMS.lib.ParseMixin.ParseMixin,    'strain'),
+		(json,                                  'loads'),
+	]
+
+
+class Timer(object):
+	'''
+	Thread-safe accumulator for the time spent in some category of call.
+	Calls nested inside another timed call of the same category aren't double counted.
+	'''
+	def __init__(self):
+		self.lock    = threading.Lock()
+		self.local   = threading.local()
+		self.elapsed = 0.0
+		self.calls   = 0
+
+	@contextlib.contextmanager
+	def timing(self):
+		depth = getattr(self.local, 'depth', 0)
+		self.local.depth = depth + 1
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.local.depth = depth
+			if depth == 0:
+				with self.lock:
+					self.elapsed += time.perf_counter() - start
+					self.calls   += 1
+
+	def wrap(self, func):
+		def timed(*args, **kwargs):
+			with self.timing():
+				return func(*args, **kwargs)
+		return timed
+
+
+@contextlib.contextmanager
+def parse_timing(timer):
+	patched = []
+	for owner, name in PARSE_ENTRY_POINTS:
+		original = owner.__dict__[name]
+		if isinstance(original, staticmethod):
+			setattr(owner, name, staticmethod(timer.wrap(original.__func__)))
+		else:
+			setattr(owner, name, timer.wrap(original))
+		patched.append((owner, name, original))
+	try:
+		yield
+	finally:
+		for owner, name, original in patched:
+			setattr(owner, name, original)
+
+@contextlib.contextmanager
+def db_timing(timer):
+	def before_execute(conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('bench_query_start', []).append(time.perf_counter())
+
+	def after_execute(conn, cursor, statement, parameters, context, executemany):
+		elapsed = time.perf_counter() - conn.info['bench_query_start'].pop()
+		with timer.lock:
+			timer.elapsed += elapsed
+			timer.calls   += 1
+
+	event.listen(engine, "before_cursor_execute", before_execute)
+	event.listen(engine, "after_cursor_execute", after_execute)
+	try:
+		yield
+	finally:
+		event.remove(engine, "before_cursor_execute", before_execute)
+		event.remove(engine, "after_cursor_execute", after_execute)
+
+
+def peak_rss_mb():
+	# ru_maxrss is in kilobytes on Linux.
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def count_rows(plugin, state=None):
+	table = db.HentaiReleases if plugin['is_h'] else db.MangaReleases
+	with db.session_context() as sess:
+		query = sess.query(table).filter(table.source_site == plugin['key'])
+		if state:
+			query = query.filter(table.state == state)
+		return query.count()
+
+def reset_plugin(plugin):
+	assert "test" in settings.NEW_DATABASE_DB_NAME.lower(), "Refusing to reset plugin data in a non-test database!"
+
+	if plugin['is_h']:
+		table, link_table = db.HentaiReleases, db.hentai_releases_tags_link
+	else:
+		table, link_table = db.MangaReleases, db.manga_releases_tags_link
+
+	key = plugin['key']
+	with db.session_context() as sess:
+		release_ids = sess.query(table.id).filter(table.source_site == key)
+		sess.execute(link_table.delete().where(link_table.c.releases_id.in_(release_ids.subquery())))
+		sess.query(table).filter(table.source_site == key).delete(synchronize_session=False)
+		sess.query(db.FeedPageCache).filter(db.FeedPageCache.source_site == key).delete(synchronize_session=False)
+		sess.query(db.FeedWatermark).filter(db.FeedWatermark.source_site == key).delete(synchronize_session=False)
+		sess.query(db.FeedSnapshot).filter(db.FeedSnapshot.source_site == key).delete(synchronize_session=False)
+	print("Reset all data for plugin '%s'" % key)
+
+
+def run_phase(plugin, phase, recorder, standin_url=None):
+	if phase == 'feeds':
+		instance = plugin['feedLoader']()
+		run      = instance.do_fetch_feeds
+		before   = count_rows(plugin)
+	else:
+		instance = plugin['contentLoader']()
+		run      = instance.do_fetch_content
+		before   = count_rows(plugin, state='new')
+
+	if recorder:
+		webRecorder.install(instance.wg, recorder)
+		fetch_start = recorder.wait_time
+		fetch_reqs  = recorder.requests
+	else:
+		utilities.standinServer.rebase_plugin(instance, standin_url)
+
+	parse_timer = Timer()
+	db_timer    = Timer()
+	rss_start   = peak_rss_mb()
+
+	start = time.perf_counter()
+	with parse_timing(parse_timer), db_timing(db_timer):
+		run()
+	wall = time.perf_counter() - start
+
+	if phase == 'feeds':
+		items = count_rows(plugin) - before
+	else:
+		items = before - count_rows(plugin, state='new')
+
+	print("")
+	print("%s: %s (%s mode)" % (phase, plugin['name'], recorder.mode if recorder else "standin"))
+	print("	Wall time:  %8.2f s" % wall)
+	print("	Items:      %8s   (%0.2f items/s)" % (items, items / wall if wall else 0))
+	if recorder:
+		print("	Fetch time: %8.2f s   (%s requests)" % (recorder.wait_time - fetch_start, recorder.requests - fetch_reqs))
+	print("	Parse time: %8.2f s   (%s calls)" % (parse_timer.elapsed, parse_timer.calls))
+	print("	DB time:    %8.2f s   (%s statements)" % (db_timer.elapsed, db_timer.calls))
+	print("	Peak RSS:   %8.1f MB  (+%0.1f MB)" % (peak_rss_mb(), peak_rss_mb() - rss_start))
+
+
+def go():
+	args  = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+
+	if len(args) < 3 or args[0] not in ("record", "replay", "standin"):
+		print(__doc__)
+		return
+
+	mode, plugin_key, target = args[:3]
+	phases = PHASES if len(args) < 4 or args[3] == 'both' else [args[3]]
+	assert all(phase in PHASES for phase in phases), "Phase must be one of %s, or 'both'" % PHASES
+
+	plugins = MangaCMS.activePlugins.PLUGIN_MAP
+	if plugin_key not in plugins:
+		print("Key {} not in available plugins ({})!".format(plugin_key, list(plugins.keys())))
+		return
+	plugin = plugins[plugin_key]
+
+	recorder = None
+	if mode in ("record", "replay"):
+		recorder = webRecorder.HttpRecorder(target, mode)
+	if mode != "record":
+		settings.hostRateLimits = {}
+
+	with tb.testSetup(load='content' in phases):
+		if "--reset" in flags:
+			reset_plugin(plugin)
+
+		for phase in phases:
+			if not runStatus.run:
+				break
+			run_phase(plugin, phase, recorder, standin_url=target)
+
+	if recorder and recorder.misses:
+		print("")
+		print("WARNING: %s requests had no recording, and were failed." % recorder.misses)
+
+
+if __name__ == "__main__":
+	go()
@@ -0,0 +1,377 @@
+'''
+Local stand-in for the sites the scrapers talk to, for end-to-end load testing
+without network access.
+
+Usage:
+	python3 -m utilities.standinServer [--port=8089] [--latency=0] [--series=20] [--chapters=5]
+		[--galleries=50] [--images=20] [--image-kb=200] [--archive-kb=5000] [--ad-image={path}]
+
+It serves synthetic content with the page structure the plugins parse:
+
+	MangaDex
+		/1                         Update listing (the `table-responsive` table of `manga_title` links)
+		/manga/{sid}               Series page (`panel-title`, and the `chapter_` rows)
+		/chapter/{cid}             Chapter page, with the `page_array`, `server` and `dataurl` JS vars
+		/data/{hash}/{page}.png    Chapter images
+	Hitomi
+		/index-all-{num}.html      Gallery listing (`gallery-content`, with the info tables)
+		/galleries/{gid}.html      Gallery page (tag table, and the `thumbnail-container` thumbnails)
+		/reader/{gid}.html         Reader page (`img-url` divs)
+		/galleries/{gid}/{n}.png   Gallery images (and `{n}t.png` thumbnails)
+	Archives
+		/archive/{aid}.zip         Zip of synthetic images, served with Range support
+
+All content is generated deterministically from the URL, so repeated runs see
+the same items (and the same file hashes). Images are valid, incompressible
+PNGs of about `--image-kb`. Archives are about `--archive-kb`, and if
+`--ad-image` is given, that file is added to every chapter and archive, so the
+ArchCleaner has something to remove (point settings.badImageDir at a directory
+containing it). `--latency` (in milliseconds) is added to every response.
+
+To point plugins at the server, create them as usual, and pass them through
+rebase_plugin() (pluginBenchmark's `standin` mode does this).
+'''
+
+import io
+import re
+import sys
+import time
+import zlib
+import struct
+import random
+import hashlib
+import zipfile
+import datetime
+import functools
+import urllib.parse
+import socketserver
+import http.server
+
+# Plugin attributes holding site URLs, which rebase_plugin() points at the stand-in.
+URL_ATTRIBUTES = ['urlBase', 'seriesBase', 'urlFeed']
+
+# Everything is dated relative to this, so the content doesn't change between runs.
+BASE_DATE = datetime.datetime(2018, 1, 1)
+
+
+class StandinConfig(object):
+	port       = 8089
+	latency    = 0
+	series     = 20
+	chapters   = 5
+	galleries  = 50
+	images     = 20
+	image_kb   = 200
+	archive_kb = 5000
+	ad_image   = None
+
+	# Gallery listing pages hold this many galleries each.
+	per_index_page = 25
+
+	@classmethod
+	def from_args(cls, args):
+		for arg in args:
+			key, _, value = arg.lstrip("-").partition("=")
+			key = key.replace("-", "_")
+			assert hasattr(cls, key) and value, "Invalid argument: '%s'" % arg
+			setattr(cls, key, value if key == 'ad_image' else int(value))
+		return cls
+
+
+def rebase_plugin(plugin, base_url):
+	'''
+	Point an (instantiated) feed or content plugin at the stand-in server at
+	`base_url`. The real sites' login and WAF step-through (in setup()) don't
+	apply to the stand-in, so setup() is disabled.
+	'''
+	base = urllib.parse.urlsplit(base_url)
+	for attr in URL_ATTRIBUTES:
+		value = getattr(plugin, attr, None)
+		if value:
+			parts = urllib.parse.urlsplit(value)
+			setattr(plugin, attr, urllib.parse.urlunsplit((base.scheme, base.netloc) + tuple(parts[2:])))
+	plugin.setup = lambda: None
+	return plugin
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+# Synthetic content
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+def _png_chunk(kind, data):
+	return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+@functools.lru_cache(maxsize=512)
+def make_png(seed, size):
+	'''
+	A valid RGB PNG of about `size` bytes, filled with noise (so it doesn't
+	compress), and unique to `seed`.
+	'''
+	width  = 256
+	height = max(1, size // (width * 3))
+	rnd = random.Random(seed)
+
+	row_bytes = width * 3
+	noise = rnd.getrandbits(row_bytes * height * 8).to_bytes(row_bytes * height, "little")
+	raw = b"".join(b"\x00" + noise[row * row_bytes:(row + 1) * row_bytes] for row in range(height))
+
+	return b"".join([
+			b"\x89PNG\r\n\x1a\n",
+			_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+			_png_chunk(b"IDAT", zlib.compress(raw, 1)),
+			_png_chunk(b"IEND", b""),
+		])
+
+@functools.lru_cache(maxsize=1)
+def load_ad_image(path):
+	with open(path, "rb") as fp:
+		return fp.read()
+
+@functools.lru_cache(maxsize=32)
+def make_archive(aid, size, image_count, ad_image):
+	buf = io.BytesIO()
+	image_size = max(1024, size // max(1, image_count))
+	with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as arch:
+		for idx in range(image_count):
+			arch.writestr("%03d.png" % idx, make_png("archive-%s-%s" % (aid, idx), image_size))
+		if ad_image:
+			arch.writestr("%03d.png" % image_count, load_ad_image(ad_image))
+	return buf.getvalue()
+
+def series_name(sid):
+	return "Stand-in Series %s" % sid
+
+def chapter_hash(cid):
+	return hashlib.md5(str(cid).encode("ascii")).hexdigest()
+
+def posted(offset_hours):
+	return BASE_DATE - datetime.timedelta(hours=offset_hours)
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+# Pages
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+def page(title, body):
+	return PAGE_TEMPLATE.format(title=title, body=body)
+
+def mangadex_listing(conf):
+	rows = []
+	for sid in range(1, conf.series + 1):
+		rows.append('<tr><td><a class="manga_title" href="/manga/{sid}">{name}</a></td><td>{when}</td></tr>'.format(
+				sid=sid, name=series_name(sid), when=posted(sid)))
+	body = '<div class="table-responsive"><table class="table">\n{}\n</table></div>'.format("\n".join(rows))
+	return page("Updates", body)
+
+def mangadex_series(conf, sid):
+	rows = ['<tr id="chapter_header"><th>Chapter</th></tr>']
+	# Newest first, like the real thing.
+	for chap in range(conf.chapters, 0, -1):
+		cid = sid * 1000 + chap
+		rows.append('''<tr id="chapter_{cid}">
+	<td></td>
+	<td><a href="/chapter/{cid}">Vol. 1 Ch. {chap}
+		Chapter {chap}</a></td>
+	<td></td>
+	<td><img src="/flags/gb.png" title="English"></td>
+	<td><a href="/group/1">Stand-in Scans</a></td>
+	<td><a href="/user/1">uploader</a></td>
+	<td>100</td>
+	<td title="{when}">{when}</td>
+</tr>'''.format(cid=cid, chap=chap, when=posted(sid + (conf.chapters - chap) * 24)))
+	body = '''<div class="panel"><div class="panel-heading"><h3 class="panel-title">{name}</h3></div></div>
+<table class="table">
+{rows}
+</table>'''.format(name=series_name(sid), rows="\n".join(rows))
+	return page(series_name(sid), body)
+
+def mangadex_chapter(conf, cid):
+	pages = ["%s.png" % idx for idx in range(1, conf.images + 1)]
+	if conf.ad_image:
+		pages.append("ad.png")
+	script = '''<script type="text/javascript">
+	var chapter_id = {cid};
+	var dataurl = '{hash}';
+	var page_array = {pages};
+	var server = '/data/';
+</script>'''.format(cid=cid, hash=chapter_hash(cid), pages=repr(pages))
+	return page("Chapter %s" % cid, script)
+
+def hitomi_index(conf, num):
+	items = []
+	first = (num - 1) * conf.per_index_page + 1
+	for gid in range(first, min(first + conf.per_index_page, conf.galleries + 1)):
+		items.append('''<div class="dj">
+	<h1><a href="/galleries/{gid}.html">Stand-in Gallery {gid}</a></h1>
+	<table>
+		<tr><td>Series</td><td>Original</td></tr>
+		<tr><td>Type</td><td>doujinshi</td></tr>
+		<tr><td>Language</td><td>english</td></tr>
+		<tr><td>Tags</td><td>female:stand-in</td></tr>
+	</table>
+	<p class="date">{when}</p>
+</div>'''.format(gid=gid, when=posted(gid)))
+	return page("Hitomi index", '<div class="gallery-content">\n{}\n</div>'.format("\n".join(items)))
+
+def hitomi_gallery(conf, gid):
+	thumbs = ['<a class="gallerythumb" href="/reader/{gid}.html#{idx}"><img src="/galleries/{gid}/{idx}t.png"></a>'.format(
+			gid=gid, idx=idx) for idx in range(1, conf.images + 1)]
+	body = '''<div class="gallery">
+	<h1><a href="/reader/{gid}.html">Stand-in Gallery {gid}</a></h1>
+	<h2><ul><li>stand-in artist</li></ul></h2>
+	<div class="gallery-info"><table>
+		<tr><td>Type</td><td>doujinshi</td></tr>
+		<tr><td>Language</td><td>english</td></tr>
+		<tr><td>Series</td><td><ul><li>original</li></ul></td></tr>
+		<tr><td>Characters</td><td><ul><li>stand-in character</li></ul></td></tr>
+		<tr><td>Tags</td><td><ul><li>stand-in ♀</li><li>synthetic</li></ul></td></tr>
+	</table></div>
+	<a href="/reader/{gid}.html">Read Online</a>
+</div>
+<div id="thumbnail-container">
+{thumbs}
+</div>'''.format(gid=gid, thumbs="\n".join(thumbs))
+	return page("Stand-in Gallery %s" % gid, body)
+
+def hitomi_reader(conf, gid, base_url):
+	# Full URLs, so the plugin's CDN host rewriting leaves them pointing here.
+	divs = ['<div class="img-url">{base}/galleries/{gid}/{idx}.png</div>'.format(base=base_url, gid=gid, idx=idx)
+			for idx in range(1, conf.images + 1)]
+	return page("Reader %s" % gid, "\n".join(divs))
+
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+# Server
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+
+	conf = StandinConfig
+	protocol_version = "HTTP/1.1"
+
+	routes = [
+			(re.compile(r"^/1$"),                                   'do_mangadex_listing'),
+			(re.compile(r"^/manga/(\d+)$"),                         'do_mangadex_series'),
+			(re.compile(r"^/chapter/(\d+)$"),                       'do_mangadex_chapter'),
+			(re.compile(r"^/data/([0-9a-f]+)/([\w]+)\.png$"),       'do_chapter_image'),
+			(re.compile(r"^/index-all-(\d+)\.html$"),               'do_hitomi_index'),
+			(re.compile(r"^/galleries/(\d+)\.html$"),               'do_hitomi_gallery'),
+			(re.compile(r"^/reader/(\d+)\.html$"),                  'do_hitomi_reader'),
+			(re.compile(r"^/galleries/(\d+)/(\d+)(t?)\.png$"),      'do_gallery_image'),
+			(re.compile(r"^/archive/(\w+)\.zip$"),                  'do_archive'),
+		]
+
+	def log_message(self, fmt, *args):
+		pass
+
+	def base_url(self):
+		return "http://%s" % (self.headers.get("Host") or "%s:%s" % self.server.server_address)
+
+	def do_GET(self):
+		if self.conf.latency:
+			time.sleep(self.conf.latency / 1000.0)
+
+		path = urllib.parse.urlsplit(self.path).path
+		for route, handler in self.routes:
+			match = route.match(path)
+			if match:
+				return getattr(self, handler)(*match.groups())
+		self.send_error(404)
+
+	def send_content(self, content, ctype, filename=None):
+		if isinstance(content, str):
+			content = content.encode("utf-8")
+
+		start = 0
+		match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+		if match and filename and int(match.group(1)) < len(content):
+			start = int(match.group(1))
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %s-%s/%s" % (start, len(content) - 1, len(content)))
+		else:
+			self.send_response(200)
+
+		self.send_header("Content-Type", ctype)
+		self.send_header("Content-Length", str(len(content) - start))
+		if filename:
+			self.send_header("Content-Disposition", 'attachment; filename="%s"' % filename)
+			self.send_header("Accept-Ranges", "bytes")
+			self.send_header("ETag", '"%s"' % hashlib.md5(content).hexdigest())
+		self.end_headers()
+		self.wfile.write(content[start:])
+
+	def send_page(self, content):
+		self.send_content(content, "text/html; charset=utf-8")
+
+	def send_image(self, seed, size):
+		self.send_content(make_png(seed, size), "image/png")
+
+	def do_mangadex_listing(self):
+		self.send_page(mangadex_listing(self.conf))
+
+	def do_mangadex_series(self, sid):
+		self.send_page(mangadex_series(self.conf, int(sid)))
+
+	def do_mangadex_chapter(self, cid):
+		self.send_page(mangadex_chapter(self.conf, int(cid)))
+
+	def do_chapter_image(self, chash, name):
+		if name == "ad" and self.conf.ad_image:
+			return self.send_content(load_ad_image(self.conf.ad_image), "image/png")
+		self.send_image("chapter-%s-%s" % (chash, name), self.conf.image_kb * 1024)
+
+	def do_hitomi_index(self, num):
+		self.send_page(hitomi_index(self.conf, int(num)))
+
+	def do_hitomi_gallery(self, gid):
+		self.send_page(hitomi_gallery(self.conf, int(gid)))
+
+	def do_hitomi_reader(self, gid):
+		self.send_page(hitomi_reader(self.conf, int(gid), self.base_url()))
+
+	def do_gallery_image(self, gid, idx, thumb):
+		if thumb:
+			self.send_image("thumb-%s-%s" % (gid, idx), 4 * 1024)
+		else:
+			self.send_image("gallery-%s-%s" % (gid, idx), self.conf.image_kb * 1024)
+
+	def do_archive(self, aid):
+		content = make_archive(aid, self.conf.archive_kb * 1024, self.conf.images, self.conf.ad_image)
+		self.send_content(content, "application/zip", filename="%s.zip" % aid)
+
+
+class StandinServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+
+def serve(conf):
+	handler = type("ConfiguredStandinHandler", (StandinHandler, ), {'conf' : conf})
+	server = StandinServer(("127.0.0.1", conf.port), handler)
+	print("Stand-in server listening on http://127.0.0.1:%s/" % server.server_address[1])
+	return server
+
+
+def go():
+	if "-h" in sys.argv or "--help" in sys.argv:
+		print(__doc__)
+		return
+
+	server = serve(StandinConfig.from_args(sys.argv[1:]))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print("Stopping")
+	server.server_close()
+
+
+if __name__ == "__main__":
+	go()